@@ -0,0 +1,247 @@
+"""
+Compare the dashboard and group pages under WSGI and ASGI at increasing concurrency.
+
+    python -m benchmarks.bench_asgi [--size small] [--concurrency 1 8 32] [--duration 10]
+
+A scratch database is seeded by ``seed_scale``, then gunicorn is started on
+it twice with the same number of worker processes: with gthread workers
+(WSGI, the sync views) and with uvicorn workers (ASGI, the same sync views
+and the async versions under /async/). For each page and concurrency
+level, that many keep-alive connections request the page as fast as they
+can for --duration seconds. Throughput and p50/p99 latency are printed and, with
+--output, written as JSON.
+
+Needs gunicorn and uvicorn installed (``pip install gunicorn uvicorn``).
+The load generator runs in this process, so keep an eye on CPU: on a small
+machine it competes with the servers for cores.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import time
+
+from benchmarks.bench_views import SIZES, pick_subjects, seed
+from benchmarks.support import scratch_database, setup_django
+
+
+# (name, server, path template); {group} is replaced by the group's id
+SCENARIOS = [
+    ('expense_list', 'wsgi', '/?period=all'),
+    ('expense_list', 'asgi', '/?period=all'),
+    ('expense_list_async', 'asgi', '/async/?period=all'),
+    ('group_detail', 'wsgi', '/groups/{group}/'),
+    ('group_detail', 'asgi', '/groups/{group}/'),
+    ('group_detail_async', 'asgi', '/async/groups/{group}/'),
+]
+WARMUP_SECONDS = 1.0
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def server_command(kind, port, workers, threads):
+    # Both run under gunicorn, as in production, so only the worker class
+    # differs. uvicorn's own --workers mode leaves Nagle's algorithm on for
+    # accepted connections, which adds ~40ms to every keep-alive response.
+    if kind == 'wsgi':
+        worker = ['--worker-class', 'gthread', '--threads', str(threads)]
+    else:
+        worker = ['--worker-class', 'uvicorn.workers.UvicornWorker']
+    return [
+        sys.executable, '-m', 'gunicorn', f'expense_tracker.{kind}:application',
+        '--bind', f'127.0.0.1:{port}', '--workers', str(workers), '--log-level', 'warning', *worker,
+    ]
+
+
+class Server:
+    """A WSGI or ASGI server subprocess serving the scratch database."""
+
+    def __init__(self, kind, database_name, workers, threads):
+        self.kind = kind
+        self.port = free_port()
+        env = {
+            **os.environ,
+            'DJANGO_SETTINGS_MODULE': 'benchmarks.server_settings',
+            'BENCH_DATABASE_NAME': database_name,
+        }
+        self.process = subprocess.Popen(server_command(kind, self.port, workers, threads), env=env)
+
+    def wait_until_ready(self, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f'{self.kind} server exited with {self.process.returncode}')
+            try:
+                socket.create_connection(('127.0.0.1', self.port), timeout=0.5).close()
+                return
+            except OSError:
+                time.sleep(0.1)
+        raise RuntimeError(f'{self.kind} server did not start within {timeout}s')
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+    def __enter__(self):
+        try:
+            self.wait_until_ready()
+        except Exception:
+            self.stop()
+            raise
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+async def read_response(reader):
+    """Read one HTTP/1.1 response; return ``(status, keep_alive)``."""
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError('connection closed')
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    if 'content-length' in headers:
+        await reader.readexactly(int(headers['content-length']))
+    elif headers.get('transfer-encoding') == 'chunked':
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            await reader.readexactly(size + 2)
+            if size == 0:
+                break
+    return int(status_line.split()[1]), headers.get('connection', '').lower() != 'close'
+
+
+async def hammer(port, request, deadline, record_after, latencies, errors):
+    """Send ``request`` over one keep-alive connection until ``deadline``."""
+    reader = writer = None
+    while time.monotonic() < deadline:
+        if writer is None:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        started = time.monotonic()
+        try:
+            writer.write(request)
+            status, keep_alive = await read_response(reader)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            writer.close()
+            reader = writer = None
+            errors.append('connection')
+            continue
+        finished = time.monotonic()
+        if started >= record_after:
+            latencies.append(finished - started)
+            if status != 200:
+                errors.append(status)
+        if not keep_alive:
+            writer.close()
+            reader = writer = None
+    if writer is not None:
+        writer.close()
+
+
+async def load(port, path, cookie, concurrency, duration):
+    request = (
+        f'GET {path} HTTP/1.1\r\nHost: 127.0.0.1\r\nCookie: {cookie}\r\n\r\n'
+    ).encode()
+    latencies, errors = [], []
+    started = time.monotonic()
+    record_after = started + WARMUP_SECONDS
+    deadline = record_after + duration
+    await asyncio.gather(*[
+        hammer(port, request, deadline, record_after, latencies, errors)
+        for _ in range(concurrency)
+    ])
+    return latencies, errors
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def session_cookie(user):
+    from django.conf import settings
+    from django.test import Client
+
+    client = Client()
+    client.force_login(user)
+    return f'{settings.SESSION_COOKIE_NAME}={client.cookies[settings.SESSION_COOKIE_NAME].value}'
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--size', choices=list(SIZES), default='small')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--duration', type=float, default=10.0, help='Seconds of load per measurement.')
+    parser.add_argument('--workers', type=int, default=2, help='Server worker processes.')
+    parser.add_argument('--threads', type=int, default=8, help='Threads per gunicorn worker.')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='Write the results to this JSON file.')
+    args = parser.parse_args(argv)
+
+    setup_django()
+    from django.db import connection
+
+    results = []
+    with scratch_database():
+        started = time.perf_counter()
+        seed(args.size, args.seed)
+        print(f'[{args.size}] seeded in {time.perf_counter() - started:.1f}s', file=sys.stderr)
+        user, group, _ = pick_subjects()
+        cookie = session_cookie(user)
+        database_name = connection.settings_dict['NAME']
+        connection.close()
+
+        print(f'{"view":<20} {"server":<6} {"conc":>5} {"req/s":>9} {"p50 ms":>9} {"p99 ms":>9} {"errors":>7}')
+        for kind in ('wsgi', 'asgi'):
+            with Server(kind, database_name, args.workers, args.threads) as server:
+                for name, scenario_kind, path in SCENARIOS:
+                    if scenario_kind != kind:
+                        continue
+                    path = path.format(group=group.pk)
+                    for concurrency in args.concurrency:
+                        latencies, errors = asyncio.run(
+                            load(server.port, path, cookie, concurrency, args.duration)
+                        )
+                        row = {
+                            'view': name, 'server': kind, 'concurrency': concurrency,
+                            'requests': len(latencies),
+                            'rps': round(len(latencies) / args.duration, 1),
+                            'p50_ms': round(percentile(latencies, 0.50) * 1000, 2) if latencies else None,
+                            'p99_ms': round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+                            'errors': len(errors),
+                        }
+                        results.append(row)
+                        print(f'{name:<20} {kind:<6} {concurrency:>5} {row["rps"]:>9.1f} '
+                              f'{row["p50_ms"] or 0:>9.2f} {row["p99_ms"] or 0:>9.2f} {row["errors"]:>7}')
+
+    if args.output:
+        report = {
+            'meta': {
+                'python': platform.python_version(), 'size': args.size, 'duration': args.duration,
+                'workers': args.workers, 'threads': args.threads, 'cpus': os.cpu_count(),
+            },
+            'results': results,
+        }
+        with open(args.output, 'w') as handle:
+            json.dump(report, handle, indent=2)
+
+
+if __name__ == '__main__':
+    main()
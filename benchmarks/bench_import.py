@@ -0,0 +1,70 @@
+"""
+Benchmark the bulk CSV import against a throwaway database.
+
+    python -m benchmarks.bench_import [--rows 10000 50000] [--categories 20] [--seed 1]
+
+Builds a scratch SQLite file in a temporary directory (or a test database
+on whatever DATABASE_URL points at), imports generated CSV for one user
+and reports rows per second. With --min-rate it exits non-zero when
+throughput drops below that many rows per second.
+"""
+import argparse
+import csv
+import io
+import random
+import sys
+import time
+from datetime import date, timedelta
+
+from benchmarks.support import scratch_database, setup_django
+
+
+def make_csv(rows, categories, rng):
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(['Title', 'Amount', 'Category', 'Date', 'Description'])
+    start = date(2020, 1, 1)
+    for i in range(rows):
+        writer.writerow([
+            f'expense {i}',
+            f'{rng.randint(100, 50_000) / 100:.2f}',
+            f'category {rng.randrange(categories)}',
+            (start + timedelta(days=rng.randrange(1500))).isoformat(),
+            'imported' if i % 4 else '',
+        ])
+    return out.getvalue()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, nargs='+', default=[10_000, 50_000])
+    parser.add_argument('--categories', type=int, default=20)
+    parser.add_argument('--batch-size', type=int)
+    parser.add_argument('--min-rate', type=float, help='Rows per second required.')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    setup_django()
+    from django.contrib.auth.models import User
+    from expenses import imports
+
+    rng = random.Random(args.seed)
+    slowest = None
+    print(f'{"rows":>8} {"seconds":>8} {"rows/s":>9}')
+    with scratch_database():
+        for size in args.rows:
+            user = User.objects.create_user(f'bench{size}')
+            text = make_csv(size, args.categories, rng)
+            started = time.perf_counter()
+            result = imports.import_expenses(user, io.StringIO(text), args.batch_size)
+            elapsed = time.perf_counter() - started
+            rate = result.created / elapsed
+            slowest = rate if slowest is None else min(slowest, rate)
+            print(f'{size:>8} {elapsed:>8.2f} {rate:>9.0f}')
+
+    if args.min_rate and slowest is not None and slowest < args.min_rate:
+        sys.exit(f'Import throughput {slowest:.0f} rows/s is below {args.min_rate:.0f}.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+"""
+Benchmark the group debt simplification on large synthetic groups.
+
+    python -m benchmarks.bench_settlements [--sizes 1000 5000 10000] [--seed 1]
+
+Balances are random amounts in cents, adjusted so the group sums to zero
+as the ledger always does.
+"""
+import argparse
+import random
+import time
+from decimal import Decimal
+
+from expenses.settlements import simplify_debts
+
+
+def make_balances(members, rng):
+    cents = [rng.randint(-50_000, 50_000) for _ in range(members - 1)]
+    cents.append(-sum(cents))
+    return {f'user{i}': Decimal(amount) / 100 for i, amount in enumerate(cents)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1_000, 5_000, 10_000])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    print(f'{"members":>8} {"transfers":>10} {"best ms":>9} {"worst ms":>9}')
+    for size in args.sizes:
+        balances = make_balances(size, rng)
+        timings = []
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            transfers = simplify_debts(balances)
+            timings.append((time.perf_counter() - started) * 1000)
+        print(f'{size:>8} {len(transfers):>10} {min(timings):>9.1f} {max(timings):>9.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+"""
+Benchmark the main pages through the Django test client on seeded data.
+
+    python -m benchmarks.bench_views [--sizes small medium] [--repeat 5] [--output results.json]
+    python -m benchmarks.bench_views --baseline baseline.json [--threshold 1.25]
+
+For each dataset size a scratch database is filled by ``seed_scale`` and
+every view is requested ``--repeat`` times with the dashboard cache cleared.
+The median wall time, SQL query count and median SQL time per view are
+printed and, with --output, written as JSON. With --baseline, results are
+compared against an earlier JSON file: any view that issues more queries,
+or is slower than the baseline by more than --threshold, is reported as a
+regression and the run exits non-zero.
+"""
+import argparse
+import io
+import json
+import platform
+import statistics
+import sys
+import time
+from contextlib import nullcontext
+
+from benchmarks.support import scratch_database, setup_django, stub_templates_if_missing
+
+
+SIZES = {
+    'small': dict(users=50, expenses=5_000, groups=20, shared_expenses=1_000),
+    'medium': dict(users=500, expenses=50_000, groups=200, shared_expenses=10_000),
+    'large': dict(users=5_000, expenses=500_000, groups=2_000, shared_expenses=100_000),
+}
+PERIODS = ['daily', 'weekly', 'monthly', 'all']
+# Differences smaller than this are noise whatever the ratio
+MIN_REGRESSION_MS = 2.0
+
+
+def seed(size, seed_value):
+    from django.core.management import call_command
+    call_command('seed_scale', seed=seed_value, skew=1.2, group_skew=1.5, stdout=io.StringIO(),
+                 **SIZES[size])
+
+
+def pick_subjects():
+    """The heaviest user, the largest group they belong to, and an admin user."""
+    from django.contrib.auth.models import User
+    from django.db.models import Count
+    from expenses.models import Group
+
+    user = User.objects.annotate(n=Count('expenses')).order_by('-n', 'pk').first()
+    group = Group.objects.filter(members=user).order_by('-member_count', 'pk').first()
+    admin = User.objects.create_superuser('bench-admin', 'bench@example.com', 'bench')
+    return user, group, admin
+
+
+def scenarios(user, group, admin):
+    """Yield ``(name, login_as, method, path, data)`` for every benchmarked request."""
+    from django.urls import reverse
+
+    for period in PERIODS:
+        yield f'expense_list?period={period}', user, 'get', reverse('expense_list'), {'period': period}
+    yield 'category_list', user, 'get', reverse('category_list'), None
+    yield 'group_list', user, 'get', reverse('group_list'), None
+    if group is not None:
+        yield 'group_detail', user, 'get', reverse('group_detail', args=[group.pk]), None
+        yield 'shared_expense_create', user, 'post', reverse('shared_expense_create', args=[group.pk]), {
+            'title': 'Benchmark', 'amount': '90.00', 'split_type': 'equal', 'date': '2024-01-01',
+        }
+    for model in ('expense', 'category', 'group', 'sharedexpense', 'userexpensesummary'):
+        yield f'admin:{model}', admin, 'get', reverse(f'admin:expenses_{model}_changelist'), None
+
+
+class QueryTimer:
+    """
+    Database execute wrapper that counts queries and adds up their time.
+
+    Only execution is timed; rows fetched lazily afterwards (as SQLite does
+    for large results) are counted in the wall time instead.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.seconds += time.perf_counter() - started
+            self.count += 1
+
+
+def measure(client, method, path, data, repeat):
+    from django.core.cache import cache
+    from django.db import connection
+
+    walls, sql_times, counts = [], [], set()
+    for _ in range(repeat):
+        cache.clear()
+        timer = QueryTimer()
+        with connection.execute_wrapper(timer):
+            started = time.perf_counter()
+            response = getattr(client, method)(path, data)
+            if response.streaming:
+                b''.join(response.streaming_content)
+            walls.append((time.perf_counter() - started) * 1000)
+        # A form that fails validation re-renders with 200 instead of redirecting
+        expected = 302 if method == 'post' else 200
+        if response.status_code != expected:
+            raise RuntimeError(f'{method.upper()} {path} returned {response.status_code}')
+        sql_times.append(timer.seconds * 1000)
+        counts.add(timer.count)
+    return {
+        'wall_ms': round(statistics.median(walls), 2),
+        'sql_ms': round(statistics.median(sql_times), 2),
+        'queries': max(counts),
+    }
+
+
+def run_size(size, repeat, seed_value):
+    from django.test import Client
+
+    with scratch_database():
+        started = time.perf_counter()
+        seed(size, seed_value)
+        print(f'[{size}] seeded in {time.perf_counter() - started:.1f}s', file=sys.stderr)
+        user, group, admin = pick_subjects()
+        client = Client()
+        results = []
+        for name, login_as, method, path, data in scenarios(user, group, admin):
+            client.force_login(login_as)
+            result = {'size': size, 'view': name, **measure(client, method, path, data, repeat)}
+            results.append(result)
+            print(f'{size:<7} {name:<30} {result["wall_ms"]:>9.2f} {result["sql_ms"]:>9.2f} {result["queries"]:>8}')
+        return results
+
+
+def compare(results, baseline, threshold):
+    """Return a list of human-readable regressions against ``baseline``."""
+    previous = {(row['size'], row['view']): row for row in baseline['results']}
+    regressions = []
+    for row in results:
+        base = previous.get((row['size'], row['view']))
+        if base is None:
+            continue
+        label = f'{row["size"]} {row["view"]}'
+        if row['queries'] > base['queries']:
+            regressions.append(f'{label}: {base["queries"]} -> {row["queries"]} queries')
+        if (row['wall_ms'] > base['wall_ms'] * threshold
+                and row['wall_ms'] - base['wall_ms'] > MIN_REGRESSION_MS):
+            regressions.append(f'{label}: {base["wall_ms"]:.2f} -> {row["wall_ms"]:.2f} ms')
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', nargs='+', choices=list(SIZES), default=['small', 'medium'])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='Write the results to this JSON file.')
+    parser.add_argument('--baseline', help='Compare against results saved with --output.')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='Flag views slower than baseline times this factor.')
+    args = parser.parse_args(argv)
+
+    setup_django()
+    from django.test.utils import setup_test_environment
+    setup_test_environment()
+
+    print(f'{"size":<7} {"view":<30} {"wall ms":>9} {"sql ms":>9} {"queries":>8}')
+    results = []
+    with stub_templates_if_missing() or nullcontext():
+        for size in args.sizes:
+            results += run_size(size, args.repeat, args.seed)
+
+    report = {
+        'meta': {'python': platform.python_version(), 'repeat': args.repeat, 'seed': args.seed},
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as handle:
+            json.dump(report, handle, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as handle:
+            regressions = compare(results, json.load(handle), args.threshold)
+        for line in regressions:
+            print(f'REGRESSION {line}')
+        if regressions:
+            sys.exit(1)
+        print('No regressions against the baseline.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,21 @@
+"""
+Settings for the servers bench_asgi starts in subprocesses.
+
+The project's settings, pointed at the benchmark's scratch database, with
+stub templates standing in for any that aren't installed.
+"""
+import os
+
+from expense_tracker.settings import *  # noqa: F401,F403
+from expense_tracker.settings import DATABASES, TEMPLATES
+
+from benchmarks.support import with_stub_templates
+
+
+DEBUG = False
+ALLOWED_HOSTS = ['127.0.0.1', 'localhost']
+DATABASES['default']['NAME'] = os.environ['BENCH_DATABASE_NAME']
+# Under ASGI each request runs its sync code in a fresh thread, so a
+# persistent connection would never be reused; close them on both servers
+DATABASES['default']['CONN_MAX_AGE'] = 0
+TEMPLATES = with_stub_templates(TEMPLATES)
@@ -0,0 +1,93 @@
+"""
+Helpers shared by the benchmarks that need the Django project.
+"""
+import os
+import tempfile
+from contextlib import contextmanager
+
+
+# Minimal stand-ins for the app templates, used when the real ones are not
+# installed. They touch the same context the real pages display, so lazy
+# querysets and per-row model calls still run.
+STUB_TEMPLATES = {
+    'expenses/expense_list.html': (
+        '{{ total_amount }}{{ expense_count }}'
+        '{% for row in expenses_by_category %}{{ row.category__name }}{{ row.total }}{% endfor %}'
+        '{% for expense in expenses %}{{ expense.title }}{{ expense.amount }}'
+        '{{ expense.category.name }}{{ expense.date }}{% endfor %}'
+        '{% for category in categories %}{{ category.name }}{% endfor %}'
+    ),
+    'expenses/category_list.html': (
+        '{% for category in categories %}{{ category.name }}{{ category.expense_count }}'
+        '{{ category.total_amount }}{% endfor %}'
+    ),
+    'expenses/group_list.html': (
+        '{% for group in user_groups %}{{ group.name }}{{ group.get_member_count }}'
+        '{{ group.get_total_expenses }}{{ group.user_net }}{% endfor %}'
+        '{% for group in created_groups %}{{ group.name }}{{ group.get_member_count }}{% endfor %}'
+    ),
+    'expenses/group_detail.html': (
+        '{{ group.name }}{% for name, net in balances.items %}{{ name }}{{ net }}{% endfor %}'
+        '{% for expense in shared_expenses %}{{ expense.title }}{{ expense.amount }}'
+        '{{ expense.paid_by.username }}{{ expense.category.name }}{{ expense.user_share }}{% endfor %}'
+    ),
+    'expenses/shared_expense_form.html': '{{ group.name }}{{ form }}',
+}
+
+
+def setup_django():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'expense_tracker.settings')
+    import django
+    django.setup()
+
+
+def with_stub_templates(templates):
+    """
+    A copy of the ``templates`` setting that falls back to STUB_TEMPLATES
+    for any template the project's own loaders can't find.
+    """
+    options = dict(templates[0].get('OPTIONS', {}))
+    options['loaders'] = [
+        'django.template.loaders.filesystem.Loader',
+        'django.template.loaders.app_directories.Loader',
+        ('django.template.loaders.locmem.Loader', STUB_TEMPLATES),
+    ]
+    return [{**templates[0], 'APP_DIRS': False, 'OPTIONS': options}]
+
+
+def stub_templates_if_missing():
+    """
+    Return an override_settings that serves STUB_TEMPLATES, or None when the
+    project's own templates are available.
+    """
+    from django.conf import settings
+    from django.template import TemplateDoesNotExist
+    from django.template.loader import get_template
+    from django.test import override_settings
+
+    try:
+        for name in STUB_TEMPLATES:
+            get_template(name)
+    except TemplateDoesNotExist:
+        return override_settings(TEMPLATES=with_stub_templates(settings.TEMPLATES))
+    return None
+
+
+@contextmanager
+def scratch_database():
+    """
+    Create a migrated throwaway database for the duration of the block.
+
+    SQLite gets a file in a temporary directory so timings include real
+    disk I/O; other backends get their usual test database.
+    """
+    from django.db import connection
+
+    with tempfile.TemporaryDirectory() as scratch:
+        if connection.vendor == 'sqlite':
+            connection.settings_dict['TEST']['NAME'] = os.path.join(scratch, 'bench.sqlite3')
+        connection.creation.create_test_db(verbosity=0)
+        try:
+            yield connection
+        finally:
+            connection.creation.destroy_test_db(connection.settings_dict['NAME'], verbosity=0)
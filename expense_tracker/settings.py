@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/4.2/ref/settings/
 
 from pathlib import Path
 import os
+import tempfile
 import dj_database_url
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -54,6 +55,11 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # Outermost so they see the whole stack; inert unless EXPENSES_METRICS,
+    # EXPENSES_PROFILING or EXPENSES_SLOW_QUERY_MS is set
+    'expenses.middleware.MetricsMiddleware',
+    'expenses.middleware.ProfilingMiddleware',
+    'expenses.middleware.SlowQueryMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -62,13 +68,16 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    # Inert unless a read replica is configured
+    'expenses.middleware.PrimaryPinMiddleware',
 ]
 
 ROOT_URLCONF = 'expense_tracker.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # Django's backend, with rendering timed by ProfilingMiddleware
+        'BACKEND': 'expenses.profiling.DjangoTemplates',
         'DIRS': [BASE_DIR / 'templates'],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -109,6 +118,28 @@ else:
         }
     }
 
+# Optional read replica for analytics reads (see expenses/routers.py). Tests
+# run against the primary alone, with the replica alias mirroring it.
+REPLICA_DATABASE_URL = os.environ.get('REPLICA_DATABASE_URL')
+
+if REPLICA_DATABASE_URL and REPLICA_DATABASE_URL.strip():
+    DATABASES['replica'] = dj_database_url.parse(
+        REPLICA_DATABASE_URL,
+        conn_max_age=600,
+        conn_health_checks=True,
+    )
+    DATABASES['replica']['TEST'] = {'MIRROR': 'default'}
+
+# Optional sharding of per-user data (see expenses/sharding.py): a comma
+# separated list of database URLs, one per shard, named shard0, shard1, ...
+# Users, groups and everything else stay on the default database.
+EXPENSES_SHARDS = []
+for index, url in enumerate(filter(None, map(str.strip, os.environ.get('SHARD_DATABASE_URLS', '').split(',')))):
+    DATABASES[f'shard{index}'] = dj_database_url.parse(url, conn_max_age=600, conn_health_checks=True)
+    EXPENSES_SHARDS.append(f'shard{index}')
+
+DATABASE_ROUTERS = ['expenses.routers.ShardRouter', 'expenses.routers.ReplicaRouter']
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -161,6 +192,87 @@ LOGIN_URL = '/login/'
 LOGIN_REDIRECT_URL = '/'
 LOGOUT_REDIRECT_URL = '/login/'
 
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+
+# Local memory by default; set CACHE_DIR to share the cache between worker
+# processes through the filesystem.
+CACHE_DIR = os.environ.get('CACHE_DIR')
+
+if CACHE_DIR:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': CACHE_DIR,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+# Dashboard aggregates are cached per user and invalidated by a data
+# version bump on every expense/category change, so the timeout only
+# bounds how long unused entries linger.
+EXPENSES_CACHE_ALIAS = 'default'
+EXPENSES_DASHBOARD_CACHE_TIMEOUT = 60 * 60
+
+# After a user changes their data, their reads skip the read replica for
+# this many seconds; keep it above the replica's usual lag.
+EXPENSES_REPLICA_PIN_SECONDS = int(os.environ.get('EXPENSES_REPLICA_PIN_SECONDS', '10'))
+
+# How long each process trusts its cached user-to-shard placements, and so
+# how long reads may miss a user's rows after rebalance_shards moves them.
+EXPENSES_SHARD_MAP_TTL = float(os.environ.get('EXPENSES_SHARD_MAP_TTL', '5'))
+# Sharded primary keys are reserved from the global shard this many at a time
+EXPENSES_SHARD_ID_BLOCK = 1000
+
+# Expense and shared-expense lists are paginated by cursor; clients may ask
+# for a different page size with ?page_size= up to the maximum.
+EXPENSES_PAGE_SIZE = int(os.environ.get('EXPENSES_PAGE_SIZE', '25'))
+EXPENSES_MAX_PAGE_SIZE = 100
+
+# CSV exports are streamed; this many rows are fetched and sent at a time.
+EXPENSES_EXPORT_CHUNK_SIZE = 2000
+
+# Bulk deletes remove this many expenses per transaction.
+EXPENSES_DELETE_BATCH_SIZE = 1000
+
+# CSV imports insert this many expenses per transaction.
+EXPENSES_IMPORT_BATCH_SIZE = 5000
+
+# Per-request profiling (Server-Timing header and "expenses.profiling" log
+# lines). Off by default; when on, only a sample of requests is profiled
+# and only those at least this slow are logged.
+EXPENSES_PROFILING = os.environ.get('EXPENSES_PROFILING', 'False') == 'True'
+EXPENSES_PROFILING_SAMPLE_RATE = float(os.environ.get('EXPENSES_PROFILING_SAMPLE_RATE', '1.0'))
+EXPENSES_PROFILING_LOG_THRESHOLD_MS = float(os.environ.get('EXPENSES_PROFILING_LOG_THRESHOLD_MS', '500'))
+
+# Queries slower than this many milliseconds are captured with their plans
+# for the staff-only slow query page; unset disables capture. Each process
+# keeps the most recent EXPENSES_SLOW_QUERY_BUFFER of them. Query parameters
+# can hold session keys and password hashes, so they are only kept with
+# EXPENSES_SLOW_QUERY_PARAMS.
+EXPENSES_SLOW_QUERY_MS = (
+    float(os.environ['EXPENSES_SLOW_QUERY_MS']) if os.environ.get('EXPENSES_SLOW_QUERY_MS') else None
+)
+EXPENSES_SLOW_QUERY_BUFFER = 200
+EXPENSES_SLOW_QUERY_PARAMS = os.environ.get('EXPENSES_SLOW_QUERY_PARAMS', 'False') == 'True'
+
+# Per-view request metrics served at /metrics in the Prometheus text format.
+# Every worker process writes its figures to its own file in
+# EXPENSES_METRICS_DIR (at most every EXPENSES_METRICS_FLUSH_SECONDS) and a
+# scrape adds them all up. If EXPENSES_METRICS_TOKEN is set, scrapers must
+# send it as "Authorization: Bearer <token>".
+EXPENSES_METRICS = os.environ.get('EXPENSES_METRICS', 'False') == 'True'
+EXPENSES_METRICS_DIR = os.environ.get(
+    'EXPENSES_METRICS_DIR', os.path.join(tempfile.gettempdir(), 'expenses-metrics')
+)
+EXPENSES_METRICS_FLUSH_SECONDS = 1.0
+EXPENSES_METRICS_TOKEN = os.environ.get('EXPENSES_METRICS_TOKEN')
+
 # Logging configuration for production debugging
 LOGGING = {
     'version': 1,
@@ -180,6 +292,11 @@ LOGGING = {
             'level': 'INFO',
             'propagate': False,
         },
+        'expenses.profiling': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
     },
 }
 
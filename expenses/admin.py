@@ -1,93 +1,246 @@
 from django.contrib import admin
 from django.contrib.auth.models import User
-from django.db.models import Sum, Count
+from django.core.exceptions import ValidationError
+from django.db.models import DecimalField, OuterRef, Subquery, Sum, Count, Value
+from django.db.models.functions import Coalesce
+from django.utils.decorators import method_decorator
+from decimal import Decimal
+from . import deletion, exports, rollups, routers, sharding
+from .admin_filters import AutocompleteFilter, DateRangeFilter, ShardFilter
 from .models import Category, Expense, Group, GroupMember, SharedExpense, ExpenseSplit
 
 
+class ShardedModelAdmin(admin.ModelAdmin):
+    """
+    Admin for the per-user models, which reads and writes their owners' shards.
+
+    Without sharding this is a plain ModelAdmin. With it, the changelist
+    shows the shard picked by ``ShardFilter``, objects are looked up on
+    every shard, and changes are written under ``sharding.atomic``. Users
+    live on the global shard, so they are prefetched rather than joined,
+    can't be searched by name, and can't be reassigned; new rows are added
+    through the site, which places them on their owner's shard.
+    """
+
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request)
+        if sharding.enabled():
+            queryset = queryset.using(ShardFilter.get_shard(request)).prefetch_related('user')
+        return queryset
+
+    def get_object(self, request, object_id, from_field=None):
+        if not sharding.enabled():
+            return super().get_object(request, object_id, from_field)
+        queryset = self.get_queryset(request)
+        field = self.model._meta.pk if from_field is None else self.model._meta.get_field(from_field)
+        try:
+            object_id = field.to_python(object_id)
+        except (ValidationError, ValueError):
+            return None
+        for alias in sharding.databases():
+            obj = queryset.using(alias).filter(**{field.name: object_id}).first()
+            if obj is not None:
+                return obj
+        return None
+
+    def get_list_filter(self, request):
+        list_filter = super().get_list_filter(request)
+        if sharding.enabled():
+            list_filter = [ShardFilter, *list_filter]
+        return list_filter
+
+    def get_list_select_related(self, request):
+        list_select_related = super().get_list_select_related(request)
+        if sharding.enabled():
+            list_select_related = [name for name in list_select_related if name != 'user']
+        return list_select_related
+
+    def get_search_fields(self, request):
+        search_fields = super().get_search_fields(request)
+        if sharding.enabled():
+            search_fields = [name for name in search_fields if not name.startswith('user__')]
+        return search_fields
+
+    def get_readonly_fields(self, request, obj=None):
+        readonly_fields = super().get_readonly_fields(request, obj)
+        if sharding.enabled():
+            readonly_fields = [*readonly_fields, 'user']
+        return readonly_fields
+
+    def has_add_permission(self, request):
+        return not sharding.enabled() and super().has_add_permission(request)
+
+    def save_model(self, request, obj, form, change):
+        with sharding.atomic(obj.user_id):
+            super().save_model(request, obj, form, change)
+
+    def delete_model(self, request, obj):
+        with sharding.atomic(obj.user_id):
+            super().delete_model(request, obj)
+
+
 @admin.register(Category)
-class CategoryAdmin(admin.ModelAdmin):
+class CategoryAdmin(ShardedModelAdmin):
     list_display = ['name', 'user', 'description', 'expense_count', 'created_at']
-    list_filter = ['user', 'created_at']
+    list_filter = [('user', AutocompleteFilter), 'created_at']
     search_fields = ['name', 'user__username']
     ordering = ['user', 'name']
+    list_select_related = ['user']
+    
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request)
+        return queryset.annotate(_expense_count=Count('expenses'))
     
     def expense_count(self, obj):
-        return obj.expenses.count()
+        return obj._expense_count
     expense_count.short_description = 'Number of Expenses'
+    expense_count.admin_order_field = '_expense_count'
 
 
 @admin.register(Expense)
-class ExpenseAdmin(admin.ModelAdmin):
+class ExpenseAdmin(ShardedModelAdmin):
     list_display = ['title', 'amount', 'user', 'category', 'date', 'created_at']
-    list_filter = ['user', 'category', 'date', 'created_at']
+    list_filter = [('user', AutocompleteFilter), ('category', AutocompleteFilter), 'date', 'created_at']
     search_fields = ['title', 'description', 'user__username', 'category__name']
     date_hierarchy = 'date'
     ordering = ['-date', '-created_at']
-    actions = ['export_user_expenses', 'delete_selected_expenses']
+    actions = ['export_user_expenses', 'export_user_expenses_gzip', 'delete_selected_expenses']
     
     # Group expenses by user in the changelist
     list_select_related = ['user', 'category']
     
     def get_queryset(self, request):
         queryset = super().get_queryset(request)
-        return queryset.select_related('user', 'category')
+        return queryset.select_related(*self.get_list_select_related(request))
+    
+    def get_form(self, request, obj=None, **kwargs):
+        form = super().get_form(request, obj, **kwargs)
+        if sharding.enabled() and obj is not None and 'category' in form.base_fields:
+            # The owner's categories, from the shard the expense is on
+            form.base_fields['category'].queryset = Category.objects.using(obj._state.db).filter(
+                user_id=obj.user_id,
+            )
+        return form
     
     def export_user_expenses(self, request, queryset):
         """Export selected expenses as CSV"""
-        import csv
-        from django.http import HttpResponse
-        
-        response = HttpResponse(content_type='text/csv')
-        response['Content-Disposition'] = 'attachment; filename="expenses.csv"'
-        
-        writer = csv.writer(response)
-        writer.writerow(['User', 'Title', 'Amount', 'Category', 'Date', 'Description'])
-        
-        for expense in queryset:
-            writer.writerow([
-                expense.user.username,
-                expense.title,
-                expense.amount,
-                expense.category.name,
-                expense.date,
-                expense.description
-            ])
-        
-        return response
+        # Primary key order streams without sorting the whole selection
+        return exports.export_response(queryset.order_by('pk'))
     export_user_expenses.short_description = "Export selected expenses as CSV"
     
+    def export_user_expenses_gzip(self, request, queryset):
+        """Export selected expenses as gzipped CSV"""
+        return exports.export_response(queryset.order_by('pk'), compress=True)
+    export_user_expenses_gzip.short_description = "Export selected expenses as gzipped CSV"
+    
+    def get_actions(self, request):
+        actions = super().get_actions(request)
+        # The built-in action lists every selected object before deleting
+        actions.pop('delete_selected', None)
+        return actions
+    
     def delete_selected_expenses(self, request, queryset):
-        """Delete selected expenses with confirmation"""
-        count = queryset.count()
-        queryset.delete()
+        """Delete selected expenses in batches"""
+        count = deletion.delete_expenses(queryset)
         self.message_user(request, f'Successfully deleted {count} expenses.')
     delete_selected_expenses.short_description = "Delete selected expenses"
 
 
 # Add a custom admin view to show user expense summaries
 class UserExpenseSummaryAdmin(admin.ModelAdmin):
-    """Custom admin to show expense summaries by user"""
-    change_list_template = 'admin/user_expense_summary.html'
+    """Expense summaries by user, one page of users at a time"""
+    list_display = ['username', 'total_amount', 'total_count', 'categories_count']
+    list_filter = [DateRangeFilter]
+    search_fields = ['username', 'email']
+    ordering = ['username']
+    list_display_links = None
+    list_per_page = 50
+    # Counting every user twice per page view is what made this page slow
+    show_full_result_count = False
     
-    def changelist_view(self, request, extra_context=None):
-        # Get summary data for each user
-        user_summaries = []
-        for user in User.objects.all():
-            total_expenses = Expense.objects.filter(user=user).aggregate(
-                total_amount=Sum('amount'),
-                total_count=Count('id')
-            )
-            user_summaries.append({
-                'user': user,
-                'total_amount': total_expenses['total_amount'] or 0,
-                'total_count': total_expenses['total_count'] or 0,
-                'categories_count': Category.objects.filter(user=user).count()
-            })
-        
-        extra_context = extra_context or {}
-        extra_context['user_summaries'] = user_summaries
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request)
+        if sharding.enabled():
+            # The real values are filled in per page by add_shard_totals();
+            # these only keep old ?o= links to the columns working
+            return queryset.annotate(_total_amount=Value(0), _total_count=Value(0), _categories_count=Value(0))
+        start, end = DateRangeFilter.get_range(request)
         
+        # Totals come from the spending rollups: the monthly table for all
+        # time, the daily one for a date range
+        spending = rollups.spending_queryset(OuterRef('pk'), start, end).order_by().values('user')
+        money = DecimalField(max_digits=14, decimal_places=2)
+        return queryset.annotate(
+            _total_amount=Coalesce(
+                Subquery(spending.annotate(total_amount=Sum('total')).values('total_amount')),
+                Value(0),
+                output_field=money,
+            ),
+            _total_count=Coalesce(
+                Subquery(spending.annotate(total_count=Sum('count')).values('total_count')),
+                Value(0),
+            ),
+            _categories_count=Coalesce(
+                Subquery(Category.objects.filter(user=OuterRef('pk')).order_by().values('user')
+                         .annotate(n=Count('pk')).values('n')),
+                Value(0),
+            ),
+        )
+    
+    def get_changelist_instance(self, request):
+        changelist = super().get_changelist_instance(request)
+        if sharding.enabled():
+            changelist.result_list = list(changelist.result_list)
+            self.add_shard_totals(request, changelist.result_list)
+        return changelist
+    
+    def add_shard_totals(self, request, users):
+        """Give ``users`` the annotations get_queryset() can't make across shards."""
+        start, end = DateRangeFilter.get_range(request)
+        totals, categories = {}, {}
+        for user_ids in sharding.group_by_database([user.pk for user in users]).values():
+            spending = rollups.users_spending(user_ids, start, end).order_by().values('user')
+            totals.update(
+                (row['user'], (row['total_amount'], row['total_count']))
+                for row in spending.annotate(total_amount=Sum('total'), total_count=Sum('count'))
+            )
+            categories.update(Category.objects.filter(user_id__in=user_ids).order_by().values('user')
+                              .annotate(n=Count('pk')).values_list('user', 'n'))
+        for user in users:
+            user._total_amount, user._total_count = totals.get(user.pk, (Decimal('0'), 0))
+            user._categories_count = categories.get(user.pk, 0)
+    
+    def get_sortable_by(self, request):
+        if sharding.enabled():
+            # The totals are read from the shards a page at a time, so can't order the list
+            return ['username']
+        return super().get_sortable_by(request)
+    
+    @method_decorator(routers.replica_reads)
+    def changelist_view(self, request, extra_context=None):
+        # Read-only and scans every user's rollups, so it can run on the replica
         return super().changelist_view(request, extra_context)
+    
+    def total_amount(self, obj):
+        return f'${obj._total_amount:.2f}'
+    total_amount.short_description = 'Total Amount'
+    total_amount.admin_order_field = '_total_amount'
+    
+    def total_count(self, obj):
+        return obj._total_count
+    total_count.short_description = 'Expenses'
+    total_count.admin_order_field = '_total_count'
+    
+    def categories_count(self, obj):
+        return obj._categories_count
+    categories_count.short_description = 'Categories'
+    categories_count.admin_order_field = '_categories_count'
+    
+    def has_add_permission(self, request):
+        return False
+    
+    def has_delete_permission(self, request, obj=None):
+        return False
 
 
 # Register a proxy model for the summary view
@@ -103,18 +256,30 @@ admin.site.register(UserExpenseSummary, UserExpenseSummaryAdmin)
 @admin.register(Group)
 class GroupAdmin(admin.ModelAdmin):
     list_display = ['name', 'created_by', 'member_count', 'total_expenses', 'created_at']
-    list_filter = ['created_by', 'created_at']
+    list_filter = [('created_by', AutocompleteFilter), 'created_at']
     search_fields = ['name', 'created_by__username']
     ordering = ['-created_at']
+    list_select_related = ['created_by']
+    
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request)
+        # A subquery rather than a join, so members don't multiply the sum
+        return queryset.annotate(_total_expenses=Coalesce(
+            Subquery(SharedExpense.objects.filter(group=OuterRef('pk')).order_by().values('group')
+                     .annotate(total=Sum('amount')).values('total')),
+            Value(0),
+            output_field=DecimalField(max_digits=14, decimal_places=2),
+        ))
     
     def member_count(self, obj):
-        return obj.members.count()
+        return obj.member_count
     member_count.short_description = 'Members'
+    member_count.admin_order_field = 'member_count'
     
     def total_expenses(self, obj):
-        total = obj.shared_expenses.aggregate(total=Sum('amount'))['total'] or 0
-        return f'${total:.2f}'
+        return f'${obj._total_expenses:.2f}'
     total_expenses.short_description = 'Total Expenses'
+    total_expenses.admin_order_field = '_total_expenses'
 
 
 @admin.register(GroupMember)
@@ -128,7 +293,7 @@ class GroupMemberAdmin(admin.ModelAdmin):
 @admin.register(SharedExpense)
 class SharedExpenseAdmin(admin.ModelAdmin):
     list_display = ['title', 'amount', 'group', 'paid_by', 'split_type', 'date', 'created_at']
-    list_filter = ['group', 'paid_by', 'split_type', 'date', 'created_at']
+    list_filter = [('group', AutocompleteFilter), ('paid_by', AutocompleteFilter), 'split_type', 'date', 'created_at']
     search_fields = ['title', 'description', 'group__name', 'paid_by__username']
     date_hierarchy = 'date'
     ordering = ['-date', '-created_at']
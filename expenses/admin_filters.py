@@ -0,0 +1,166 @@
+"""
+Changelist filters that stay cheap however many rows the related table has.
+"""
+from datetime import date
+
+from django import forms
+from django.contrib import admin
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.widgets import AutocompleteSelect
+
+from . import sharding
+
+
+class AutocompleteFilter(admin.RelatedFieldListFilter):
+    """
+    Filter on a foreign key with an autocomplete box instead of a link per object.
+
+    Only the currently selected object is loaded; everything else is searched
+    through the admin's autocomplete view, so the related model's admin must
+    define ``search_fields``.
+    """
+    template = 'admin/expenses/autocomplete_filter.html'
+
+    def __init__(self, field, request, params, model, model_admin, field_path):
+        super().__init__(field, request, params, model, model_admin, field_path)
+        form_field = forms.ModelChoiceField(
+            queryset=field.remote_field.model._default_manager.all(),
+            widget=AutocompleteSelect(field, model_admin.admin_site, attrs={
+                'onchange': 'this.form.submit()',
+                'data-placeholder': f'Filter by {self.title}',
+            }),
+            required=False,
+        )
+        selected = self.lookup_val[-1] if self.lookup_val else None
+        self.widget = form_field.widget.render(self.lookup_kwarg, selected)
+        self.media = form_field.widget.media
+        # Carry the rest of the changelist's query string through the form
+        self.hidden_params = [
+            (key, value) for key, values in request.GET.lists()
+            if key not in (self.lookup_kwarg, self.lookup_kwarg_isnull, 'p')
+            for value in values
+        ]
+
+    def field_choices(self, field, request, model_admin):
+        if not self.lookup_val:
+            return []
+        return [
+            (obj.pk, str(obj))
+            for obj in field.remote_field.model._default_manager.filter(pk__in=self.lookup_val)
+        ]
+
+    def has_output(self):
+        return True
+
+
+class DateRangeFilter(admin.ListFilter):
+    """
+    ``?start=YYYY-MM-DD&end=YYYY-MM-DD`` for changelists whose columns depend on a range.
+
+    The filter only validates and displays the range; the model admin reads
+    it back with ``get_range`` to shape its annotations.
+    """
+    title = 'date range'
+    parameters = ('start', 'end')
+    template = 'admin/expenses/date_range_filter.html'
+
+    def __init__(self, request, params, model, model_admin):
+        super().__init__(request, params, model, model_admin)
+        self.values = {}
+        for name in self.parameters:
+            value = params.pop(name, None)
+            if value:
+                self.values[name] = value[-1]
+        self.hidden_params = [
+            (key, value) for key, values in request.GET.lists()
+            if key not in self.parameters and key != 'p'
+            for value in values
+        ]
+
+    @classmethod
+    def get_range(cls, request):
+        """Return ``(start, end)`` from the request, or ``(None, None)`` if invalid."""
+        try:
+            return cls.parse(request.GET.get('start'), request.GET.get('end'))
+        except ValueError:
+            return None, None
+
+    @staticmethod
+    def parse(start, end):
+        start = date.fromisoformat(start) if start else None
+        end = date.fromisoformat(end) if end else None
+        if start and end and start > end:
+            raise ValueError('start must not be after end')
+        return start, end
+
+    def has_output(self):
+        return True
+
+    def expected_parameters(self):
+        return list(self.parameters)
+
+    def queryset(self, request, queryset):
+        try:
+            self.parse(self.values.get('start'), self.values.get('end'))
+        except ValueError as e:
+            raise IncorrectLookupParameters(e)
+        return queryset
+
+    def choices(self, changelist):
+        yield {
+            'selected': not self.values,
+            'query_string': changelist.get_query_string(remove=self.parameters),
+            'display': 'All time',
+        }
+
+
+class ShardFilter(admin.SimpleListFilter):
+    """
+    ``?shard=<alias>`` for changelists of per-user rows once sharding is on.
+
+    A changelist runs its queries on one database, so it shows one shard at
+    a time: the one picked here, else the shard of the user picked in the
+    ``user`` filter, else the first. The model admin reads it back with
+    ``get_shard`` to route its queryset.
+    """
+    title = 'shard'
+    parameter_name = 'shard'
+    user_parameter = 'user__id__exact'
+
+    def __init__(self, request, params, model, model_admin):
+        super().__init__(request, params, model, model_admin)
+        self.shard = self.get_shard(request)
+
+    @classmethod
+    def get_shard(cls, request):
+        shards = sharding.databases()
+        shard = request.GET.get(cls.parameter_name)
+        if shard in shards:
+            return shard
+        user_id = request.GET.get(cls.user_parameter, '')
+        if user_id.isdigit():
+            return sharding.db_for_user(int(user_id))
+        return shards[0]
+
+    def lookups(self, request, model_admin):
+        return [(alias, alias) for alias in sharding.databases()]
+
+    def value(self):
+        return self.shard
+
+    def queryset(self, request, queryset):
+        # Already routed by the model admin's get_queryset()
+        return queryset
+
+    def get_facet_counts(self, pk_attname, filtered_qs):
+        # Counting the other shards would need a query on each of them
+        return {}
+
+    def choices(self, changelist):
+        # No "All": one query can't read every shard
+        for lookup, title in self.lookup_choices:
+            yield {
+                'selected': self.shard == lookup,
+                'query_string': changelist.get_query_string({self.parameter_name: lookup}),
+                'display': title,
+            }
@@ -0,0 +1,158 @@
+"""
+SQL aggregation for spending summaries.
+
+``summarize`` turns any Expense, SharedExpense or rollup queryset into the
+total, per-category breakdown and time-bucketed trend in at most two
+queries, grouping in the database with ``TruncDay``/``TruncMonth`` and
+reading plain ``values()`` rows rather than model instances.
+"""
+from collections import namedtuple
+from datetime import timedelta
+from decimal import Decimal
+
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncDay, TruncMonth
+
+from .models import Expense, SharedExpense, DailySpending, MonthlySpending
+
+
+TRUNCATE = {
+    'day': TruncDay,
+    'month': TruncMonth,
+}
+
+# (amount field, pre-aggregated count field or None, date field) per model
+FIELDS = {
+    Expense: ('amount', None, 'date'),
+    SharedExpense: ('amount', None, 'date'),
+    DailySpending: ('total', 'count', 'date'),
+    MonthlySpending: ('total', 'count', 'month'),
+}
+
+# Longest custom range, in days, that is still charted day by day
+CUSTOM_DAILY_SPAN = 92
+
+Period = namedtuple('Period', 'key label start end granularity label_format')
+
+
+def resolve_period(period, today):
+    """
+    Map a dashboard ``period`` parameter onto a date range.
+
+    Unknown values fall back to all time, matching the dashboard's filter.
+    """
+    if period == 'daily':
+        return Period('daily', 'Today', today, today, None, None)
+    if period == 'weekly':
+        start = today - timedelta(days=today.weekday())  # Monday
+        return Period('weekly', 'This Week', start, None, 'day', '%a')
+    if period == 'monthly':
+        return Period('monthly', 'This Month', today.replace(day=1), None, 'day', '%b %d')
+    return Period('all', 'All Time', None, None, 'month', '%b %Y')
+
+
+def custom_period(start, end, today):
+    """
+    Period for an arbitrary ``start``/``end`` range (either may be None).
+
+    Ranges of up to about three months are charted by day; longer ones, and
+    ranges without a start, by month.
+    """
+    if start is not None and end is not None and start > end:
+        raise ValueError('start must not be after end')
+    if start is None:
+        granularity = 'month'
+    else:
+        span = ((end or today) - start).days
+        granularity = 'day' if span <= CUSTOM_DAILY_SPAN else 'month'
+    label_format = '%b %d' if granularity == 'day' else '%b %Y'
+    label = ' - '.join(
+        bound.strftime('%b %d, %Y') if bound else '...' for bound in (start, end)
+    )
+    return Period('custom', label, start, end, granularity, label_format)
+
+
+def filter_dates(queryset, start=None, end=None):
+    """Restrict a queryset to ``start <= date <= end`` on its model's date field."""
+    date_field = FIELDS[queryset.model][2]
+    if start is not None:
+        queryset = queryset.filter(**{f'{date_field}__gte': start})
+    if end is not None:
+        queryset = queryset.filter(**{f'{date_field}__lte': end})
+    return queryset
+
+
+def _count(queryset):
+    count_field = FIELDS[queryset.model][1]
+    return Sum(count_field) if count_field else Count('pk')
+
+
+def _breakdown(queryset, category):
+    return queryset.values(category).annotate(
+        total=Sum(FIELDS[queryset.model][0]), count=_count(queryset),
+    ).order_by('-total', category)
+
+
+def category_breakdown(queryset, category='category__name'):
+    """Per-category ``total`` and ``count``, largest first."""
+    return list(_breakdown(queryset, category))
+
+
+def trend(queryset, granularity):
+    """``[(bucket_date, amount), ...]`` in date order, one entry per non-empty bucket."""
+    amount_field, _, date_field = FIELDS[queryset.model]
+    rows = queryset.annotate(
+        bucket=TRUNCATE[granularity](date_field)
+    ).values('bucket').annotate(amount=Sum(amount_field)).order_by('bucket')
+    return [(row['bucket'], row['amount']) for row in rows]
+
+
+def summarize(queryset, granularity=None, category='category__name'):
+    """
+    Total, category breakdown and trend for ``queryset``.
+
+    The total and count are derived from the category rows, so this costs
+    one query, plus one more when a trend ``granularity`` is requested.
+    """
+    by_category = category_breakdown(queryset, category)
+    return {
+        'total': sum((row['total'] for row in by_category), Decimal('0')),
+        'count': sum(row['count'] for row in by_category),
+        'by_category': by_category,
+        'trend': trend(queryset, granularity) if granularity else [],
+    }
+
+
+async def asummarize(queryset, category='category__name'):
+    """
+    ``summarize()`` without a trend, for async views.
+
+    The total and count come from ``aaggregate()`` and the category rows
+    from an async iteration, so neither blocks the event loop.
+    """
+    totals = await queryset.aaggregate(total=Sum(FIELDS[queryset.model][0]), count=_count(queryset))
+    return {
+        'total': totals['total'] or Decimal('0'),
+        'count': totals['count'] or 0,
+        'by_category': [row async for row in _breakdown(queryset, category)],
+        'trend': [],
+    }
+
+
+def chart_series(summary, period, category='category__name'):
+    """
+    Chart-ready ``(category_labels, category_data, trend_labels, trend_amounts)``.
+
+    A single-day period charts one "Today" point instead of a trend.
+    """
+    if period.granularity is None:
+        points = [(period.label, summary['total'])]
+    else:
+        points = [(bucket.strftime(period.label_format), amount)
+                  for bucket, amount in summary['trend']]
+    return (
+        [row[category] for row in summary['by_category']],
+        [float(row['total']) for row in summary['by_category']],
+        [label for label, _ in points],
+        [float(amount) for _, amount in points],
+    )
@@ -0,0 +1,161 @@
+"""
+Ledger of each member's net position in a group.
+
+A split owed by someone other than the payer moves its amount from the
+debtor's balance to the payer's until it is settled. GroupBalance stores
+the running result, so group pages can read every member's position in
+one query instead of aggregating splits per member.
+"""
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import F, Q, Sum
+from django.utils import timezone
+
+from .models import ExpenseSplit, GroupBalance
+
+
+CENT = Decimal('0.01')
+
+
+def split_deltas(group_id, payer_id, user_id, amount, is_settled, sign=1):
+    """
+    Ledger changes contributed by one split, as ``{(group_id, user_id): delta}``.
+
+    Settled splits and the payer's own share contribute nothing. Pass
+    ``sign=-1`` to get the changes that remove the split again. Amounts are
+    rounded to cents the same way the database stores them.
+    """
+    if is_settled or user_id == payer_id:
+        return {}
+    amount = Decimal(amount).quantize(CENT) * sign
+    return {(group_id, payer_id): amount, (group_id, user_id): -amount}
+
+
+def merge(*deltas):
+    """Sum several delta mappings into one."""
+    total = defaultdict(Decimal)
+    for delta in deltas:
+        for key, amount in delta.items():
+            total[key] += amount
+    return total
+
+
+def apply_deltas(deltas, create=True):
+    """
+    Add ``{(group_id, user_id): amount}`` to the ledger.
+
+    Runs a fixed number of queries however many members are touched.
+    Missing rows are created unless ``create`` is False. Deletions pass
+    False, because a cascading group delete may already have removed the
+    ledger rows.
+    """
+    deltas = {key: amount for key, amount in deltas.items() if amount}
+    if not deltas:
+        return
+    group_ids = {group_id for group_id, _ in deltas}
+    user_ids = {user_id for _, user_id in deltas}
+
+    with transaction.atomic():
+        if create:
+            GroupBalance.objects.bulk_create(
+                [GroupBalance(group_id=g, user_id=u) for g, u in deltas],
+                ignore_conflicts=True,
+            )
+        rows = [
+            row for row in GroupBalance.objects.select_for_update().filter(
+                group_id__in=group_ids, user_id__in=user_ids
+            )
+            if (row.group_id, row.user_id) in deltas
+        ]
+        for row in rows:
+            row.net += deltas[(row.group_id, row.user_id)]
+        GroupBalance.objects.bulk_update(rows, ['net'], batch_size=500)
+
+
+def expected_balances(group_ids):
+    """Recompute ``{(group_id, user_id): net}`` for ``group_ids`` from the raw splits."""
+    open_splits = ExpenseSplit.objects.filter(
+        expense__group_id__in=group_ids, is_settled=False
+    ).exclude(user=F('expense__paid_by'))
+
+    balances = defaultdict(Decimal)
+    for row in open_splits.values('expense__group_id', 'expense__paid_by_id').annotate(
+        total=Sum('amount')
+    ).order_by():
+        balances[(row['expense__group_id'], row['expense__paid_by_id'])] += row['total']
+    for row in open_splits.values('expense__group_id', 'user_id').annotate(
+        total=Sum('amount')
+    ).order_by():
+        balances[(row['expense__group_id'], row['user_id'])] -= row['total']
+    return balances
+
+
+def find_mismatches(group_ids):
+    """Return ``[(group_id, user_id, expected, recorded), ...]`` for ledger rows that disagree."""
+    expected = expected_balances(group_ids)
+    recorded = {
+        (row.group_id, row.user_id): row.net
+        for row in GroupBalance.objects.filter(group_id__in=group_ids)
+    }
+    mismatches = []
+    for key in sorted(expected.keys() | recorded.keys()):
+        want, have = expected.get(key, Decimal('0')), recorded.get(key, Decimal('0'))
+        if want != have:
+            mismatches.append((*key, want, have))
+    return mismatches
+
+
+def rebuild(group_ids):
+    """Rewrite the ledger for ``group_ids`` from the raw splits."""
+    expected = expected_balances(group_ids)
+    with transaction.atomic():
+        GroupBalance.objects.filter(group_id__in=group_ids).delete()
+        GroupBalance.objects.bulk_create([
+            GroupBalance(group_id=group_id, user_id=user_id, net=net)
+            for (group_id, user_id), net in expected.items()
+            if net
+        ], batch_size=1000)
+
+
+def settle_between(group_id, user_id, other_id):
+    """
+    Settle every open split between two members of a group, in both directions.
+
+    Returns ``(count, amount)``. ``amount`` is the net sum ``user_id`` paid
+    ``other_id`` to clear the splits, and is negative if money flowed the
+    other way. The splits are flipped by a single conditional UPDATE on
+    ``is_settled=False``, so a concurrent double submit settles each split
+    exactly once without row locks; the loser simply settles nothing.
+    """
+    between = (Q(user_id=user_id, expense__paid_by_id=other_id)
+               | Q(user_id=other_id, expense__paid_by_id=user_id))
+    candidates = list(ExpenseSplit.objects.filter(
+        between, expense__group_id=group_id, is_settled=False
+    ).values_list('pk', flat=True))
+    if not candidates:
+        return 0, Decimal('0')
+
+    settled_at = timezone.now()
+    with transaction.atomic():
+        # Only local columns in the WHERE clause, so the database re-checks
+        # is_settled on each row it updates.
+        count = ExpenseSplit.objects.filter(pk__in=candidates, is_settled=False).update(
+            is_settled=True, settled_at=settled_at
+        )
+        if not count:
+            return 0, Decimal('0')
+        # The timestamp tells this request's rows apart from any settled
+        # concurrently by someone else.
+        settled = ExpenseSplit.objects.filter(
+            pk__in=candidates, settled_at=settled_at
+        ).values('user_id', 'expense__paid_by_id').annotate(total=Sum('amount')).order_by()
+
+        deltas, amount = [], Decimal('0')
+        for row in settled:
+            deltas.append(split_deltas(group_id, row['expense__paid_by_id'], row['user_id'],
+                                       row['total'], False, sign=-1))
+            amount += row['total'] if row['user_id'] == user_id else -row['total']
+        apply_deltas(merge(*deltas), create=False)
+    return count, amount
@@ -0,0 +1,129 @@
+"""
+Inserting and deleting many rows without building model instances.
+
+``bulk_create`` constructs a model instance per row and compiles every
+value through its field, which costs several times more than the INSERT
+itself once a batch runs into the tens of thousands. ``insert_rows`` takes
+plain tuples, adapts each column once per type and hands the batch to a
+single ``executemany``; ``insert_from_query`` copies the result of a query
+without fetching it at all. Neither sends signals or applies field
+defaults, ``auto_now`` included, so callers supply every value.
+``delete_rows`` likewise removes rows by primary key with plain DELETEs,
+skipping the collector and its signals.
+"""
+from functools import lru_cache
+
+from django.db import connections
+
+from . import sharding
+
+
+def _adapter(field, ops):
+    internal_type = field.get_internal_type()
+    if internal_type == 'DecimalField':
+        return lambda value: ops.adapt_decimalfield_value(value, field.max_digits, field.decimal_places)
+    # Dates and timestamps repeat heavily within a batch
+    if internal_type == 'DateField':
+        return lru_cache(maxsize=None)(ops.adapt_datefield_value)
+    if internal_type == 'DateTimeField':
+        return lru_cache(maxsize=None)(ops.adapt_datetimefield_value)
+    return None
+
+
+def _needs_ids(model, fields):
+    return sharding.enabled() and sharding.is_sharded(model) and model._meta.pk not in fields
+
+
+def insert_rows(model, fields, rows, using):
+    """
+    Insert ``rows``, tuples holding a value for each name in ``fields``, into
+    ``model``'s table on ``using``. Returns the number of rows.
+
+    Values must already be of the field's Python type (``Decimal``,
+    ``date``, an aware ``datetime``...). Sharded models get ids from
+    ``sharding.allocate_ids`` unless ``fields`` includes the primary key.
+    """
+    rows = list(rows)
+    if not rows:
+        return 0
+    opts = model._meta
+    fields = [opts.get_field(name) for name in fields]
+    if _needs_ids(model, fields):
+        fields.insert(0, opts.pk)
+        rows = [(pk, *row) for pk, row in zip(sharding.allocate_ids(model, len(rows)), rows)]
+
+    connection = connections[using]
+    ops = connection.ops
+    adapters = [(index, _adapter(field, ops)) for index, field in enumerate(fields)]
+    adapters = [(index, adapt) for index, adapt in adapters if adapt is not None]
+    if adapters:
+        rows = [list(row) for row in rows]
+        for row in rows:
+            for index, adapt in adapters:
+                if row[index] is not None:
+                    row[index] = adapt(row[index])
+
+    sql = 'INSERT INTO {} ({}) VALUES ({})'.format(
+        ops.quote_name(opts.db_table),
+        ', '.join(ops.quote_name(field.column) for field in fields),
+        ', '.join(['%s'] * len(fields)),
+    )
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, rows)
+    return len(rows)
+
+
+def insert_from_query(model, fields, queryset, using):
+    """
+    Insert the rows ``queryset`` returns, one value per name in ``fields``
+    in the order the queryset selects them, without fetching them.
+
+    The queryset's SELECT becomes the body of an ``INSERT ... SELECT``. If
+    the rows need ids from ``sharding.allocate_ids``, they go through
+    ``insert_rows`` instead.
+    """
+    opts = model._meta
+    fields = [opts.get_field(name) for name in fields]
+    queryset = queryset.using(using)
+    if _needs_ids(model, fields):
+        return insert_rows(model, [field.name for field in fields], queryset.values_list(
+            *queryset.query.values_select, *queryset.query.annotation_select
+        ), using)
+
+    connection = connections[using]
+    ops = connection.ops
+    select, params = queryset.query.get_compiler(using).as_sql()
+    sql = 'INSERT INTO {} ({}) {}'.format(
+        ops.quote_name(opts.db_table),
+        ', '.join(ops.quote_name(field.column) for field in fields),
+        select,
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.rowcount
+
+
+def delete_rows(model, pks, using):
+    """
+    Delete the rows of ``model`` on ``using`` whose primary keys are in
+    ``pks``. Returns the number of rows removed.
+
+    Nothing cascades and no signals are sent, so only use it for rows that
+    no other row references and whose side effects the caller handles.
+    """
+    pks = list(pks)
+    connection = connections[using]
+    ops = connection.ops
+    opts = model._meta
+    batch_size = max(ops.bulk_batch_size([opts.pk], pks), 1)
+    deleted = 0
+    with connection.cursor() as cursor:
+        for start in range(0, len(pks), batch_size):
+            batch = pks[start:start + batch_size]
+            cursor.execute('DELETE FROM {} WHERE {} IN ({})'.format(
+                ops.quote_name(opts.db_table),
+                ops.quote_name(opts.pk.column),
+                ', '.join(['%s'] * len(batch)),
+            ), batch)
+            deleted += cursor.rowcount
+    return deleted
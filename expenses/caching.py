@@ -0,0 +1,120 @@
+"""
+Versioned per-user cache for dashboard aggregates.
+
+Each user has a data version that is bumped whenever one of their expenses
+or categories changes. Cached dashboard entries embed the version in their
+key, so a bump makes every older entry unreachable without having to find
+and delete it. Works with any Django cache backend, including local-memory
+and file-based caches.
+"""
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+
+from . import metrics
+
+
+VERSION_KEY = 'expenses:data-version:{user_id}'
+DASHBOARD_KEY = 'expenses:dashboard:{user_id}:{version}:{variant}'
+STATS_KEY = 'expenses:dashboard-cache:{outcome}'
+PRIMARY_PIN_KEY = 'expenses:primary-pin:{user_id}'
+
+
+def get_cache():
+    return caches[settings.EXPENSES_CACHE_ALIAS]
+
+
+def _initial_version():
+    # Seeded from the clock rather than 1 so that a version key lost to
+    # eviction can never come back as a value older entries were keyed by.
+    return int(time.time() * 1000)
+
+
+def data_version(user_id):
+    """Return the current data version for ``user_id``."""
+    cache = get_cache()
+    key = VERSION_KEY.format(user_id=user_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, _initial_version(), timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def bump_data_version(user_id):
+    """Invalidate every cached dashboard entry for ``user_id``."""
+    cache = get_cache()
+    key = VERSION_KEY.format(user_id=user_id)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, _initial_version(), timeout=None)
+    # Otherwise the next dashboard could be computed from a replica that
+    # hasn't caught up yet, and cached under the new version
+    pin_to_primary(user_id)
+
+
+def pin_to_primary(user_id):
+    """Read ``user_id``'s data from the primary database for a while (see routers)."""
+    get_cache().set(PRIMARY_PIN_KEY.format(user_id=user_id), True,
+                    timeout=settings.EXPENSES_REPLICA_PIN_SECONDS)
+
+
+def pinned_to_primary(user_id):
+    return get_cache().get(PRIMARY_PIN_KEY.format(user_id=user_id), False)
+
+
+def _count(outcome):
+    cache = get_cache()
+    key = STATS_KEY.format(outcome=outcome)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, 1, timeout=None)
+
+
+def _cached_dashboard(user_id, variant):
+    # Returns the cache key and the cached data, or None on a miss
+    key = DASHBOARD_KEY.format(user_id=user_id, version=data_version(user_id), variant=variant)
+    data = get_cache().get(key)
+    if data is None:
+        _count('misses')
+        metrics.count_cache_lookup('miss')
+    else:
+        _count('hits')
+        metrics.count_cache_lookup('hit')
+    return key, data
+
+
+def get_dashboard(user_id, variant, compute):
+    """
+    Return the cached dashboard data for ``(user_id, variant)``.
+
+    ``variant`` identifies the period being shown; ``compute`` is called to
+    build the data on a miss.
+    """
+    key, data = _cached_dashboard(user_id, variant)
+    if data is None:
+        data = compute()
+        get_cache().set(key, data, timeout=settings.EXPENSES_DASHBOARD_CACHE_TIMEOUT)
+    return data
+
+
+async def aget_dashboard(user_id, variant, compute):
+    """``get_dashboard()`` for async views; ``compute`` is a coroutine function."""
+    key, data = await sync_to_async(_cached_dashboard)(user_id, variant)
+    if data is None:
+        data = await compute()
+        await get_cache().aset(key, data, timeout=settings.EXPENSES_DASHBOARD_CACHE_TIMEOUT)
+    return data
+
+
+def stats():
+    """Return ``{'hits': n, 'misses': n}`` for the dashboard cache."""
+    cache = get_cache()
+    return {
+        outcome: cache.get(STATS_KEY.format(outcome=outcome), 0)
+        for outcome in ('hits', 'misses')
+    }
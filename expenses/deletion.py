@@ -0,0 +1,66 @@
+"""
+Bulk deletion of expenses in bounded batches.
+
+``QuerySet.delete()`` makes Django's collector load every matching row to
+send signals, and removes them all in one long transaction. Here the rows
+are walked in primary-key order and removed ``batch_size`` at a time, each
+batch in its own short transaction. The rollups and cached dashboards are
+adjusted per batch, not per row, so an interrupted run leaves consistent
+data and can simply be started again. With sharding, each shard is walked
+in turn.
+"""
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Sum
+
+from . import bulk, caching, rollups, sharding
+from .models import Expense
+
+
+def delete_expenses(queryset, batch_size=None, progress=None):
+    """
+    Delete every expense in ``queryset``; returns the number removed.
+
+    ``progress`` is called with the running total after each batch.
+    """
+    batch_size = batch_size or settings.EXPENSES_DELETE_BATCH_SIZE
+    deleted = 0
+    for using in sharding.databases():
+        ids = queryset.using(using).order_by('pk').values_list('pk', flat=True)
+        last_pk = None
+        while True:
+            remaining = ids if last_pk is None else ids.filter(pk__gt=last_pk)
+            batch = list(remaining[:batch_size])
+            if not batch:
+                break
+            last_pk = batch[-1]
+            deleted += _delete_batch(batch, using)
+            if progress is not None:
+                progress(deleted)
+    return deleted
+
+
+def _delete_batch(pks, using):
+    user_ids = ()
+    if sharding.enabled():
+        user_ids = set(Expense.objects.using(using).filter(pk__in=pks).values_list('user_id', flat=True))
+        if not user_ids:
+            return 0
+    with sharding.atomic(*user_ids) as alias:
+        if alias != using:
+            # Rows left on the old shard of a user who has just moved
+            raise sharding.UserMoving(f'Users {sorted(user_ids)} are being moved; try again shortly.')
+        rows = Expense.objects.using(using).select_for_update().filter(pk__in=pks)
+        deltas = {
+            (row['user_id'], row['category_id'], row['date']): (-row['total'], -row['count'])
+            for row in rows.values('user_id', 'category_id', 'date').annotate(
+                total=Sum('amount'), count=Count('pk')
+            ).order_by()
+        }
+        # Not delete(): its post_delete signals would make the rollup
+        # handlers subtract every row again on top of these deltas
+        count = bulk.delete_rows(Expense, pks, using)
+        rollups.apply_deltas(deltas)
+        for user_id in {user_id for user_id, _, _ in deltas}:
+            transaction.on_commit(lambda user_id=user_id: caching.bump_data_version(user_id), using=using)
+    return count
@@ -0,0 +1,122 @@
+"""
+Slow-query capture.
+
+``SlowQueryRecorder`` is a database execute wrapper. Any query that takes
+longer than ``EXPENSES_SLOW_QUERY_MS`` is recorded with its SQL, the view
+being served, the innermost project stack frame that issued it and the
+database's query plan (``EXPLAIN QUERY PLAN`` on SQLite, ``EXPLAIN``
+elsewhere, SELECTs only). Parameters, which may be session keys or
+password hashes, are only kept with ``EXPENSES_SLOW_QUERY_PARAMS``. Records go to a bounded in-memory
+ring buffer, one per process, that staff can browse at
+``/diagnostics/slow-queries/``.
+"""
+import os
+import threading
+import time
+import traceback
+from collections import deque, namedtuple
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+
+SlowQuery = namedtuple('SlowQuery', 'captured_at duration_ms sql params view frame plan')
+
+# Name of the view being served, set by SlowQueryMiddleware
+current_view = ContextVar('expenses_current_view', default=None)
+
+# Set while a plan is being fetched so the EXPLAIN itself is not captured
+_explaining = ContextVar('expenses_explaining', default=False)
+
+_lock = threading.Lock()
+_buffer = deque(maxlen=settings.EXPENSES_SLOW_QUERY_BUFFER)
+
+# The capture machinery itself is never the interesting frame
+_OWN_FILES = {
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), name)
+    for name in ('diagnostics.py', 'middleware.py')
+}
+
+
+def recent():
+    """Captured slow queries, newest first."""
+    with _lock:
+        return list(reversed(_buffer))
+
+
+def clear():
+    with _lock:
+        _buffer.clear()
+
+
+def _record(entry):
+    global _buffer
+    with _lock:
+        if _buffer.maxlen != settings.EXPENSES_SLOW_QUERY_BUFFER:
+            _buffer = deque(_buffer, maxlen=settings.EXPENSES_SLOW_QUERY_BUFFER)
+        _buffer.append(entry)
+
+
+def calling_frame():
+    """``path:line in function`` for the innermost project frame on the stack."""
+    base_dir = str(settings.BASE_DIR) + os.sep
+    for frame in reversed(traceback.extract_stack()):
+        filename = frame.filename
+        if (filename.startswith(base_dir) and filename not in _OWN_FILES
+                and 'site-packages' not in filename):
+            return f'{os.path.relpath(filename, base_dir)}:{frame.lineno} in {frame.name}'
+    return None
+
+
+def explain(connection, sql, params):
+    """Return the query plan for ``sql`` as text, or None if it can't be explained."""
+    if not sql.lstrip().upper().startswith('SELECT'):
+        return None
+    prefix = 'EXPLAIN QUERY PLAN ' if connection.vendor == 'sqlite' else 'EXPLAIN '
+    token = _explaining.set(True)
+    try:
+        # The savepoint keeps a failed EXPLAIN from poisoning the request's transaction
+        with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+            cursor.execute(prefix + sql, params)
+            rows = cursor.fetchall()
+    except Exception as exc:
+        return f'(no plan: {exc})'
+    finally:
+        _explaining.reset(token)
+    if connection.vendor == 'sqlite':
+        # (id, parent, notused, detail): indent children under their parent
+        depth = {0: -1}
+        lines = []
+        for node, parent, _, detail in rows:
+            depth[node] = depth.get(parent, -1) + 1
+            lines.append('  ' * depth[node] + detail)
+        return '\n'.join(lines)
+    return '\n'.join(' '.join(str(value) for value in row) for row in rows)
+
+
+class SlowQueryRecorder:
+    """Execute wrapper for one connection that captures queries over the threshold."""
+
+    def __init__(self, connection, threshold_ms):
+        self.connection = connection
+        self.threshold_ms = threshold_ms
+
+    def __call__(self, execute, sql, params, many, context):
+        if _explaining.get():
+            return execute(sql, params, many, context)
+        started = time.perf_counter()
+        result = execute(sql, params, many, context)
+        duration_ms = (time.perf_counter() - started) * 1000
+        if duration_ms >= self.threshold_ms:
+            _record(SlowQuery(
+                captured_at=timezone.now(),
+                duration_ms=round(duration_ms, 2),
+                sql=sql,
+                params=repr(params) if settings.EXPENSES_SLOW_QUERY_PARAMS else None,
+                view=current_view.get(),
+                frame=calling_frame(),
+                plan=None if many else explain(self.connection, sql, params),
+            ))
+        return result
@@ -0,0 +1,37 @@
+from django.conf import settings
+from django.contrib import admin, messages
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import Http404, HttpResponse, HttpResponseForbidden
+from django.shortcuts import redirect, render
+from django.utils.crypto import constant_time_compare
+
+from . import diagnostics, metrics
+
+
+@staff_member_required
+def slow_query_list(request):
+    """Browse the slow queries captured by this process, newest first"""
+    if request.method == 'POST':
+        diagnostics.clear()
+        messages.success(request, 'Cleared the captured slow queries.')
+        return redirect('slow_query_list')
+    
+    context = {
+        **admin.site.each_context(request),
+        'title': 'Slow queries',
+        'queries': diagnostics.recent(),
+        'threshold_ms': settings.EXPENSES_SLOW_QUERY_MS,
+        'buffer_size': settings.EXPENSES_SLOW_QUERY_BUFFER,
+    }
+    return render(request, 'admin/expenses/slow_queries.html', context)
+
+
+def metrics_view(request):
+    """Prometheus scrape endpoint with the metrics of every worker process"""
+    if not settings.EXPENSES_METRICS:
+        raise Http404
+    token = settings.EXPENSES_METRICS_TOKEN
+    if token and not constant_time_compare(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return HttpResponseForbidden()
+    
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,85 @@
+"""
+Streaming CSV export of expenses.
+
+Rows are read with ``values_list().iterator()``, so the database driver
+hands them over in chunks and no model instances are built. Each batch of
+rows is written out as one piece of the response, which keeps memory flat
+however many expenses are exported.
+"""
+import csv
+import zlib
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.http import StreamingHttpResponse
+
+from . import sharding
+
+
+COLUMNS = [
+    ('User', 'user__username'),
+    ('Title', 'title'),
+    ('Amount', 'amount'),
+    ('Category', 'category__name'),
+    ('Date', 'date'),
+    ('Description', 'description'),
+]
+
+
+class Echo:
+    """File-like object whose write() hands the CSV line straight back."""
+
+    def write(self, value):
+        return value
+
+
+def csv_chunks(queryset, chunk_size=None):
+    """Yield the CSV for ``queryset`` as strings of up to ``chunk_size`` rows."""
+    chunk_size = chunk_size or settings.EXPENSES_EXPORT_CHUNK_SIZE
+    writer = csv.writer(Echo())
+    fields = [field for _, field in COLUMNS]
+    usernames = None
+    if sharding.enabled():
+        # Users are on the global shard, so their names can't be joined in;
+        # they are looked up once per user instead
+        fields[0] = 'user_id'
+        usernames = {}
+    rows = queryset.values_list(*fields)
+
+    buffer = [writer.writerow([header for header, _ in COLUMNS])]
+    for row in rows.iterator(chunk_size=chunk_size):
+        if usernames is not None:
+            if row[0] not in usernames:
+                usernames[row[0]] = User.objects.filter(pk=row[0]).values_list('username', flat=True).first()
+            row = (usernames[row[0]], *row[1:])
+        buffer.append(writer.writerow(row))
+        if len(buffer) >= chunk_size:
+            yield ''.join(buffer)
+            buffer = []
+    if buffer:
+        yield ''.join(buffer)
+
+
+def gzip_chunks(chunks):
+    """Compress a stream of strings into a gzip stream of bytes."""
+    compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode())
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_response(queryset, filename='expenses', compress=False):
+    """
+    Stream ``queryset`` as a CSV download, gzipped when ``compress`` is set.
+    """
+    chunks = csv_chunks(queryset)
+    if compress:
+        response = StreamingHttpResponse(gzip_chunks(chunks), content_type='application/gzip')
+        filename += '.csv.gz'
+    else:
+        response = StreamingHttpResponse(chunks, content_type='text/csv')
+        filename += '.csv'
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
@@ -1,4 +1,5 @@
 from django import forms
+from . import sharding, splits
 from .models import Expense, Category, Group, SharedExpense
 
 
@@ -68,11 +69,62 @@ class SharedExpenseForm(forms.ModelForm):
     
     def __init__(self, *args, **kwargs):
         group = kwargs.pop('group', None)
+        self.members = kwargs.pop('members', [])
+        payer = kwargs.pop('payer', None)
         super().__init__(*args, **kwargs)
         if group:
-            # Filter categories to show categories from any group member
-            group_member_ids = group.members.values_list('id', flat=True)
-            self.fields['category'].queryset = Category.objects.filter(
-                user__in=group_member_ids
-            ).distinct()
+            if sharding.enabled():
+                # Members' categories may be spread over several shards;
+                # the payer's own are all on one
+                self.fields['category'].queryset = Category.objects.filter(user=payer)
+            else:
+                # Filter categories to show categories from any group member
+                group_member_ids = group.members.values_list('id', flat=True)
+                self.fields['category'].queryset = Category.objects.filter(
+                    user__in=group_member_ids
+                ).distinct()
             self.fields['category'].required = False
+        
+        # One share field per member, used by exact and percentage splits
+        for member in self.members:
+            self.fields[self.share_field_name(member)] = forms.DecimalField(
+                label=member.username,
+                required=False,
+                min_value=0,
+                max_digits=10,
+                decimal_places=2,
+                widget=forms.NumberInput(attrs={'class': 'form-control', 'placeholder': '0.00', 'step': '0.01'}),
+            )
+    
+    @staticmethod
+    def share_field_name(member):
+        return f'share_{member.pk}'
+    
+    def clean(self):
+        cleaned_data = super().clean()
+        amount = cleaned_data.get('amount')
+        split_type = cleaned_data.get('split_type')
+        if amount is None or split_type is None:
+            return cleaned_data
+        
+        values = {
+            member.pk: cleaned_data.get(self.share_field_name(member))
+            for member in self.members
+        }
+        try:
+            cleaned_data['splits'] = splits.split_amounts(
+                amount, split_type, [member.pk for member in self.members], values
+            )
+        except ValueError as exc:
+            raise forms.ValidationError(str(exc))
+        return cleaned_data
+
+
+class ExpenseImportForm(forms.Form):
+    """
+    Form for uploading a CSV file of expenses.
+    """
+    file = forms.FileField(
+        help_text='CSV with Title, Amount, Category, Date (YYYY-MM-DD) and optional Description columns.',
+        widget=forms.ClearableFileInput(attrs={'class': 'form-control', 'accept': '.csv,text/csv'}),
+    )
@@ -1,23 +1,53 @@
-from django.shortcuts import render, redirect, get_object_or_404
+from asgiref.sync import sync_to_async
+from django.shortcuts import aget_object_or_404, render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
-from django.db.models import Sum, Q
+from django.db import transaction
+from django.db.models import DecimalField, Exists, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
 from django.contrib.auth.models import User
 from django.http import JsonResponse
 from django.utils import timezone
-from .models import Group, GroupMember, SharedExpense, ExpenseSplit, Category
+from django.views.decorators.http import require_POST
+import asyncio
+import logging
+from . import balances, pagination, routers, settlements, sharding
+from .models import Group, GroupMember, SharedExpense, ExpenseSplit, GroupBalance, Category
 from .forms import GroupForm, SharedExpenseForm
 
 
+logger = logging.getLogger('expenses.balances')
+
+
 @login_required
+@routers.replica_reads
 def group_list(request):
     """Display list of user's groups"""
-    user_groups = request.user.user_groups.all()
-    created_groups = request.user.created_groups.all()
+    membership = GroupMember.objects.filter(group=OuterRef('pk'), user=request.user)
+    money = DecimalField(max_digits=14, decimal_places=2)
+    
+    # One query covers both lists; member counts are denormalized and the
+    # totals and the viewer's balance come from correlated subqueries.
+    groups = list(Group.objects.filter(
+        Q(created_by=request.user) | Q(Exists(membership))
+    ).annotate(
+        is_member=Exists(membership),
+        total_spent=Coalesce(
+            Subquery(SharedExpense.objects.filter(group=OuterRef('pk')).order_by().values('group')
+                     .annotate(total=Sum('amount')).values('total')),
+            Value(0),
+            output_field=money,
+        ),
+        user_net=Coalesce(
+            Subquery(GroupBalance.objects.filter(group=OuterRef('pk'), user=request.user).values('net')),
+            Value(0),
+            output_field=money,
+        ),
+    ))
     
     context = {
-        'user_groups': user_groups,
-        'created_groups': created_groups,
+        'user_groups': [group for group in groups if group.is_member],
+        'created_groups': [group for group in groups if group.created_by_id == request.user.id],
     }
     return render(request, 'expenses/group_list.html', context)
 
@@ -47,6 +77,14 @@ def group_create(request):
     return render(request, 'expenses/group_form.html', {'form': form, 'action': 'Create'})
 
 
+def _shared_expense_rows(group):
+    # Categories live on the payers' shards when sharding is on, so they
+    # can't be joined in; sharding.load_categories fetches them per page
+    if sharding.enabled():
+        return group.shared_expenses.all().select_related('group', 'paid_by')
+    return group.shared_expenses.all().select_related('group', 'paid_by', 'category')
+
+
 @login_required
 def group_detail(request, pk):
     """Display group details and shared expenses"""
@@ -57,23 +95,32 @@ def group_detail(request, pk):
         messages.error(request, 'You are not a member of this group.')
         return redirect('group_list')
     
-    shared_expenses = group.shared_expenses.all().select_related('paid_by', 'category')
+    shared_expenses = _shared_expense_rows(group)
     
-    # Calculate balances
-    balances = {}
-    for member in group.members.all():
-        paid_total = shared_expenses.filter(paid_by=member).aggregate(
-            total=Sum('amount'))['total'] or 0
-        
-        owed_total = ExpenseSplit.objects.filter(
-            expense__group=group, user=member
-        ).aggregate(total=Sum('amount'))['total'] or 0
-        
-        balances[member.username] = paid_total - owed_total
+    # Every member's position comes from the balance ledger in one query
+    balances = dict(group.members.annotate(
+        net=Coalesce(
+            Subquery(GroupBalance.objects.filter(group=group, user=OuterRef('pk')).values('net')),
+            Value(0),
+            output_field=DecimalField(),
+        )
+    ).values_list('username', 'net'))
+    
+    # Only one page of shared expenses is loaded; ?cursor= moves between pages
+    page = pagination.paginate_request(request, shared_expenses)
+    
+    if sharding.enabled():
+        sharding.load_categories(page.object_list)
+    
+    # The viewer's share of every expense on the page, in one query
+    shares = SharedExpense.get_user_shares(page.object_list, request.user)
+    for expense in page.object_list:
+        expense.user_share = shares[expense.pk]
     
     context = {
         'group': group,
-        'shared_expenses': shared_expenses,
+        'shared_expenses': page.object_list,
+        'page': page,
         'balances': balances,
         'is_admin': GroupMember.objects.filter(
             group=group, user=request.user, is_admin=True
@@ -82,6 +129,93 @@ def group_detail(request, pk):
     return render(request, 'expenses/group_detail.html', context)
 
 
+@login_required
+async def group_detail_async(request, pk):
+    """
+    Async version of group_detail for ASGI servers.
+
+    Membership is checked first; the balances, the page of shared expenses
+    and the group total are then requested at the same time.
+    """
+    user = await request.auser()
+    group = await aget_object_or_404(Group, pk=pk)
+    
+    # One query answers both "is a member" and "is an admin"
+    is_admin = await GroupMember.objects.filter(
+        group=group, user=user
+    ).values_list('is_admin', flat=True).afirst()
+    if is_admin is None:
+        messages.error(request, 'You are not a member of this group.')
+        return redirect('group_list')
+    
+    shared_expenses = _shared_expense_rows(group)
+    ledger = group.members.annotate(
+        net=Coalesce(
+            Subquery(GroupBalance.objects.filter(group=group, user=OuterRef('pk')).values('net')),
+            Value(0),
+            output_field=DecimalField(),
+        )
+    ).values_list('username', 'net')
+    
+    async def load_balances():
+        return {username: net async for username, net in ledger}
+    
+    balances, page, totals = await asyncio.gather(
+        load_balances(),
+        pagination.apaginate_request(request, shared_expenses),
+        group.shared_expenses.aaggregate(total=Coalesce(Sum('amount'), Value(0), output_field=DecimalField())),
+    )
+    # Read by get_total_expenses, so the template doesn't query for it
+    group.total_spent = totals['total']
+    
+    if sharding.enabled():
+        await sync_to_async(sharding.load_categories)(page.object_list)
+    
+    shares = await sync_to_async(SharedExpense.get_user_shares)(page.object_list, user)
+    for expense in page.object_list:
+        expense.user_share = shares[expense.pk]
+    
+    context = {
+        'group': group,
+        'shared_expenses': page.object_list,
+        'page': page,
+        'balances': balances,
+        'is_admin': is_admin,
+    }
+    # Rendered in a thread: templates may follow relations lazily, which
+    # the ORM only allows from sync code
+    return await sync_to_async(render)(request, 'expenses/group_detail.html', context)
+
+
+@login_required
+def group_settlement_plan(request, pk):
+    """Suggest the fewest transfers that settle everyone's balance in the group"""
+    group = get_object_or_404(Group, pk=pk)
+    
+    # Check if user is a member
+    if not group.members.filter(id=request.user.id).exists():
+        return JsonResponse({'error': 'You are not a member of this group.'}, status=403)
+    
+    ledger = dict(GroupBalance.objects.filter(group=group).exclude(net=0).values_list('user__username', 'net'))
+    try:
+        transfers = settlements.simplify_debts(ledger)
+    except ValueError:
+        # The ledger has drifted from the splits (reconcile_balances repairs
+        # it); plan from the splits themselves in the meantime
+        logger.warning('Balances of group %s do not sum to zero; run reconcile_balances', group.pk)
+        expected = {user_id: net for (_, user_id), net in balances.expected_balances([group.pk]).items() if net}
+        usernames = dict(User.objects.filter(pk__in=expected).values_list('pk', 'username'))
+        transfers = settlements.simplify_debts({usernames[user_id]: net for user_id, net in expected.items()})
+    
+    return JsonResponse({
+        'group': group.pk,
+        'transfers': [
+            {'from': transfer.debtor, 'to': transfer.creditor, 'amount': str(transfer.amount)}
+            for transfer in transfers
+        ],
+    })
+
+
 @login_required
 def group_join(request, pk):
     """Join a group via invitation or request"""
@@ -123,37 +257,39 @@ def group_leave(request, pk):
 def shared_expense_create(request, group_pk):
     """Create a shared expense for a group"""
     group = get_object_or_404(Group, pk=group_pk)
+    members = list(group.members.all())
     
     # Check if user is a member
-    if not group.members.filter(id=request.user.id).exists():
+    if request.user.pk not in {member.pk for member in members}:
         messages.error(request, 'You are not a member of this group.')
         return redirect('group_list')
     
     if request.method == 'POST':
-        form = SharedExpenseForm(request.POST, group=group)
+        form = SharedExpenseForm(request.POST, group=group, members=members, payer=request.user)
         if form.is_valid():
             expense = form.save(commit=False)
             expense.group = group
             expense.paid_by = request.user
-            expense.save()
             
-            # Create expense splits
-            if expense.split_type == 'equal':
-                # Split equally among all members
-                member_count = group.members.count()
-                split_amount = expense.amount / member_count
+            # The expense, its splits and the balance ledger change together,
+            # in a fixed number of queries whatever the group size
+            with transaction.atomic():
+                expense.save()
                 
-                for member in group.members.all():
-                    ExpenseSplit.objects.create(
-                        expense=expense,
-                        user=member,
-                        amount=split_amount
-                    )
+                new_splits = [
+                    ExpenseSplit(expense=expense, user_id=user_id, amount=amount, percentage=percentage)
+                    for user_id, (amount, percentage) in form.cleaned_data['splits'].items()
+                ]
+                ExpenseSplit.objects.bulk_create(new_splits)
+                balances.apply_deltas(balances.merge(*(
+                    balances.split_deltas(group.pk, request.user.pk, split.user_id, split.amount, False)
+                    for split in new_splits
+                )))
             
             messages.success(request, 'Shared expense added successfully!')
             return redirect('group_detail', pk=group.pk)
     else:
-        form = SharedExpenseForm(group=group)
+        form = SharedExpenseForm(group=group, members=members, payer=request.user)
     
     context = {
         'form': form,
@@ -190,7 +326,8 @@ def settle_expense(request, split_pk):
     if request.method == 'POST':
         split.is_settled = True
         split.settled_at = timezone.now()
-        split.save()
+        with transaction.atomic():
+            split.save()
         
         messages.success(request, 'Expense marked as settled!')
         return redirect('group_detail', pk=split.expense.group.pk)
@@ -198,6 +335,30 @@ def settle_expense(request, split_pk):
     return render(request, 'expenses/settle_expense_confirm.html', {'split': split})
 
 
+@login_required
+@require_POST
+def settle_up_with(request, pk, user_pk):
+    """Settle every open split between the current user and another member"""
+    group = get_object_or_404(Group, pk=pk)
+    
+    # Check if user is a member
+    if not group.members.filter(id=request.user.id).exists():
+        messages.error(request, 'You are not a member of this group.')
+        return redirect('group_list')
+    
+    # Only another member of the group can be settled with
+    other = get_object_or_404(group.members.exclude(pk=request.user.pk), pk=user_pk)
+    
+    count, amount = balances.settle_between(group.pk, request.user.pk, other.pk)
+    if not count:
+        messages.info(request, f'Nothing left to settle with {other.username}.')
+    elif amount >= 0:
+        messages.success(request, f'Settled {count} expenses: you paid {other.username} ${amount:.2f}.')
+    else:
+        messages.success(request, f'Settled {count} expenses: {other.username} paid you ${-amount:.2f}.')
+    return redirect('group_detail', pk=group.pk)
+
+
 @login_required
 def group_members(request, pk):
     """Manage group members"""
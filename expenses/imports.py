@@ -0,0 +1,145 @@
+"""
+Bulk CSV import of a user's expense history.
+
+The file is parsed as a stream, so only one batch of rows is held in
+memory. Category names are resolved through an in-memory name -> id map
+(creating the missing ones once per batch), and expenses are inserted as
+plain tuples with ``bulk.insert_rows``, one transaction per batch. Rather
+than folding every batch into the rollups, the import rebuilds them once
+at the end for the date span it wrote, so the dashboard catches up with
+the new rows when the import finishes. Rows that fail validation are
+collected in the result instead of aborting the import.
+
+The expected columns match the export: ``Title``, ``Amount``, ``Category``,
+``Date`` (YYYY-MM-DD) and optionally ``Description``. Other columns, such
+as the export's ``User``, are ignored.
+"""
+import csv
+from collections import namedtuple
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from . import bulk, caching, rollups, sharding
+from .models import Category, Expense
+
+
+REQUIRED_COLUMNS = ('title', 'amount', 'category', 'date')
+
+RowError = namedtuple('RowError', 'line message')
+ImportResult = namedtuple('ImportResult', 'created errors')
+
+CENT = Decimal('0.01')
+_title_length = Expense._meta.get_field('title').max_length
+_category_length = Category._meta.get_field('name').max_length
+_amount_field = Expense._meta.get_field('amount')
+_max_amount = Decimal(10) ** (_amount_field.max_digits - _amount_field.decimal_places)
+_columns = ('title', 'amount', 'category', 'date', 'description', 'user', 'created_at', 'updated_at')
+
+
+class InvalidImportFile(ValueError):
+    """The file as a whole cannot be imported, e.g. required columns are missing."""
+
+
+def _parse_row(row):
+    """Return ``(title, amount, category_name, date, description)`` or raise ValueError."""
+    title = (row.get('title') or '').strip()
+    if not title:
+        raise ValueError('Title is required.')
+    if len(title) > _title_length:
+        raise ValueError(f'Title is longer than {_title_length} characters.')
+
+    try:
+        amount = Decimal((row.get('amount') or '').strip().lstrip('$'))
+    except InvalidOperation:
+        raise ValueError(f'Invalid amount: {row.get("amount")!r}')
+    if not amount.is_finite() or amount != amount.quantize(CENT) or abs(amount) >= _max_amount:
+        raise ValueError(f'Invalid amount: {row.get("amount")!r}')
+
+    category = (row.get('category') or '').strip()
+    if not category:
+        raise ValueError('Category is required.')
+    if len(category) > _category_length:
+        raise ValueError(f'Category is longer than {_category_length} characters.')
+
+    value = (row.get('date') or '').strip()
+    try:
+        day = parse_date(value)
+    except ValueError:
+        day = None
+    if day is None:
+        raise ValueError(f'Invalid date: {value!r}')
+
+    return title, amount, category, day, (row.get('description') or '').strip()
+
+
+def import_expenses(user, lines, batch_size=None):
+    """
+    Import expenses for ``user`` from ``lines``, an iterable of CSV text lines.
+
+    Returns an ImportResult with the number of expenses created and a list
+    of RowError for rows that were skipped. Raises InvalidImportFile if the
+    header lacks a required column.
+    """
+    batch_size = batch_size or settings.EXPENSES_IMPORT_BATCH_SIZE
+    reader = csv.reader(lines)
+    header = [name.strip().lower() for name in next(reader, [])]
+    missing = [name for name in REQUIRED_COLUMNS if name not in header]
+    if missing:
+        raise InvalidImportFile(f'Missing column(s): {", ".join(missing)}')
+
+    categories = dict(Category.objects.filter(user=user).values_list('name', 'id'))
+    using = sharding.db_for_user(user.pk, for_write=True)
+    created, errors, batch, days = 0, [], [], set()
+
+    try:
+        for values in reader:
+            if not any(values):
+                continue
+            try:
+                title, amount, category, day, description = _parse_row(dict(zip(header, values)))
+            except ValueError as exc:
+                errors.append(RowError(reader.line_num, str(exc)))
+                continue
+
+            batch.append((title, amount, category, day, description))
+            days.add(day)
+            if len(batch) >= batch_size:
+                created += _insert(user, batch, categories)
+                batch = []
+
+        if batch:
+            created += _insert(user, batch, categories)
+    finally:
+        # Even after a failure, so the batches already committed are counted
+        if days:
+            rollups.rebuild([user.pk], min(days), max(days))
+            transaction.on_commit(lambda: caching.bump_data_version(user.pk), using=using)
+    return ImportResult(created, errors)
+
+
+def _insert(user, rows, categories):
+    """
+    Insert ``(title, amount, category_name, date, description)`` tuples for
+    ``user`` in one transaction. ``categories`` maps names to ids and gains
+    any category the batch had to create.
+    """
+    now = timezone.now()
+    with sharding.atomic(user.pk) as using:
+        missing = {row[2] for row in rows} - categories.keys()
+        if missing:
+            # (name, user) is unique, so names another request has created
+            # since are skipped here and picked up by the lookup below
+            Category.objects.using(using).bulk_create(
+                [Category(user=user, name=name) for name in missing], ignore_conflicts=True,
+            )
+            categories.update(Category.objects.using(using).filter(
+                user=user, name__in=missing,
+            ).values_list('name', 'id'))
+        return bulk.insert_rows(Expense, _columns, (
+            (title, amount, categories[category], day, description, user.pk, now, now)
+            for title, amount, category, day, description in rows
+        ), using)
@@ -0,0 +1,41 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from expenses import aggregation, deletion
+from expenses.models import Expense
+
+
+class Command(BaseCommand):
+    help = 'Delete expenses in primary-key batches, keeping rollups and caches in step.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', action='append', default=[], dest='usernames',
+                            help='Only delete expenses of this user (repeatable).')
+        parser.add_argument('--start', help='Only delete expenses dated on or after YYYY-MM-DD.')
+        parser.add_argument('--end', help='Only delete expenses dated on or before YYYY-MM-DD.')
+        parser.add_argument('--all', action='store_true', help='Allow deleting without any filter.')
+        parser.add_argument('--batch-size', type=int, help='Expenses deleted per transaction.')
+
+    def handle(self, *args, **options):
+        bounds = []
+        for name in ('start', 'end'):
+            value = options[name]
+            parsed = parse_date(value) if value else None
+            if value and parsed is None:
+                raise CommandError(f'Invalid --{name} date: {value}')
+            bounds.append(parsed)
+
+        expenses = aggregation.filter_dates(Expense.objects.all(), *bounds)
+        if options['usernames']:
+            # Ids rather than a join: with sharding, users live on another database
+            user_ids = list(User.objects.filter(username__in=options['usernames']).values_list('pk', flat=True))
+            expenses = expenses.filter(user_id__in=user_ids)
+        elif not any(bounds) and not options['all']:
+            raise CommandError('Pass --user, --start/--end or --all.')
+
+        def progress(count):
+            self.stdout.write(f'Deleted {count} expenses...')
+
+        count = deletion.delete_expenses(expenses, options['batch_size'], progress=progress)
+        self.stdout.write(self.style.SUCCESS(f'Deleted {count} expenses.'))
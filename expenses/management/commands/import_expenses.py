@@ -0,0 +1,42 @@
+import sys
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from expenses import imports
+
+
+class Command(BaseCommand):
+    help = 'Import expenses for a user from a CSV file (Title, Amount, Category, Date, Description).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='CSV file to read, or - for standard input.')
+        parser.add_argument('--user', required=True, help='Username that will own the expenses.')
+        parser.add_argument('--batch-size', type=int, help='Expenses inserted per transaction.')
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options['user'])
+        except User.DoesNotExist:
+            raise CommandError(f'No such user: {options["user"]}')
+
+        if options['path'] == '-':
+            result = self._import(user, sys.stdin, options['batch_size'])
+        else:
+            try:
+                with open(options['path'], encoding='utf-8-sig', newline='') as lines:
+                    result = self._import(user, lines, options['batch_size'])
+            except OSError as exc:
+                raise CommandError(str(exc))
+
+        for error in result.errors:
+            self.stderr.write(f'line {error.line}: {error.message}')
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {result.created} expenses, skipped {len(result.errors)} rows.'
+        ))
+
+    def _import(self, user, lines, batch_size):
+        try:
+            return imports.import_expenses(user, lines, batch_size)
+        except imports.InvalidImportFile as exc:
+            raise CommandError(str(exc))
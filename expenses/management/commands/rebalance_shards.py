@@ -0,0 +1,65 @@
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count
+
+from expenses import sharding
+from expenses.models import Expense, UserShard
+
+
+class Command(BaseCommand):
+    help = ('Move users between shards, either one at a time or so every shard holds about '
+            'the same number of expenses. A user\'s data is read-only while they are moved.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', action='append', default=[], dest='usernames',
+                            help='Move this user (repeatable); needs --to.')
+        parser.add_argument('--to', help='Shard to move the --user users to.')
+        parser.add_argument('--even', action='store_true',
+                            help='Move users from the fullest shards to the emptiest ones.')
+        parser.add_argument('--max-moves', type=int, help='Stop --even after this many moves.')
+        parser.add_argument('--dry-run', action='store_true', help='Print the moves without making them.')
+
+    def handle(self, *args, **options):
+        if not sharding.enabled():
+            raise CommandError('Sharding is off; set SHARD_DATABASE_URLS.')
+        if bool(options['usernames']) == options['even']:
+            raise CommandError('Pass either --user with --to, or --even.')
+
+        if options['even']:
+            moves = sharding.plan_rebalance(self.loads(), options['max_moves'])
+        else:
+            target = options['to']
+            if target not in settings.EXPENSES_SHARDS:
+                raise CommandError(f'--to must be one of: {", ".join(settings.EXPENSES_SHARDS)}')
+            users = dict(User.objects.filter(username__in=options['usernames']).values_list('username', 'pk'))
+            missing = set(options['usernames']) - set(users)
+            if missing:
+                raise CommandError(f'Unknown user(s): {", ".join(sorted(missing))}')
+            moves = [
+                (user_id, sharding.placement(user_id)[0], target)
+                for user_id in users.values()
+            ]
+            moves = [move for move in moves if move[1] != target]
+
+        for user_id, source, target in moves:
+            if options['dry_run']:
+                self.stdout.write(f'Would move user {user_id} from {source} to {target}')
+                continue
+            sharding.move_user(user_id, target)
+            self.stdout.write(f'Moved user {user_id} from {source} to {target}')
+        self.stdout.write(self.style.SUCCESS(
+            f'{"Planned" if options["dry_run"] else "Made"} {len(moves)} move(s).'
+        ))
+
+    def loads(self):
+        """``{shard: {user_id: expenses}}`` for the users placed on each shard."""
+        loads = {shard: {} for shard in settings.EXPENSES_SHARDS}
+        for shard in settings.EXPENSES_SHARDS:
+            placed = set(UserShard.objects.filter(shard=shard).values_list('user_id', flat=True))
+            counts = Expense.objects.using(shard).order_by().values('user_id').annotate(rows=Count('pk'))
+            for row in counts:
+                # Leftovers of an interrupted move belong to another shard
+                if row['user_id'] in placed:
+                    loads[shard][row['user_id']] = row['rows']
+        return loads
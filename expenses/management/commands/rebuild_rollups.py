@@ -0,0 +1,40 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from expenses import rollups
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the daily/monthly spending rollups from expenses, or check them for drift.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('usernames', nargs='*', help='Only process these users (default: everyone).')
+        parser.add_argument('--check', action='store_true',
+                            help='Report drift without rewriting anything; exits non-zero if any is found.')
+        parser.add_argument('--batch-size', type=int, default=500, help='Users processed per batch.')
+
+    def handle(self, *args, **options):
+        users = User.objects.order_by('pk')
+        if options['usernames']:
+            users = users.filter(username__in=options['usernames'])
+        user_ids = list(users.values_list('pk', flat=True))
+        batch_size = options['batch_size']
+
+        drift_count = 0
+        for start in range(0, len(user_ids), batch_size):
+            batch = user_ids[start:start + batch_size]
+            if options['check']:
+                for table, key, expected, actual in rollups.find_drift(batch):
+                    drift_count += 1
+                    self.stdout.write(f'{table} {key}: expected {expected}, found {actual}')
+            else:
+                daily, monthly = rollups.rebuild(batch)
+                self.stdout.write(f'Rebuilt {daily} daily and {monthly} monthly rows '
+                                  f'for {len(batch)} users.')
+
+        if options['check']:
+            if drift_count:
+                raise CommandError(f'{drift_count} rollup rows have drifted.')
+            self.stdout.write(self.style.SUCCESS('Rollups are in sync.'))
+        else:
+            self.stdout.write(self.style.SUCCESS(f'Rebuilt rollups for {len(user_ids)} users.'))
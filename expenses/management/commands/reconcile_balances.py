@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from expenses import balances
+from expenses.models import Group
+
+
+class Command(BaseCommand):
+    help = 'Recompute group balances from the raw expense splits and report (or fix) ledger mismatches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('group_ids', nargs='*', type=int, help='Only reconcile these groups (default: all).')
+        parser.add_argument('--fix', action='store_true', help='Rewrite the ledger for groups with mismatches.')
+        parser.add_argument('--batch-size', type=int, default=500, help='Groups processed per batch.')
+
+    def handle(self, *args, **options):
+        groups = Group.objects.order_by('pk')
+        if options['group_ids']:
+            groups = groups.filter(pk__in=options['group_ids'])
+        group_ids = list(groups.values_list('pk', flat=True))
+        batch_size = options['batch_size']
+
+        mismatched_groups = set()
+        for start in range(0, len(group_ids), batch_size):
+            batch = group_ids[start:start + batch_size]
+            mismatches = balances.find_mismatches(batch)
+            for group_id, user_id, expected, recorded in mismatches:
+                self.stdout.write(f'group {group_id} user {user_id}: expected {expected}, ledger has {recorded}')
+            stale = {group_id for group_id, *_ in mismatches}
+            if options['fix'] and stale:
+                balances.rebuild(stale)
+            mismatched_groups |= stale
+
+        if not mismatched_groups:
+            self.stdout.write(self.style.SUCCESS(f'All {len(group_ids)} group ledgers reconcile.'))
+        elif options['fix']:
+            self.stdout.write(self.style.SUCCESS(f'Rebuilt the ledger for {len(mismatched_groups)} groups.'))
+        else:
+            raise CommandError(f'{len(mismatched_groups)} groups have ledger mismatches; rerun with --fix.')
@@ -0,0 +1,205 @@
+import random
+from datetime import date, timedelta
+from decimal import Decimal
+from itertools import accumulate
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+
+from expenses import balances, rollups, splits
+from expenses.models import Category, Expense, ExpenseSplit, Group, GroupMember, SharedExpense
+
+
+CATEGORY_NAMES = [
+    'Food', 'Groceries', 'Transport', 'Rent', 'Utilities', 'Entertainment', 'Health',
+    'Shopping', 'Travel', 'Education', 'Insurance', 'Gifts', 'Subscriptions', 'Pets',
+    'Home', 'Fitness', 'Coffee', 'Books', 'Charity', 'Other',
+]
+TITLES = ['Lunch', 'Dinner', 'Taxi', 'Tickets', 'Supplies', 'Bill', 'Order', 'Refill', 'Snacks', 'Fees']
+SPLIT_TYPES = ['equal', 'exact', 'percentage']
+CENT = Decimal('0.01')
+
+
+class Command(BaseCommand):
+    help = 'Generate a reproducible synthetic dataset (users, expenses, groups, splits) for scale testing.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100)
+        parser.add_argument('--categories', type=int, default=8, help='Categories per user (max 20).')
+        parser.add_argument('--expenses', type=int, default=10_000, help='Personal expenses in total.')
+        parser.add_argument('--skew', type=float, default=1.0,
+                            help='Zipf exponent for how expenses spread over users; 0 is uniform, '
+                                 'higher values concentrate them on a few heavy users.')
+        parser.add_argument('--groups', type=int, default=20)
+        parser.add_argument('--group-size', type=int, default=4, help='Typical members per group.')
+        parser.add_argument('--group-skew', type=float, default=2.0,
+                            help='Pareto shape for group sizes; lower values give more very large groups.')
+        parser.add_argument('--max-group-size', type=int, default=500)
+        parser.add_argument('--shared-expenses', type=int, default=2_000)
+        parser.add_argument('--settled', type=float, default=0.3, help='Fraction of splits already settled.')
+        parser.add_argument('--days', type=int, default=730, help='Spread expenses over this many days.')
+        parser.add_argument('--end', type=date.fromisoformat, help='Last expense date, YYYY-MM-DD (default: today).')
+        parser.add_argument('--prefix', default='seed', help='Username prefix for generated users.')
+        parser.add_argument('--password', help='Give every generated user this password (default: unusable).')
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--batch-size', type=int, default=5_000)
+
+    def handle(self, *args, **options):
+        if User.objects.filter(username__startswith=options['prefix']).exists():
+            raise CommandError(f'Users named {options["prefix"]}* already exist; pick another --prefix.')
+        if not connection.features.can_return_rows_from_bulk_insert:
+            raise CommandError('seed_scale needs a database that returns ids from bulk inserts.')
+        if options['users'] < 2:
+            raise CommandError('--users must be at least 2.')
+
+        self.rng = random.Random(options['seed'])
+        self.batch_size = options['batch_size']
+        self.end = options['end'] or timezone.now().date()
+        self.days = options['days']
+        self.options = options
+
+        user_ids = self.create_users()
+        categories = self.create_categories(user_ids)
+        self.create_expenses(user_ids, categories)
+        groups = self.create_groups(user_ids)
+        self.create_shared_expenses(groups, categories)
+
+        # Everything above skipped the signals, so derive the maintained data once
+        self.stdout.write('Rebuilding rollups, balances and member counts...')
+        for start in range(0, len(user_ids), 500):
+            rollups.rebuild(user_ids[start:start + 500])
+        group_ids = [group_id for group_id, _ in groups]
+        for start in range(0, len(group_ids), 500):
+            batch = group_ids[start:start + 500]
+            balances.rebuild(batch)
+            Group.recount_members(batch)
+        self.stdout.write(self.style.SUCCESS('Done.'))
+
+    def insert(self, model, objects):
+        """bulk_create ``objects`` in batches, each in its own transaction."""
+        created = []
+        for start in range(0, len(objects), self.batch_size):
+            with transaction.atomic():
+                created += model.objects.bulk_create(objects[start:start + self.batch_size])
+        return created
+
+    def random_date(self):
+        return self.end - timedelta(days=self.rng.randrange(self.days))
+
+    def random_amount(self):
+        # Log-normal, so most amounts are small with a long tail of large ones
+        cents = min(max(int(self.rng.lognormvariate(7.5, 1.0)), 1), 9_999_999)
+        return Decimal(cents) * CENT
+
+    def create_users(self):
+        count, prefix = self.options['users'], self.options['prefix']
+        # Hashed once; hashing per user would dominate the run
+        password = make_password(self.options['password'])
+        width = len(str(count - 1))
+        users = self.insert(User, [
+            User(username=f'{prefix}{i:0{width}}', email=f'{prefix}{i:0{width}}@example.com', password=password)
+            for i in range(count)
+        ])
+        self.stdout.write(f'Created {len(users)} users.')
+        return [user.pk for user in users]
+
+    def create_categories(self, user_ids):
+        names = CATEGORY_NAMES[:max(1, min(self.options['categories'], len(CATEGORY_NAMES)))]
+        created = self.insert(Category, [
+            Category(user_id=user_id, name=name) for user_id in user_ids for name in names
+        ])
+        categories = {}
+        for category in created:
+            categories.setdefault(category.user_id, []).append(category.pk)
+        self.stdout.write(f'Created {len(created)} categories.')
+        return categories
+
+    def create_expenses(self, user_ids, categories):
+        total, rng = self.options['expenses'], self.rng
+        skew = self.options['skew']
+        weights = list(accumulate(1 / (rank + 1) ** skew for rank in range(len(user_ids))))
+
+        done = 0
+        while done < total:
+            size = min(self.batch_size, total - done)
+            owners = rng.choices(user_ids, cum_weights=weights, k=size)
+            with transaction.atomic():
+                Expense.objects.bulk_create([
+                    Expense(
+                        user_id=owner, category_id=rng.choice(categories[owner]),
+                        title=f'{rng.choice(TITLES)} {done + i}', amount=self.random_amount(),
+                        date=self.random_date(),
+                    )
+                    for i, owner in enumerate(owners)
+                ])
+            done += size
+            self.stdout.write(f'Created {done}/{total} expenses...')
+
+    def create_groups(self, user_ids):
+        """Returns ``[(group_id, member_ids), ...]``."""
+        rng, options = self.rng, self.options
+        max_size = min(options['max_group_size'], len(user_ids))
+        member_lists = [
+            rng.sample(user_ids, max(2, min(max_size, int(options['group_size'] * rng.paretovariate(options['group_skew'])))))
+            for _ in range(options['groups'])
+        ]
+        groups = self.insert(Group, [
+            Group(name=f'{options["prefix"]} group {i}', created_by_id=members[0])
+            for i, members in enumerate(member_lists)
+        ])
+        memberships = self.insert(GroupMember, [
+            GroupMember(group_id=group.pk, user_id=user_id, is_admin=(user_id == members[0]))
+            for group, members in zip(groups, member_lists)
+            for user_id in members
+        ])
+        self.stdout.write(f'Created {len(groups)} groups with {len(memberships)} members.')
+        return [(group.pk, members) for group, members in zip(groups, member_lists)]
+
+    def create_shared_expenses(self, groups, categories):
+        total, rng = self.options['shared_expenses'], self.rng
+        if not groups:
+            return
+        # Bigger groups share more expenses
+        weights = list(accumulate(len(members) for _, members in groups))
+
+        done = splits_created = 0
+        while done < total:
+            size = min(self.batch_size, total - done)
+            chosen = rng.choices(groups, cum_weights=weights, k=size)
+            expenses, shares = [], []
+            for i, (group_id, members) in enumerate(chosen):
+                payer = rng.choice(members)
+                amount = self.random_amount()
+                split_type = rng.choice(SPLIT_TYPES)
+                if split_type == 'equal':
+                    weights_for = [1] * len(members)
+                else:
+                    weights_for = [rng.randint(1, 10) for _ in members]
+                percentages = [None] * len(members)
+                if split_type == 'percentage':
+                    percentages = weights_for = splits.allocate(100, weights_for)
+                expenses.append(SharedExpense(
+                    group_id=group_id, paid_by_id=payer, amount=amount, split_type=split_type,
+                    title=f'{rng.choice(TITLES)} {done + i}', date=self.random_date(),
+                    category_id=rng.choice(categories[payer]),
+                ))
+                shares.append(list(zip(members, splits.allocate(amount, weights_for), percentages)))
+
+            settled_at = timezone.now()
+            with transaction.atomic():
+                expenses = SharedExpense.objects.bulk_create(expenses)
+                split_rows = []
+                for expense, members in zip(expenses, shares):
+                    for user_id, share, percentage in members:
+                        settled = rng.random() < self.options['settled']
+                        split_rows.append(ExpenseSplit(
+                            expense_id=expense.pk, user_id=user_id, amount=share, percentage=percentage,
+                            is_settled=settled, settled_at=settled_at if settled else None,
+                        ))
+                ExpenseSplit.objects.bulk_create(split_rows, batch_size=self.batch_size)
+            done += size
+            splits_created += len(split_rows)
+            self.stdout.write(f'Created {done}/{total} shared expenses ({splits_created} splits)...')
@@ -0,0 +1,31 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from expenses import sharding
+
+
+class Command(BaseCommand):
+    help = ('Prepare the databases for sharding and move the expenses, categories and rollups '
+            'kept on the default database to their owners\' shards. Safe to run again.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows copied per INSERT.')
+
+    def handle(self, *args, **options):
+        if not sharding.enabled():
+            raise CommandError('Sharding is off; set SHARD_DATABASE_URLS.')
+
+        for alias in [DEFAULT_DB_ALIAS, *settings.EXPENSES_SHARDS]:
+            for field in sharding.drop_cross_shard_constraints(alias):
+                self.stdout.write(f'Dropped the constraint of {field.model._meta.label}.{field.name} on {alias}')
+
+        user_ids = set()
+        for model in sharding.sharded_models():
+            user_ids.update(
+                model._base_manager.using(DEFAULT_DB_ALIAS).order_by().values_list('user_id', flat=True).distinct()
+            )
+        for user_id in sorted(user_ids):
+            shard = sharding.adopt_global_rows(user_id, options['batch_size'])
+            self.stdout.write(f'Moved user {user_id} from {DEFAULT_DB_ALIAS} to {shard}')
+        self.stdout.write(self.style.SUCCESS(f'Moved {len(user_ids)} user(s) to their shards.'))
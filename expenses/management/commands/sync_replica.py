@@ -0,0 +1,33 @@
+import sqlite3
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from expenses import routers
+
+
+class Command(BaseCommand):
+    help = ('Copy the primary SQLite database over the replica, to try read-replica routing locally. '
+            'Real deployments use the database server\'s own replication.')
+
+    def handle(self, *args, **options):
+        if not routers.replica_configured():
+            raise CommandError('No replica configured; set REPLICA_DATABASE_URL.')
+        primary = connections[DEFAULT_DB_ALIAS]
+        replica = connections[routers.REPLICA_ALIAS]
+        if primary.vendor != 'sqlite' or replica.vendor != 'sqlite':
+            raise CommandError('sync_replica only copies SQLite databases.')
+        if primary.settings_dict['NAME'] == replica.settings_dict['NAME']:
+            raise CommandError('The primary and the replica are the same file.')
+
+        replica.close()
+        primary.ensure_connection()
+        # The backup API takes a consistent snapshot even while the primary is in use
+        target = sqlite3.connect(replica.settings_dict['NAME'])
+        try:
+            primary.connection.backup(target)
+        finally:
+            target.close()
+        self.stdout.write(self.style.SUCCESS(
+            f'Copied {primary.settings_dict["NAME"]} to {replica.settings_dict["NAME"]}.'
+        ))
@@ -0,0 +1,268 @@
+"""
+Request metrics in the Prometheus text format, shared between worker processes.
+
+Each process keeps its counters and histograms in memory and periodically
+writes them to ``<EXPENSES_METRICS_DIR>/<pid>.json`` (atomically, through a
+rename). ``/metrics`` sums the files of every process, so whichever gunicorn
+worker answers the scrape reports the totals for all of them. A worker's
+figures reach the other workers' scrapes at most
+``EXPENSES_METRICS_FLUSH_SECONDS`` late.
+
+When a scrape finds files of processes that have exited, it folds them
+into ``exited.json`` and deletes them, so the counters never go backwards
+and worker recycling doesn't grow the directory. A new process that gets a
+recycled pid before that happens carries on from the old file. Point
+``EXPENSES_METRICS_DIR`` at a directory that is emptied when the server is
+(re)deployed, and that only this host's processes write to.
+"""
+import glob
+import json
+import os
+try:
+    import fcntl
+except ImportError:  # Windows: files are never folded together
+    fcntl = None
+import threading
+import time
+from collections import defaultdict
+from contextvars import ContextVar
+
+from django.conf import settings
+
+
+# Upper bounds, in seconds, of the request duration histogram buckets
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Upper bounds of the queries-per-request histogram buckets
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+# name: (type, help, histogram buckets)
+METRICS = {
+    'expenses_http_requests_total': (
+        'counter', 'Requests served, by view, method and status code.', None),
+    'expenses_http_request_duration_seconds': (
+        'histogram', 'Time spent serving a request, by view.', DURATION_BUCKETS),
+    'expenses_http_request_queries': (
+        'histogram', 'Database queries issued per request, by view.', QUERY_BUCKETS),
+    'expenses_db_queries_total': (
+        'counter', 'Database queries issued, by view.', None),
+    'expenses_http_exceptions_total': (
+        'counter', 'Unhandled exceptions raised by views, by view and exception class.', None),
+    'expenses_cache_requests_total': (
+        'counter', 'Dashboard cache lookups, by view and outcome (hit or miss).', None),
+}
+
+# Name of the view being served, set by MetricsMiddleware
+current_view = ContextVar('expenses_metrics_view', default=None)
+
+_lock = threading.Lock()
+_pid = None
+_counters = defaultdict(float)
+_histograms = {}
+_last_flush = 0.0
+
+
+def _labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _check_process():
+    # Called with the lock held. A forked worker starts over from its own
+    # file instead of inheriting its parent's figures.
+    global _pid, _last_flush
+    pid = os.getpid()
+    if pid == _pid:
+        return
+    _pid = pid
+    _counters.clear()
+    _histograms.clear()
+    _last_flush = time.monotonic()
+    for name, labels, value in _read(_path(pid)):
+        _merge(_counters, _histograms, name, labels, value)
+
+
+def inc(name, labels, value=1):
+    """Add ``value`` to the counter ``name`` with ``labels``."""
+    with _lock:
+        _check_process()
+        _counters[(name, _labels_key(labels))] += value
+
+
+def observe(name, labels, value):
+    """Record ``value`` in the histogram ``name`` with ``labels``."""
+    buckets = METRICS[name][2]
+    with _lock:
+        _check_process()
+        key = (name, _labels_key(labels))
+        # Per-bucket (not cumulative) counts, then sum and count
+        state = _histograms.setdefault(key, [0] * len(buckets) + [0.0, 0])
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                state[i] += 1
+                break
+        state[-2] += value
+        state[-1] += 1
+
+
+def count_cache_lookup(outcome):
+    """Count a dashboard cache ``'hit'`` or ``'miss'`` against the current view."""
+    if settings.EXPENSES_METRICS:
+        inc('expenses_cache_requests_total', {'view': current_view.get() or '', 'outcome': outcome})
+
+
+# Figures of every process that has exited, folded together by collect()
+EXITED_FILE = 'exited.json'
+
+
+def _path(pid):
+    return os.path.join(settings.EXPENSES_METRICS_DIR, f'{pid}.json')
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Somebody else's process
+        return True
+    return True
+
+
+def _read(path):
+    """Yield ``(name, labels, value)`` from one process file; value is a list for histograms."""
+    try:
+        with open(path) as handle:
+            data = json.load(handle)
+    except (OSError, ValueError):
+        # Missing, or from a process that died mid-way through its first write
+        return
+    for name, labels, value in data:
+        yield name, tuple(tuple(pair) for pair in labels), value
+
+
+def _merge(counters, histograms, name, labels, value):
+    key = (name, labels)
+    if isinstance(value, list):
+        state = histograms.setdefault(key, [0] * len(value))
+        for i, part in enumerate(value):
+            state[i] += part
+    else:
+        counters[key] += value
+
+
+def flush(force=False):
+    """Write this process's figures to its file if the flush interval has passed."""
+    global _last_flush
+    with _lock:
+        _check_process()
+        now = time.monotonic()
+        if not force and now - _last_flush < settings.EXPENSES_METRICS_FLUSH_SECONDS:
+            return
+        _last_flush = now
+        data = [[name, labels, value] for (name, labels), value in _counters.items()]
+        data += [[name, labels, value] for (name, labels), value in _histograms.items()]
+
+    os.makedirs(settings.EXPENSES_METRICS_DIR, exist_ok=True)
+    _write(_path(_pid), data)
+
+
+def _write(path, data):
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'w') as handle:
+        json.dump(data, handle)
+    os.replace(tmp_path, path)
+
+
+def _sum(paths):
+    counters, histograms = defaultdict(float), {}
+    for path in paths:
+        for name, labels, value in _read(path):
+            _merge(counters, histograms, name, labels, value)
+    return counters, histograms
+
+
+def _fold_exited(directory):
+    # Called with the directory locked exclusively
+    exited = [
+        path for path in glob.glob(os.path.join(directory, '[0-9]*.json'))
+        if not _alive(int(os.path.basename(path)[:-len('.json')]))
+    ]
+    if not exited:
+        return
+    archive = os.path.join(directory, EXITED_FILE)
+    counters, histograms = _sum([archive, *exited])
+    data = [[name, labels, value] for (name, labels), value in counters.items()]
+    data += [[name, labels, value] for (name, labels), value in histograms.items()]
+    _write(archive, data)
+    for path in exited:
+        os.remove(path)
+
+
+def collect():
+    """Return ``(counters, histograms)`` summed over every process's file."""
+    flush(force=True)
+    directory = settings.EXPENSES_METRICS_DIR
+    if fcntl is None:
+        return _sum(glob.glob(os.path.join(directory, '*.json')))
+    # One scrape at a time, so none sees a process's figures both in its
+    # own file and in the folded one
+    with open(os.path.join(directory, '.lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            _fold_exited(directory)
+            return _sum(glob.glob(os.path.join(directory, '*.json')))
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def reset():
+    """Forget this process's figures and delete every process file."""
+    global _pid
+    with _lock:
+        _pid = None
+        _counters.clear()
+        _histograms.clear()
+    for path in glob.glob(os.path.join(settings.EXPENSES_METRICS_DIR, '*.json')):
+        os.remove(path)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in pairs) + '}'
+
+
+def _format_value(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def render():
+    """The aggregated metrics in the Prometheus text exposition format."""
+    counters, histograms = collect()
+    lines = []
+    for name, (kind, help_text, buckets) in METRICS.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        if kind == 'counter':
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+            continue
+        for (metric, labels), state in sorted(histograms.items()):
+            if metric != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(buckets, state):
+                cumulative += count
+                lines.append(f'{name}_bucket{_format_labels(labels, [("le", bound)])} {cumulative}')
+            lines.append(f'{name}_bucket{_format_labels(labels, [("le", "+Inf")])} {state[-1]}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {_format_value(float(state[-2]))}')
+            lines.append(f'{name}_count{_format_labels(labels)} {state[-1]}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,236 @@
+"""
+Opt-in per-request metrics, profiling and slow-query capture, and
+read-replica pinning.
+
+``ProfilingMiddleware`` times each sampled request and splits it into SQL
+(query count and time, through ``connection.execute_wrapper``), view and
+template rendering time (see ``profiling``). The figures are sent back in a ``Server-Timing``
+header, which browser dev tools display, and logged to the
+``expenses.profiling`` logger when a request is slower than the
+configured threshold. ``SlowQueryMiddleware`` feeds the slow-query
+buffer in ``diagnostics`` and ``MetricsMiddleware`` the process-shared
+counters in ``metrics``. All of them remove themselves at startup unless their
+setting turns them on, so they cost nothing when disabled.
+"""
+import logging
+import random
+import time
+from contextlib import ExitStack
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.utils.deprecation import MiddlewareMixin
+
+from . import caching, diagnostics, metrics, profiling, routers
+
+
+logger = logging.getLogger('expenses.profiling')
+
+
+class ProfilingMiddleware:
+    """
+    Add a ``Server-Timing`` header and a log line with the request's timings.
+
+    Settings: ``EXPENSES_PROFILING`` turns it on, a share of requests given
+    by ``EXPENSES_PROFILING_SAMPLE_RATE`` is profiled, and only those taking
+    at least ``EXPENSES_PROFILING_LOG_THRESHOLD_MS`` are logged. Template
+    time is only measured with ``expenses.profiling.DjangoTemplates`` as the
+    template backend.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.EXPENSES_PROFILING:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.sample_rate = settings.EXPENSES_PROFILING_SAMPLE_RATE
+        self.threshold = settings.EXPENSES_PROFILING_LOG_THRESHOLD_MS
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return self.get_response(request)
+
+        profile = profiling.Profile()
+        token = profiling.current_profile.set(profile)
+        try:
+            with ExitStack() as stack:
+                self.watch_queries(stack, profile)
+                response = self.get_response(request)
+        finally:
+            profiling.current_profile.reset(token)
+        return self.report(request, response, profile)
+
+    async def __acall__(self, request):
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return await self.get_response(request)
+
+        profile = profiling.Profile()
+        token = profiling.current_profile.set(profile)
+        # Database connections belong to a thread, and async views query
+        # from the one sync_to_async runs this request's ORM calls on
+        stack = ExitStack()
+        await sync_to_async(self.watch_queries)(stack, profile)
+        try:
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(stack.close)()
+            profiling.current_profile.reset(token)
+        return self.report(request, response, profile)
+
+    def watch_queries(self, stack, profile):
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(profile))
+
+    def report(self, request, response, profile):
+        finished = time.perf_counter()
+        if profile.view_started is not None:
+            profile.view = finished - profile.view_started
+        timings = profile.as_dict(finished - profile.started)
+        response['Server-Timing'] = ', '.join([
+            f'db;dur={timings["db_ms"]};desc="{profile.queries} queries"',
+            f'view;dur={timings["view_ms"]}',
+            f'tpl;dur={timings["template_ms"]}',
+            f'total;dur={timings["total_ms"]}',
+        ])
+        if timings['total_ms'] >= self.threshold:
+            match = request.resolver_match
+            logger.info(
+                '%s %s %s total=%.1fms db=%.1fms/%d view=%.1fms template=%.1fms',
+                request.method, request.path, response.status_code, timings['total_ms'],
+                timings['db_ms'], profile.queries, timings['view_ms'], timings['template_ms'],
+                extra={'profile': {
+                    'method': request.method,
+                    'path': request.path,
+                    'view': match.view_name if match else None,
+                    'status': response.status_code,
+                    **timings,
+                }},
+            )
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        profile = profiling.current_profile.get()
+        if profile is not None:
+            profile.view_started = time.perf_counter()
+        return None
+
+
+class SlowQueryMiddleware:
+    """
+    Capture queries slower than ``EXPENSES_SLOW_QUERY_MS`` with their plans.
+
+    Unset (the default), the middleware removes itself at startup.
+    """
+
+    def __init__(self, get_response):
+        if settings.EXPENSES_SLOW_QUERY_MS is None:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        threshold = settings.EXPENSES_SLOW_QUERY_MS
+        token = diagnostics.current_view.set(None)
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(
+                        diagnostics.SlowQueryRecorder(connection, threshold)
+                    ))
+                return self.get_response(request)
+        finally:
+            diagnostics.current_view.reset(token)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        match = request.resolver_match
+        diagnostics.current_view.set(match.view_name if match else view_func.__qualname__)
+        return None
+
+
+class QueryCounter:
+    """Database execute wrapper that counts the queries it sees."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class MetricsMiddleware:
+    """
+    Record latency, query count and errors per view for ``/metrics``.
+
+    Requests are labelled with the URL name they resolved to (namespaced,
+    as in ``admin:index``); anything that didn't resolve is ``unresolved``.
+    Off unless ``EXPENSES_METRICS`` is set.
+    """
+
+    def __init__(self, get_response):
+        if not settings.EXPENSES_METRICS:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        counter = QueryCounter()
+        token = metrics.current_view.set(None)
+        started = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(counter))
+                response = self.get_response(request)
+        finally:
+            metrics.current_view.reset(token)
+        duration = time.perf_counter() - started
+
+        match = request.resolver_match
+        view = match.view_name if match else 'unresolved'
+        metrics.inc('expenses_http_requests_total', {
+            'view': view, 'method': request.method, 'status': str(response.status_code),
+        })
+        metrics.observe('expenses_http_request_duration_seconds', {'view': view}, duration)
+        metrics.observe('expenses_http_request_queries', {'view': view}, counter.count)
+        metrics.inc('expenses_db_queries_total', {'view': view}, counter.count)
+        metrics.flush()
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        metrics.current_view.set(request.resolver_match.view_name)
+        return None
+
+    def process_exception(self, request, exception):
+        match = request.resolver_match
+        metrics.inc('expenses_http_exceptions_total', {
+            'view': match.view_name if match else 'unresolved',
+            'exception': type(exception).__name__,
+        })
+        return None
+
+
+class PrimaryPinMiddleware(MiddlewareMixin):
+    """
+    Pin users to the primary database for a while after any write request.
+
+    Expense and category changes pin their owner anyway, through the data
+    version bump; this also covers groups, shared expenses and settling
+    up. Removes itself unless a read replica is configured.
+    """
+
+    def __init__(self, get_response):
+        if not routers.replica_configured():
+            raise MiddlewareNotUsed
+        super().__init__(get_response)
+
+    def process_response(self, request, response):
+        if request.method not in ('GET', 'HEAD', 'OPTIONS', 'TRACE') and request.user.is_authenticated:
+            caching.pin_to_primary(request.user.pk)
+        return response
@@ -0,0 +1,74 @@
+# Generated by Django 5.1.14 on 2026-10-18 04:18
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncMonth
+
+
+def backfill_rollups(apps, schema_editor):
+    """Populate the rollups from the expenses recorded so far"""
+    Expense = apps.get_model('expenses', 'Expense')
+    DailySpending = apps.get_model('expenses', 'DailySpending')
+    MonthlySpending = apps.get_model('expenses', 'MonthlySpending')
+    # Each database's rollups come from its own expenses (shards migrate too)
+    db_alias = schema_editor.connection.alias
+
+    daily = Expense.objects.using(db_alias).values('user_id', 'category_id', 'date').annotate(
+        total=Sum('amount'), count=Count('id')
+    ).order_by()
+    DailySpending.objects.using(db_alias).bulk_create(
+        (DailySpending(**row) for row in daily.iterator()), batch_size=1000
+    )
+
+    monthly = Expense.objects.using(db_alias).annotate(month=TruncMonth('date')).values(
+        'user_id', 'category_id', 'month'
+    ).annotate(total=Sum('amount'), count=Count('id')).order_by()
+    MonthlySpending.objects.using(db_alias).bulk_create(
+        (MonthlySpending(**row) for row in monthly.iterator()), batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expenses', '0004_alter_group_members'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailySpending',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('total', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('count', models.IntegerField(default=0)),
+                ('category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_spending', to='expenses.category')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_spending', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name_plural': 'Daily spending',
+                'ordering': ['-date'],
+                'unique_together': {('user', 'category', 'date')},
+            },
+        ),
+        migrations.CreateModel(
+            name='MonthlySpending',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField()),
+                ('total', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('count', models.IntegerField(default=0)),
+                ('category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='monthly_spending', to='expenses.category')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='monthly_spending', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name_plural': 'Monthly spending',
+                'ordering': ['-month'],
+                'unique_together': {('user', 'category', 'month')},
+            },
+        ),
+        migrations.RunPython(backfill_rollups, migrations.RunPython.noop),
+    ]
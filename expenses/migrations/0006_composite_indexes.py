@@ -0,0 +1,39 @@
+# Generated by Django 5.1.14 on 2026-10-18 04:22
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expenses', '0005_spending_rollups'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='dailyspending',
+            index=models.Index(fields=['user', 'date'], name='dailyspending_user_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='expense',
+            index=models.Index(fields=['user', '-date', '-created_at', '-id'], name='expense_user_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='expense',
+            index=models.Index(fields=['user', 'category', 'date'], name='expense_user_category_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='expensesplit',
+            index=models.Index(fields=['user', 'is_settled'], name='split_user_settled_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='sharedexpense',
+            index=models.Index(fields=['group', '-date', '-created_at', '-id'], name='sharedexp_group_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='sharedexpense',
+            index=models.Index(fields=['group', 'paid_by'], name='sharedexp_group_payer_idx'),
+        ),
+    ]
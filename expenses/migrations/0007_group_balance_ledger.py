@@ -0,0 +1,56 @@
+# Generated by Django 5.1.14 on 2026-10-18 04:24
+
+import django.db.models.deletion
+from django.conf import settings
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import migrations, models
+from django.db.models import F, Sum
+
+
+def backfill_balances(apps, schema_editor):
+    """Build the ledger from the splits that are still open"""
+    ExpenseSplit = apps.get_model('expenses', 'ExpenseSplit')
+    GroupBalance = apps.get_model('expenses', 'GroupBalance')
+
+    open_splits = ExpenseSplit.objects.filter(is_settled=False).exclude(user=F('expense__paid_by'))
+    balances = defaultdict(Decimal)
+    for row in open_splits.values('expense__group_id', 'expense__paid_by_id').annotate(
+        total=Sum('amount')
+    ).order_by():
+        balances[(row['expense__group_id'], row['expense__paid_by_id'])] += row['total']
+    for row in open_splits.values('expense__group_id', 'user_id').annotate(
+        total=Sum('amount')
+    ).order_by():
+        balances[(row['expense__group_id'], row['user_id'])] -= row['total']
+
+    GroupBalance.objects.bulk_create([
+        GroupBalance(group_id=group_id, user_id=user_id, net=net)
+        for (group_id, user_id), net in balances.items()
+        if net
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expenses', '0006_composite_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GroupBalance',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('net', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('group', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='balances', to='expenses.group')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='group_balances', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('group', 'user')},
+            },
+        ),
+        migrations.RunPython(backfill_balances, migrations.RunPython.noop),
+    ]
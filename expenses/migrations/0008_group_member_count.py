@@ -0,0 +1,31 @@
+# Generated by Django 5.1.14 on 2026-10-18 04:27
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_member_counts(apps, schema_editor):
+    Group = apps.get_model('expenses', 'Group')
+    GroupMember = apps.get_model('expenses', 'GroupMember')
+    Group.objects.update(member_count=Coalesce(Subquery(
+        GroupMember.objects.filter(group=OuterRef('pk')).order_by().values('group').annotate(
+            count=Count('pk')
+        ).values('count')
+    ), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expenses', '0007_group_balance_ledger'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='group',
+            name='member_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(backfill_member_counts, migrations.RunPython.noop),
+    ]
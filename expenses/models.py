@@ -1,7 +1,10 @@
 from django.db import models
+from django.db.models.functions import Coalesce
 from django.utils import timezone
 from django.contrib.auth.models import User
 
+from .sharding import ShardedQuerySet
+
 
 class Category(models.Model):
     """
@@ -12,6 +15,8 @@ class Category(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='categories')
     created_at = models.DateTimeField(auto_now_add=True)
 
+    objects = ShardedQuerySet.as_manager()
+
     class Meta:
         verbose_name_plural = 'Categories'
         ordering = ['name']
@@ -34,8 +39,16 @@ class Expense(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = ShardedQuerySet.as_manager()
+
     class Meta:
         ordering = ['-date', '-created_at']
+        indexes = [
+            # Per-user listing, date-range filters and keyset pagination
+            models.Index(fields=['user', '-date', '-created_at', '-id'], name='expense_user_date_idx'),
+            # Per-user category grouping (rollup rebuilds, category totals)
+            models.Index(fields=['user', 'category', 'date'], name='expense_user_category_idx'),
+        ]
 
     def __str__(self):
         return f"{self.title} - ${self.amount}"
@@ -49,6 +62,8 @@ class Group(models.Model):
     description = models.TextField(blank=True)
     created_by = models.ForeignKey(User, on_delete=models.CASCADE, related_name='created_groups')
     members = models.ManyToManyField(User, through='GroupMember', related_name='user_groups')
+    # Kept in step by the GroupMember signal handlers
+    member_count = models.PositiveIntegerField(default=0, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -58,10 +73,32 @@ class Group(models.Model):
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        # member_count only changes through F() updates; saving a possibly
+        # stale instance must not write its copy back over them.
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name != 'member_count'
+            ]
+        super().save(*args, **kwargs)
+
     def get_member_count(self):
-        return self.members.count()
+        return self.member_count
+
+    @classmethod
+    def recount_members(cls, group_ids):
+        """Recompute member_count from GroupMember rows, e.g. after bulk inserts"""
+        cls.objects.filter(pk__in=group_ids).update(member_count=Coalesce(models.Subquery(
+            GroupMember.objects.filter(group=models.OuterRef('pk')).order_by().values('group').annotate(
+                count=models.Count('pk')
+            ).values('count')
+        ), 0))
 
     def get_total_expenses(self):
+        # group_list annotates the total so its rows don't query one by one
+        if hasattr(self, 'total_spent'):
+            return self.total_spent
         return self.shared_expenses.aggregate(total=models.Sum('amount'))['total'] or 0
 
 
@@ -96,6 +133,7 @@ class SharedExpense(models.Model):
     amount = models.DecimalField(max_digits=10, decimal_places=2)
     group = models.ForeignKey(Group, on_delete=models.CASCADE, related_name='shared_expenses')
     paid_by = models.ForeignKey(User, on_delete=models.CASCADE, related_name='paid_expenses')
+    # The payer's category, on the payer's shard when sharding is on
     category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='shared_expenses', null=True, blank=True)
     date = models.DateField(default=timezone.now)
     split_type = models.CharField(max_length=20, choices=SPLIT_CHOICES, default='equal')
@@ -104,6 +142,12 @@ class SharedExpense(models.Model):
 
     class Meta:
         ordering = ['-date', '-created_at']
+        indexes = [
+            # Group expense listing and keyset pagination
+            models.Index(fields=['group', '-date', '-created_at', '-id'], name='sharedexp_group_date_idx'),
+            # Per-member paid totals within a group
+            models.Index(fields=['group', 'paid_by'], name='sharedexp_group_payer_idx'),
+        ]
 
     def __str__(self):
         return f"{self.title} - ${self.amount} ({self.group.name})"
@@ -116,6 +160,28 @@ class SharedExpense(models.Model):
                 return self.amount / member_count
         return 0
 
+    @classmethod
+    def get_user_shares(cls, expenses, user):
+        """
+        Map each expense's id to ``user``'s share, with one query for the lot.
+
+        Same rules as get_user_share: the user's split if there is one, else
+        an equal share for equally split expenses, else nothing.
+        """
+        expenses = list(expenses)
+        split_amounts = dict(ExpenseSplit.objects.filter(
+            expense__in=expenses, user=user
+        ).values_list('expense_id', 'amount'))
+        shares = {}
+        for expense in expenses:
+            if expense.pk in split_amounts:
+                shares[expense.pk] = split_amounts[expense.pk]
+            elif expense.split_type == 'equal':
+                shares[expense.pk] = expense.get_split_amount_per_person()
+            else:
+                shares[expense.pk] = 0
+        return shares
+
     def get_user_share(self, user):
         """Get a specific user's share of this expense"""
         try:
@@ -140,6 +206,108 @@ class ExpenseSplit(models.Model):
 
     class Meta:
         unique_together = ['expense', 'user']
+        indexes = [
+            # A member's open splits, e.g. before leaving a group
+            models.Index(fields=['user', 'is_settled'], name='split_user_settled_idx'),
+        ]
 
     def __str__(self):
         return f"{self.user.username} owes ${self.amount} for {self.expense.title}"
+
+
+class DailySpending(models.Model):
+    """
+    Per-user, per-category spending rolled up by day.
+
+    Maintained incrementally by the Expense signal handlers in
+    ``expenses.rollups`` so dashboard totals never need to scan Expense rows.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='daily_spending')
+    category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='daily_spending')
+    date = models.DateField()
+    total = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    count = models.IntegerField(default=0)
+
+    objects = ShardedQuerySet.as_manager()
+
+    class Meta:
+        ordering = ['-date']
+        unique_together = ['user', 'category', 'date']
+        indexes = [
+            models.Index(fields=['user', 'date'], name='dailyspending_user_date_idx'),
+        ]
+        verbose_name_plural = 'Daily spending'
+
+    def __str__(self):
+        return f"{self.user_id}/{self.category_id} {self.date}: ${self.total}"
+
+
+class MonthlySpending(models.Model):
+    """
+    Per-user, per-category spending rolled up by month.
+
+    ``month`` is always the first day of the month.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='monthly_spending')
+    category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='monthly_spending')
+    month = models.DateField()
+    total = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    count = models.IntegerField(default=0)
+
+    objects = ShardedQuerySet.as_manager()
+
+    class Meta:
+        ordering = ['-month']
+        unique_together = ['user', 'category', 'month']
+        verbose_name_plural = 'Monthly spending'
+
+    def __str__(self):
+        return f"{self.user_id}/{self.category_id} {self.month:%Y-%m}: ${self.total}"
+
+
+class GroupBalance(models.Model):
+    """
+    A member's outstanding net position in a group.
+
+    Positive means the rest of the group owes the member money. Only
+    unsettled splits between different people count. Maintained by
+    ``expenses.balances`` alongside every split write and settlement.
+    """
+    group = models.ForeignKey(Group, on_delete=models.CASCADE, related_name='balances')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='group_balances')
+    net = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        unique_together = ['group', 'user']
+
+    def __str__(self):
+        return f"{self.user.username} in {self.group.name}: ${self.net}"
+
+
+class UserShard(models.Model):
+    """
+    The shard holding a user's categories, expenses and rollups.
+
+    ``moving_to`` is set while ``rebalance_shards`` copies the user to
+    another shard. Lives on the global shard; see ``expenses.sharding``.
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='shard')
+    shard = models.CharField(max_length=50, db_index=True)
+    moving_to = models.CharField(max_length=50, blank=True)
+
+    def __str__(self):
+        return f"{self.user_id} on {self.shard}"
+
+
+class IdBlock(models.Model):
+    """
+    Next free primary key of a sharded model, shared by every shard.
+
+    Processes reserve ids from here in blocks so rows created on different
+    shards never share a key.
+    """
+    name = models.CharField(max_length=100, primary_key=True)
+    next_id = models.BigIntegerField()
+
+    def __str__(self):
+        return f"{self.name}: {self.next_id}"
@@ -0,0 +1,161 @@
+"""
+Keyset (cursor) pagination for the expense lists.
+
+Pages are fetched by seeking past the last row seen on the ordering key
+rather than with OFFSET, so page 500 costs the same as page 1. Cursors
+are opaque, URL-safe tokens encoding the boundary row's key and the
+direction of travel.
+"""
+import base64
+import json
+from functools import reduce
+from operator import or_
+
+from django.conf import settings
+from django.db.models import Q
+
+
+# Matches Expense/SharedExpense Meta.ordering, with id as the tiebreaker
+DEFAULT_KEYSET = ('date', 'created_at', 'id')
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+class KeysetPage:
+    """One page of results plus the cursors to reach its neighbours."""
+
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+def encode_cursor(obj, direction, keyset=DEFAULT_KEYSET):
+    values = [obj._meta.get_field(name).value_to_string(obj) for name in keyset]
+    payload = json.dumps([direction, *values], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor, model, keyset=DEFAULT_KEYSET):
+    """Return ``(direction, values)`` for a cursor, raising InvalidCursor if it is malformed."""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        direction, *raw = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        if direction not in ('next', 'prev') or len(raw) != len(keyset):
+            raise ValueError(cursor)
+        values = [model._meta.get_field(name).to_python(value)
+                  for name, value in zip(keyset, raw)]
+    except Exception as exc:
+        raise InvalidCursor(cursor) from exc
+    if any(value is None for value in values):
+        raise InvalidCursor(cursor)
+    return direction, values
+
+
+def _seek(keyset, values, lookup):
+    """
+    Rows strictly beyond ``values`` in lexicographic key order.
+
+    Also bounds the leading column directly so the database can turn the
+    condition into an index range scan.
+    """
+    branches = []
+    for i, name in enumerate(keyset):
+        equal = {keyset[j]: values[j] for j in range(i)}
+        branches.append(Q(**equal, **{f'{name}__{lookup}': values[i]}))
+    bound = {'lt': 'lte', 'gt': 'gte'}[lookup]
+    return Q(**{f'{keyset[0]}__{bound}': values[0]}) & reduce(or_, branches)
+
+
+def _page_query(queryset, cursor, page_size, keyset):
+    """Return ``(direction, queryset)`` fetching one row more than a page."""
+    descending = [f'-{name}' for name in keyset]
+    if cursor is None:
+        return 'next', queryset.order_by(*descending)[:page_size + 1]
+    direction, values = decode_cursor(cursor, queryset.model, keyset)
+    if direction == 'next':
+        return direction, queryset.filter(_seek(keyset, values, 'lt')).order_by(*descending)[:page_size + 1]
+    return direction, queryset.filter(_seek(keyset, values, 'gt')).order_by(*keyset)[:page_size + 1]
+
+
+def _build_page(rows, direction, cursor, page_size, keyset):
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    if direction == 'prev':
+        rows.reverse()
+
+    if not rows:
+        return KeysetPage([])
+    if direction == 'next':
+        next_cursor = encode_cursor(rows[-1], 'next', keyset) if has_more else None
+        previous_cursor = encode_cursor(rows[0], 'prev', keyset) if cursor else None
+    else:
+        next_cursor = encode_cursor(rows[-1], 'next', keyset)
+        previous_cursor = encode_cursor(rows[0], 'prev', keyset) if has_more else None
+    return KeysetPage(rows, next_cursor, previous_cursor)
+
+
+def paginate(queryset, cursor=None, page_size=None, keyset=DEFAULT_KEYSET):
+    """
+    Return a KeysetPage of ``queryset`` ordered newest first on ``keyset``.
+
+    Any ordering already on the queryset is replaced.
+    """
+    page_size = page_size or settings.EXPENSES_PAGE_SIZE
+    direction, rows = _page_query(queryset, cursor, page_size, keyset)
+    return _build_page(list(rows), direction, cursor, page_size, keyset)
+
+
+async def apaginate(queryset, cursor=None, page_size=None, keyset=DEFAULT_KEYSET):
+    """Async version of paginate()."""
+    page_size = page_size or settings.EXPENSES_PAGE_SIZE
+    direction, rows = _page_query(queryset, cursor, page_size, keyset)
+    return _build_page([row async for row in rows], direction, cursor, page_size, keyset)
+
+
+def _request_params(request):
+    try:
+        page_size = int(request.GET.get('page_size', settings.EXPENSES_PAGE_SIZE))
+    except ValueError:
+        page_size = settings.EXPENSES_PAGE_SIZE
+    page_size = max(1, min(page_size, settings.EXPENSES_MAX_PAGE_SIZE))
+    return request.GET.get('cursor') or None, page_size
+
+
+def paginate_request(request, queryset, keyset=DEFAULT_KEYSET):
+    """
+    Paginate using the ``cursor`` and ``page_size`` query parameters.
+
+    A malformed cursor falls back to the first page, and ``page_size`` is
+    capped at ``EXPENSES_MAX_PAGE_SIZE``.
+    """
+    cursor, page_size = _request_params(request)
+    try:
+        return paginate(queryset, cursor, page_size, keyset)
+    except InvalidCursor:
+        return paginate(queryset, None, page_size, keyset)
+
+
+async def apaginate_request(request, queryset, keyset=DEFAULT_KEYSET):
+    """Async version of paginate_request()."""
+    cursor, page_size = _request_params(request)
+    try:
+        return await apaginate(queryset, cursor, page_size, keyset)
+    except InvalidCursor:
+        return await apaginate(queryset, None, page_size, keyset)
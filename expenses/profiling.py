@@ -0,0 +1,77 @@
+"""
+Per-request timings for ``ProfilingMiddleware``.
+
+The middleware puts a ``Profile`` in ``current_profile`` for each sampled
+request. SQL is timed by installing the profile as a database execute
+wrapper, and template rendering by the ``DjangoTemplates`` backend below,
+which ``TEMPLATES`` uses in place of Django's own. Outside a profiled
+request the backend behaves exactly like Django's.
+"""
+import time
+from contextvars import ContextVar
+
+from django.template.backends import django as django_backend
+
+
+# The profile of the request being handled in this thread/task, if sampled
+current_profile = ContextVar('expenses_profile', default=None)
+
+
+class Profile:
+    """Timings collected for one request, in seconds."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db = 0.0
+        self.view_started = None
+        self.view = 0.0
+        self.template = 0.0
+        self._template_depth = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        # Installed as a database execute wrapper. Async requests share the
+        # ORM's thread, so queries made for other requests are passed over.
+        if current_profile.get() is not self:
+            return execute(sql, params, many, context)
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db += time.perf_counter() - started
+            self.queries += 1
+
+    def as_dict(self, total):
+        return {
+            'total_ms': round(total * 1000, 2),
+            'db_ms': round(self.db * 1000, 2),
+            'db_queries': self.queries,
+            'view_ms': round(self.view * 1000, 2),
+            'template_ms': round(self.template * 1000, 2),
+        }
+
+
+class Template(django_backend.Template):
+    def render(self, context=None, request=None):
+        profile = current_profile.get()
+        # Only the outermost render is timed, so templates rendered from
+        # inside other templates are not counted twice
+        if profile is None or profile._template_depth:
+            return super().render(context, request)
+        profile._template_depth += 1
+        started = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            profile.template += time.perf_counter() - started
+            profile._template_depth -= 1
+
+
+class DjangoTemplates(django_backend.DjangoTemplates):
+    """Django's template backend, with rendering timed for profiled requests."""
+
+    def from_string(self, template_code):
+        return Template(super().from_string(template_code).template, self)
+
+    def get_template(self, template_name):
+        return Template(super().get_template(template_name).template, self)
@@ -0,0 +1,267 @@
+"""
+Incrementally maintained spending rollups.
+
+Every Expense write is folded into DailySpending and MonthlySpending so the
+dashboard can chart any period by reading a handful of pre-aggregated rows
+instead of every expense the user has ever recorded. A user's rollups live
+on the same shard as their expenses, so the writes below are grouped by
+database.
+"""
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal
+
+from django.db import IntegrityError, connections, transaction
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncMonth
+
+from . import bulk, sharding
+from .models import Expense, DailySpending, MonthlySpending
+
+
+def month_start(day):
+    """Return the first day of the month containing ``day``."""
+    return day.replace(day=1)
+
+
+def spending_queryset(user, start=None, end=None):
+    """
+    Return the rollup rows covering ``start <= date <= end`` for ``user``.
+
+    Unbounded ranges are answered from the monthly table, anything else from
+    the daily one.
+    """
+    return _spending(start, end, user=user)
+
+
+def users_spending(user_ids, start=None, end=None):
+    """``spending_queryset`` for several users who live on the same shard."""
+    return _spending(start, end, user_id__in=user_ids)
+
+
+def _spending(start, end, **users):
+    if start is None and end is None:
+        return MonthlySpending.objects.filter(**users)
+    queryset = DailySpending.objects.filter(**users)
+    if start is not None:
+        queryset = queryset.filter(date__gte=start)
+    if end is not None:
+        queryset = queryset.filter(date__lte=end)
+    return queryset
+
+
+def expense_key(expense):
+    """
+    Return ``((user_id, category_id, date), amount)`` for an expense.
+
+    Values are normalised through the model fields because an unsaved
+    instance may still hold the raw ``timezone.now`` default or a string
+    amount.
+    """
+    date = Expense._meta.get_field('date').to_python(expense.date)
+    amount = Expense._meta.get_field('amount').to_python(expense.amount)
+    return (expense.user_id, expense.category_id, date), amount
+
+
+def apply_deltas(deltas):
+    """
+    Fold ``{(user_id, category_id, date): (amount, count)}`` into the rollups.
+
+    Positive deltas create missing rows; negative deltas only touch rows
+    that already exist, so cascades that remove the rollup rows first are
+    harmless. Rows whose count drops to zero are removed.
+    """
+    daily = defaultdict(lambda: [Decimal('0'), 0])
+    monthly = defaultdict(lambda: [Decimal('0'), 0])
+    for (user_id, category_id, day), (amount, count) in deltas.items():
+        if not amount and not count:
+            continue
+        for bucket, key in ((daily, day), (monthly, month_start(day))):
+            entry = bucket[(user_id, category_id, key)]
+            entry[0] += amount
+            entry[1] += count
+
+    for using, user_ids in sharding.group_by_database({key[0] for key in daily}, for_write=True).items():
+        with transaction.atomic(using=using):
+            _apply(DailySpending, 'date', _for_users(daily, user_ids), using)
+            _apply(MonthlySpending, 'month', _for_users(monthly, user_ids), using)
+
+
+def _for_users(deltas, user_ids):
+    return {key: value for key, value in deltas.items() if key[0] in user_ids}
+
+
+def _update_rows(model, field, rows, using):
+    # The rows are locked and already hold their new totals. Where the
+    # database supports it, writing them back as an upsert is a plain
+    # multi-row INSERT, far cheaper than bulk_update's CASE expressions.
+    if connections[using].features.supports_update_conflicts_with_target:
+        model.objects.using(using).bulk_create(
+            rows, batch_size=500, update_conflicts=True,
+            unique_fields=['user', 'category', field], update_fields=['total', 'count'],
+        )
+    else:
+        model.objects.using(using).bulk_update(rows, ['total', 'count'], batch_size=500)
+
+
+def _apply(model, field, deltas, using, retry=True):
+    if not deltas:
+        return
+    user_ids = {key[0] for key in deltas}
+    category_ids = {key[1] for key in deltas}
+    days = [key[2] for key in deltas]
+    # Plain tuples: a wide date range can lock far more rows than change
+    existing = {
+        (user_id, category_id, day): (pk, total, count)
+        for pk, user_id, category_id, day, total, count in model.objects.using(using).select_for_update().filter(
+            user_id__in=user_ids,
+            category_id__in=category_ids,
+            **{f'{field}__range': (min(days), max(days))},
+        ).values_list('pk', 'user_id', 'category_id', field, 'total', 'count')
+    }
+
+    changed, created, emptied = [], [], []
+    for key, (amount, count) in deltas.items():
+        row = existing.get(key)
+        if row is None:
+            if count > 0:
+                created.append(model(
+                    user_id=key[0], category_id=key[1], total=amount, count=count,
+                    **{field: key[2]}
+                ))
+            continue
+        pk, total, current = row
+        if current + count <= 0:
+            emptied.append(pk)
+        else:
+            changed.append(model(
+                pk=pk, user_id=key[0], category_id=key[1], total=total + amount,
+                count=current + count, **{field: key[2]}
+            ))
+
+    if changed:
+        _update_rows(model, field, changed, using)
+    if emptied:
+        model.objects.using(using).filter(pk__in=emptied).delete()
+    if created:
+        try:
+            with transaction.atomic(using=using):
+                model.objects.using(using).bulk_create(created, batch_size=500)
+        except IntegrityError:
+            # A concurrent writer created one of the rows first; the retry
+            # finds it and updates it under lock instead.
+            if not retry:
+                raise
+            _apply(model, field, {
+                (row.user_id, row.category_id, getattr(row, field)): (row.total, row.count)
+                for row in created
+            }, using, retry=False)
+
+
+def record_expense(expense, previous=None):
+    """
+    Apply a saved expense to the rollups.
+
+    ``previous`` is the ``(key, amount)`` pair captured before an update so
+    the old contribution can be removed.
+    """
+    deltas = defaultdict(lambda: [Decimal('0'), 0])
+    if previous is not None:
+        key, amount = previous
+        deltas[key][0] -= amount
+        deltas[key][1] -= 1
+    key, amount = expense_key(expense)
+    deltas[key][0] += amount
+    deltas[key][1] += 1
+    apply_deltas(deltas)
+
+
+def forget_expense(expense):
+    """Remove a deleted expense from the rollups."""
+    key, amount = expense_key(expense)
+    apply_deltas({key: (-amount, -1)})
+
+
+def _daily_totals(expenses):
+    return expenses.values('user_id', 'category_id', 'date').annotate(
+        total=Sum('amount'), count=Count('id')
+    ).order_by()
+
+
+def _monthly_totals(expenses):
+    return expenses.annotate(month=TruncMonth('date')).values(
+        'user_id', 'category_id', 'month'
+    ).annotate(total=Sum('amount'), count=Count('id')).order_by()
+
+
+def _keyed(totals, field):
+    return {
+        (row['user_id'], row['category_id'], row[field]): (row['total'], row['count'])
+        for row in totals
+    }
+
+
+def _actual_rows(model, field, user_ids, using):
+    return {
+        (row.user_id, row.category_id, getattr(row, field)): (row.total, row.count)
+        for row in model.objects.using(using).filter(user_id__in=user_ids)
+    }
+
+
+def _next_month(day):
+    return (month_start(day) + timedelta(days=31)).replace(day=1)
+
+
+def rebuild(user_ids, start=None, end=None):
+    """
+    Recompute the rollups for ``user_ids`` from the Expense table.
+
+    With ``start`` and/or ``end``, only the daily rows in that range and the
+    monthly rows of the months it touches are replaced; bulk writers such as
+    the CSV import skip per-row upkeep and rebuild just the span they wrote.
+    """
+    day_range, month_range, month_days = {}, {}, {}
+    if start is not None:
+        day_range['date__gte'] = start
+        month_range['month__gte'] = month_days['date__gte'] = month_start(start)
+    if end is not None:
+        day_range['date__lte'] = end
+        month_range['month__lte'] = month_start(end)
+        month_days['date__lt'] = _next_month(end)
+
+    daily_rows = monthly_rows = 0
+    for shard_user_ids in sharding.group_by_database(user_ids).values():
+        with sharding.atomic(*shard_user_ids) as using:
+            expenses = Expense.objects.using(using).filter(user_id__in=shard_user_ids)
+            DailySpending.objects.using(using).filter(user_id__in=shard_user_ids, **day_range).delete()
+            MonthlySpending.objects.using(using).filter(user_id__in=shard_user_ids, **month_range).delete()
+            daily_rows += bulk.insert_from_query(
+                DailySpending, ('user', 'category', 'date', 'total', 'count'),
+                _daily_totals(expenses.filter(**day_range)), using,
+            )
+            monthly_rows += bulk.insert_from_query(
+                MonthlySpending, ('user', 'category', 'month', 'total', 'count'),
+                _monthly_totals(expenses.filter(**month_days)), using,
+            )
+    return daily_rows, monthly_rows
+
+
+def find_drift(user_ids):
+    """
+    Compare the rollups for ``user_ids`` against the Expense table.
+
+    Returns a list of ``(table, key, expected, actual)`` tuples, where a
+    missing side is reported as ``None``.
+    """
+    drift = []
+    for using, shard_user_ids in sharding.group_by_database(user_ids).items():
+        expenses = Expense.objects.using(using).filter(user_id__in=shard_user_ids)
+        daily = _keyed(_daily_totals(expenses), 'date')
+        monthly = _keyed(_monthly_totals(expenses), 'month')
+        for model, field, expected in ((DailySpending, 'date', daily),
+                                       (MonthlySpending, 'month', monthly)):
+            actual = _actual_rows(model, field, shard_user_ids, using)
+            for key in sorted(expected.keys() | actual.keys(), key=str):
+                if expected.get(key) != actual.get(key):
+                    drift.append((model._meta.model_name, key, expected.get(key), actual.get(key)))
+    return drift
@@ -0,0 +1,113 @@
+"""
+Read-replica routing for analytics reads, and per-user shard routing.
+
+Nothing goes to the replica by default. Code opts in with
+``read_from_replica(user_id)`` or the ``replica_reads`` view decorator,
+and only reads made outside a transaction on the primary are sent there.
+Writes always go to the primary.
+
+A replica lags the primary, so a user who has just changed their data is
+pinned to the primary for ``EXPENSES_REPLICA_PIN_SECONDS`` (see
+``caching.pin_to_primary``) and reads their own writes back.
+
+``ShardRouter`` comes first and only answers for the sharded per-user
+models; see ``expenses.sharding``.
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from . import caching, sharding
+
+
+REPLICA_ALIAS = 'replica'
+
+# Alias reads are sent to inside read_from_replica()
+_read_alias = ContextVar('expenses_read_alias', default=None)
+
+
+def replica_configured():
+    return REPLICA_ALIAS in connections
+
+
+@contextmanager
+def read_from_replica(user_id):
+    """
+    Send reads in the block to the replica, if there is one and ``user_id``
+    hasn't written recently.
+    """
+    if not replica_configured() or caching.pinned_to_primary(user_id):
+        yield
+        return
+    token = _read_alias.set(REPLICA_ALIAS)
+    try:
+        yield
+    finally:
+        _read_alias.reset(token)
+
+
+def replica_reads(view):
+    """Run a read-only view's queries, including its template's, on the replica."""
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        with read_from_replica(request.user.pk):
+            response = view(request, *args, **kwargs)
+            # Template responses query while rendering, so render here
+            if hasattr(response, 'render') and not response.is_rendered:
+                response.render()
+        return response
+    return wrapper
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        alias = _read_alias.get()
+        # Inside a transaction on the primary, reads must see its writes
+        if alias is None or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return None
+        return alias
+
+    def db_for_write(self, model, **hints):
+        # Explicit, or Django would write an instance back to the replica
+        # it was read from
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if {obj1._state.db, obj2._state.db} <= {DEFAULT_DB_ALIAS, REPLICA_ALIAS}:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # The replica gets its schema from the primary
+        if db == REPLICA_ALIAS:
+            return False
+        return None
+
+
+class ShardRouter:
+    """Send per-user models to their owner's shard. Inactive without shards."""
+
+    def _route(self, model, hints, for_write):
+        if not sharding.enabled():
+            return None
+        if sharding.is_sharded(model):
+            return sharding.db_for_hints(hints, for_write)
+        instance = hints.get('instance')
+        # Following a relation from a sharded row back to global data
+        if instance is not None and sharding.is_sharded(instance):
+            return DEFAULT_DB_ALIAS
+        return None
+
+    def db_for_read(self, model, **hints):
+        return self._route(model, hints, for_write=False)
+
+    def db_for_write(self, model, **hints):
+        return self._route(model, hints, for_write=True)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Sharded rows point at users and categories on other databases
+        if sharding.enabled():
+            return True
+        return None
@@ -0,0 +1,69 @@
+"""
+Turn a group's net balances into a short list of "who pays whom" transfers.
+
+Finding the true minimum number of transfers is NP-hard, so this uses the
+usual near-optimal approach: first pair off debtors and creditors whose
+amounts match exactly, then repeatedly settle the largest debt against the
+largest credit using two heaps. Each greedy step clears at least one
+member, so a group of n members never needs more than n - 1 transfers,
+and the whole plan takes O(n log n) time.
+
+All arithmetic is done in integer cents, so the plan balances to the cent.
+"""
+import heapq
+from collections import defaultdict, namedtuple
+from decimal import Decimal
+
+
+Transfer = namedtuple('Transfer', 'debtor creditor amount')
+
+CENT = Decimal('0.01')
+
+
+def to_cents(amount):
+    return int(Decimal(amount).quantize(CENT) / CENT)
+
+
+def simplify_debts(balances):
+    """
+    Plan transfers that bring every balance in ``balances`` to zero.
+
+    ``balances`` maps any key (user id, username, ...) to a net amount;
+    positive means the member is owed money. Returns a list of Transfer
+    tuples with Decimal amounts. Raises ValueError if the balances do not
+    sum to zero once rounded to cents.
+    """
+    cents = {key: to_cents(amount) for key, amount in balances.items()}
+    if sum(cents.values()) != 0:
+        raise ValueError('Balances must sum to zero')
+
+    transfers = []
+
+    # Exact matches settle two members with a single transfer
+    creditors_by_amount = defaultdict(list)
+    for key, amount in cents.items():
+        if amount > 0:
+            creditors_by_amount[amount].append(key)
+    for key, amount in cents.items():
+        if amount < 0 and creditors_by_amount.get(-amount):
+            creditor = creditors_by_amount[-amount].pop()
+            transfers.append((key, creditor, -amount))
+            cents[key] = cents[creditor] = 0
+
+    # Heap entries carry an insertion index so keys never need comparing
+    creditors = [(-amount, i, key) for i, (key, amount) in enumerate(cents.items()) if amount > 0]
+    debtors = [(amount, i, key) for i, (key, amount) in enumerate(cents.items()) if amount < 0]
+    heapq.heapify(creditors)
+    heapq.heapify(debtors)
+
+    while creditors and debtors:
+        credit, ci, creditor = heapq.heappop(creditors)
+        debt, di, debtor = heapq.heappop(debtors)
+        amount = min(-credit, -debt)
+        transfers.append((debtor, creditor, amount))
+        if -credit > amount:
+            heapq.heappush(creditors, (credit + amount, ci, creditor))
+        if -debt > amount:
+            heapq.heappush(debtors, (debt + amount, di, debtor))
+
+    return [Transfer(debtor, creditor, Decimal(amount) * CENT) for debtor, creditor, amount in transfers]
@@ -0,0 +1,526 @@
+"""
+Horizontal sharding of per-user data by user id.
+
+Categories, expenses and their spending rollups live on one of the
+databases named in ``EXPENSES_SHARDS``. Everything else, including users,
+groups, shared expenses and sessions, stays on ``default``, the global
+shard. A user's rows are always kept together, so every per-user query and
+transaction runs against a single database.
+
+``UserShard`` on the global shard records where each user lives. A user is
+placed on ``shards[user_id % len(shards)]`` the first time they are looked
+up, and ``rebalance_shards`` moves them later. Placements are cached in each
+process for ``EXPENSES_SHARD_MAP_TTL`` seconds; writes go through
+``atomic()``, which reads the placement afresh under a row lock.
+
+``ShardRouter`` sends a query to its owner's shard when it knows the owner:
+from the instance a query starts from, such as ``user.expenses`` or
+``expense.category``, or from a ``user``/``user_id`` lookup passed to
+``ShardedQuerySet.filter()``. ``Expense.objects.filter(user=user)`` reads
+the right shard that way. A query that names no owner goes to ``default``,
+whose sharded tables are empty.
+
+Primary keys of sharded rows come from ``IdBlock`` on the global shard, so
+they are unique across shards and survive a move. Every database carries
+the full schema, but only the sharded tables are used on the shards.
+``shard_existing_rows`` turns sharding on: it drops the constraints of the
+keys that now cross databases, and moves the rows stored on ``default``
+until then to their owners' shards.
+
+With ``EXPENSES_SHARDS`` empty (the default) none of this is active.
+"""
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, connections, models, transaction
+
+
+# Models whose rows live on their owner's shard, in the order they are copied
+SHARDED_MODELS = (
+    'expenses.category', 'expenses.expense', 'expenses.dailyspending', 'expenses.monthlyspending',
+)
+# Lookups that name the owner of the rows a query reads
+USER_LOOKUPS = ('user', 'user_id', 'user__pk', 'user__id')
+# Placements kept in memory per process before the cache starts over
+MAX_CACHED_PLACEMENTS = 10000
+
+
+class CrossShardQuery(Exception):
+    """A single query asked for rows of users who live on different shards."""
+
+
+class UserMoving(Exception):
+    """The user is being moved to another shard, so their data is read-only."""
+
+
+_lock = threading.Lock()
+_pid = None
+# user_id: (expires, shard, moving_to)
+_placements = {}
+# model label: (next id, end of the reserved block)
+_id_blocks = {}
+
+
+def enabled():
+    return bool(settings.EXPENSES_SHARDS)
+
+
+def databases():
+    """Every database that may hold sharded rows."""
+    return list(settings.EXPENSES_SHARDS) or [DEFAULT_DB_ALIAS]
+
+
+def is_sharded(model):
+    """Whether ``model`` (a class or an instance) is stored on its owner's shard."""
+    return model._meta.label_lower in SHARDED_MODELS
+
+
+def sharded_models():
+    from django.apps import apps
+    return [apps.get_model(label) for label in SHARDED_MODELS]
+
+
+def _check_process():
+    # Called with the lock held. A forked worker must not hand out ids
+    # from a block its parent reserved.
+    global _pid
+    pid = os.getpid()
+    if pid != _pid:
+        _pid = pid
+        _placements.clear()
+        _id_blocks.clear()
+
+
+def initial_shard(user_id):
+    shards = settings.EXPENSES_SHARDS
+    return shards[user_id % len(shards)]
+
+
+def placement(user_id):
+    """Return ``(shard, moving_to)`` for ``user_id``, placing new users."""
+    from .models import UserShard
+
+    now = time.monotonic()
+    with _lock:
+        _check_process()
+        cached = _placements.get(user_id)
+    if cached is not None and cached[0] > now:
+        return cached[1:]
+
+    placements = UserShard.objects.using(DEFAULT_DB_ALIAS)
+    row = placements.filter(user_id=user_id).values_list('shard', 'moving_to').first()
+    if row is None:
+        row = (initial_shard(user_id), '')
+        try:
+            with transaction.atomic(using=DEFAULT_DB_ALIAS):
+                placements.create(user_id=user_id, shard=row[0])
+        except IntegrityError:
+            # Placed by a concurrent request, or not a user at all
+            row = placements.filter(user_id=user_id).values_list('shard', 'moving_to').first()
+            if row is None:
+                return initial_shard(user_id), ''
+    _remember(user_id, row, now)
+    return row
+
+
+def _remember(user_id, row, now):
+    with _lock:
+        if len(_placements) >= MAX_CACHED_PLACEMENTS:
+            _placements.clear()
+        _placements[user_id] = (now + settings.EXPENSES_SHARD_MAP_TTL, *row)
+
+
+def forget(user_id=None):
+    """Drop cached placements, of one user or of everyone."""
+    with _lock:
+        if user_id is None:
+            _placements.clear()
+        else:
+            _placements.pop(user_id, None)
+
+
+def db_for_user(user_id, for_write=False):
+    """The database holding ``user_id``'s per-user rows."""
+    if not enabled():
+        return DEFAULT_DB_ALIAS
+    shard, moving_to = placement(user_id)
+    if for_write and moving_to:
+        raise UserMoving(f'User {user_id} is being moved to {moving_to}; try again shortly.')
+    return shard
+
+
+@contextmanager
+def atomic(*user_ids):
+    """
+    A transaction on the shard of ``user_ids``, which it yields, that no
+    move of theirs can overlap.
+
+    Their ``UserShard`` rows are read afresh, not from the cache, and stay
+    locked until the shard transaction has committed. ``move_user`` takes
+    the same lock to mark a user as moving, so it waits for writes under
+    way, and writes that start later raise ``UserMoving``. Without sharding
+    this is ``transaction.atomic()`` on ``default``.
+    """
+    from .models import UserShard
+
+    if not enabled():
+        with transaction.atomic(using=DEFAULT_DB_ALIAS):
+            yield DEFAULT_DB_ALIAS
+        return
+    user_ids = sorted(set(user_ids))
+    for user_id in user_ids:
+        # Places new users before the lock is taken
+        placement(user_id)
+    with transaction.atomic(using=DEFAULT_DB_ALIAS):
+        rows = UserShard.objects.using(DEFAULT_DB_ALIAS).select_for_update().filter(
+            user_id__in=user_ids
+        ).order_by('user_id').values_list('user_id', 'shard', 'moving_to')
+        found = {}
+        now = time.monotonic()
+        for user_id, shard, moving_to in rows:
+            _remember(user_id, (shard, moving_to), now)
+            if moving_to:
+                raise UserMoving(f'User {user_id} is being moved to {moving_to}; try again shortly.')
+            found[user_id] = shard
+        shards = {found.get(user_id) or initial_shard(user_id) for user_id in user_ids}
+        if len(shards) != 1:
+            raise CrossShardQuery(f'Users {user_ids} live on different shards: {sorted(shards)}')
+        shard = shards.pop()
+        with transaction.atomic(using=shard):
+            yield shard
+
+
+def group_by_database(user_ids, for_write=False):
+    """Split ``user_ids`` into ``{database: set of user ids}``."""
+    groups = defaultdict(set)
+    for user_id in user_ids:
+        groups[db_for_user(user_id, for_write)].add(user_id)
+    return groups
+
+
+def owner_id(instance):
+    """The user whose shard holds the sharded rows ``instance`` relates to, if any."""
+    if is_sharded(instance):
+        return instance.user_id
+    if isinstance(instance, User):
+        return instance.pk
+    if instance._meta.label_lower == 'expenses.sharedexpense':
+        # Shared expenses are only filed under their payer's categories
+        return instance.paid_by_id
+    return None
+
+
+def db_for_hints(hints, for_write=False):
+    """The shard a sharded query with these router hints belongs on, or None."""
+    user_ids = hints.get('user_ids')
+    instance = hints.get('instance')
+    if user_ids is None and instance is not None:
+        user_id = owner_id(instance)
+        if user_id is None:
+            return instance._state.db
+        user_ids = (user_id,)
+    if not user_ids:
+        return None
+    found = {db_for_user(user_id, for_write) for user_id in user_ids}
+    if len(found) > 1:
+        raise CrossShardQuery(f'Users {sorted(user_ids)} live on different shards: {sorted(found)}')
+    return found.pop()
+
+
+def _lookup_user_ids(kwargs):
+    # The user ids a filter() call restricts rows to, or None if it doesn't
+    # name them as plain values
+    for name in USER_LOOKUPS:
+        if name in kwargs:
+            values = [kwargs[name]]
+            break
+        if f'{name}__in' in kwargs:
+            values = kwargs[f'{name}__in']
+            break
+    else:
+        return None
+    if hasattr(values, 'resolve_expression'):
+        return None
+    user_ids = set()
+    for value in values:
+        if isinstance(value, models.Model):
+            value = value.pk
+        if hasattr(value, 'resolve_expression'):
+            return None
+        try:
+            user_ids.add(int(value))
+        except (TypeError, ValueError):
+            return None
+    return frozenset(user_ids) or None
+
+
+def allocate_ids(model, count):
+    """Reserve ``count`` primary keys for ``model`` that are unique across shards."""
+    label = model._meta.label_lower
+    with _lock:
+        _check_process()
+        next_id, end = _id_blocks.get(label, (0, 0))
+        if end - next_id < count:
+            next_id, end = _reserve_ids(model, max(count, settings.EXPENSES_SHARD_ID_BLOCK))
+        _id_blocks[label] = (next_id + count, end)
+    return list(range(next_id, next_id + count))
+
+
+def _reserve_ids(model, size):
+    from .models import IdBlock
+
+    blocks = IdBlock.objects.using(DEFAULT_DB_ALIAS)
+    label = model._meta.label_lower
+    with transaction.atomic(using=DEFAULT_DB_ALIAS):
+        block = blocks.select_for_update().filter(name=label).first()
+        if block is None:
+            # First use: carry on from the highest id stored anywhere
+            start = 1 + max(
+                model._base_manager.using(alias).aggregate(top=models.Max('pk'))['top'] or 0
+                for alias in {DEFAULT_DB_ALIAS, *databases()}
+            )
+            blocks.get_or_create(name=label, defaults={'next_id': start})
+            block = blocks.select_for_update().get(name=label)
+        start = block.next_id
+        block.next_id = start + size
+        block.save(update_fields=['next_id'])
+    return start, start + size
+
+
+def assign_ids(objs):
+    """Give unsaved sharded instances their primary keys."""
+    objs = [obj for obj in objs if obj.pk is None]
+    if objs:
+        for obj, pk in zip(objs, allocate_ids(type(objs[0]), len(objs))):
+            obj.pk = pk
+
+
+class ShardedQuerySet(models.QuerySet):
+    """
+    QuerySet for per-user models that routes by the user it is filtered on.
+
+    The owner named by ``filter()``, ``create()`` and friends becomes a
+    router hint, so ``ShardRouter`` can pick the shard; ``bulk_create()``
+    writes each row to its owner's shard. Without sharding these behave
+    exactly like a plain QuerySet.
+    """
+
+    def _for_users(self, kwargs):
+        user_ids = _lookup_user_ids(kwargs) if enabled() else None
+        if user_ids is None:
+            return self
+        clone = self._chain()
+        # A new dict: clones share their hints with the queryset they came from
+        clone._hints = {**self._hints, 'user_ids': user_ids}
+        return clone
+
+    def filter(self, *args, **kwargs):
+        return super(ShardedQuerySet, self._for_users(kwargs)).filter(*args, **kwargs)
+
+    def create(self, **kwargs):
+        return super(ShardedQuerySet, self._for_users(kwargs)).create(**kwargs)
+
+    def get_or_create(self, defaults=None, **kwargs):
+        return super(ShardedQuerySet, self._for_users(kwargs)).get_or_create(defaults, **kwargs)
+
+    def update_or_create(self, defaults=None, create_defaults=None, **kwargs):
+        return super(ShardedQuerySet, self._for_users(kwargs)).update_or_create(
+            defaults, create_defaults, **kwargs
+        )
+
+    def bulk_create(self, objs, *args, **kwargs):
+        if not enabled():
+            return super().bulk_create(objs, *args, **kwargs)
+        objs = list(objs)
+        assign_ids(objs)
+        if self._db is not None:
+            return super().bulk_create(objs, *args, **kwargs)
+        by_database = defaultdict(list)
+        for obj in objs:
+            by_database[db_for_user(obj.user_id, for_write=True)].append(obj)
+        for alias, rows in by_database.items():
+            models.QuerySet.bulk_create(self.using(alias), rows, *args, **kwargs)
+        return objs
+
+
+def delete_user_rows(user_id, alias):
+    """Remove every sharded row of ``user_id`` from ``alias``, bypassing signals."""
+    from .bulk import delete_rows
+
+    with transaction.atomic(using=alias):
+        for model in reversed(sharded_models()):
+            pks = model._base_manager.using(alias).filter(user_id=user_id).values_list('pk', flat=True)
+            delete_rows(model, pks, alias)
+
+
+def _copy_rows(model, user_id, source, target, batch_size):
+    # Plain values, so the rows keep their ids and auto_now timestamps
+    from .bulk import insert_rows
+
+    names = [field.name for field in model._meta.concrete_fields]
+    rows = model._base_manager.using(source).filter(user_id=user_id).order_by('pk').values_list(
+        *[field.attname for field in model._meta.concrete_fields]
+    )
+    batch = []
+    for row in rows.iterator(chunk_size=batch_size):
+        batch.append(row)
+        if len(batch) >= batch_size:
+            insert_rows(model, names, batch, target)
+            batch = []
+    insert_rows(model, names, batch, target)
+
+
+def move_user(user_id, target, batch_size=1000):
+    """
+    Move ``user_id``'s rows to the shard ``target``.
+
+    The user is marked as moving under the lock ``atomic()`` takes, so
+    writes still under way finish first and later ones raise
+    ``UserMoving``. The rows are then copied, the placement is switched and
+    the old copy is removed. Writes check the placement under that lock, so
+    none lands on the old shard; a process reading through a cached
+    placement finds no rows there until the cache expires.
+    """
+    from .models import UserShard
+
+    if target not in settings.EXPENSES_SHARDS:
+        raise ValueError(f'Unknown shard: {target}')
+    placement(user_id)
+    placements = UserShard.objects.using(DEFAULT_DB_ALIAS).filter(user_id=user_id)
+    with transaction.atomic(using=DEFAULT_DB_ALIAS):
+        source = placements.select_for_update().values_list('shard', flat=True).get()
+        if source == target:
+            return False
+        placements.update(moving_to=target)
+    forget(user_id)
+
+    try:
+        # Leftovers of an interrupted move would collide with the copy
+        delete_user_rows(user_id, target)
+        with transaction.atomic(using=target):
+            for model in sharded_models():
+                _copy_rows(model, user_id, source, target, batch_size)
+    except Exception:
+        placements.update(moving_to='')
+        forget(user_id)
+        raise
+
+    placements.update(shard=target, moving_to='')
+    forget(user_id)
+    delete_user_rows(user_id, source)
+    return True
+
+
+def adopt_global_rows(user_id, batch_size=1000):
+    """
+    Move ``user_id``'s rows kept on ``default`` from before sharding was
+    turned on to their shard, which it returns.
+
+    The rows are copied first, then removed from ``default`` under the lock
+    ``atomic()`` takes, so a move that started meanwhile raises
+    ``UserMoving`` and leaves them where they are. Running it again after
+    an interruption replaces what an earlier run copied.
+    """
+    from .bulk import delete_rows
+
+    target = db_for_user(user_id, for_write=True)
+    copied = {}
+    with transaction.atomic(using=target):
+        for model in sharded_models():
+            copied[model] = list(model._base_manager.using(DEFAULT_DB_ALIAS).filter(
+                user_id=user_id
+            ).values_list('pk', flat=True))
+        for model in reversed(sharded_models()):
+            delete_rows(model, copied[model], target)
+        for model in sharded_models():
+            _copy_rows(model, user_id, DEFAULT_DB_ALIAS, target, batch_size)
+
+    with atomic(user_id) as shard:
+        if shard != target:
+            raise UserMoving(f'User {user_id} was moved to {shard} while their rows were copied.')
+        for model in reversed(sharded_models()):
+            delete_rows(model, copied[model], DEFAULT_DB_ALIAS)
+    return target
+
+
+def cross_shard_keys(alias):
+    """The foreign keys of ``alias`` that point at rows on other databases."""
+    from .models import SharedExpense
+
+    if alias == DEFAULT_DB_ALIAS:
+        # Shared expenses are filed under categories on the payers' shards
+        return [SharedExpense._meta.get_field('category')]
+    return [model._meta.get_field('user') for model in sharded_models()]
+
+
+def drop_cross_shard_constraints(alias):
+    """
+    Drop the database constraints of ``cross_shard_keys(alias)`` and return
+    the keys that had one. The models keep theirs, so databases that are
+    never sharded keep the constraints.
+    """
+    connection = connections[alias]
+    dropped = []
+    with connection.cursor() as cursor:
+        for field in cross_shard_keys(alias):
+            constraints = connection.introspection.get_constraints(cursor, field.model._meta.db_table)
+            if any(c['foreign_key'] and c['columns'] == [field.column] for c in constraints.values()):
+                dropped.append(field)
+    if not dropped:
+        return dropped
+    with connection.schema_editor() as schema_editor:
+        for field in dropped:
+            new_field = field.clone()
+            new_field.db_constraint = False
+            new_field.set_attributes_from_name(field.name)
+            new_field.model = field.model
+            new_field.remote_field.model = field.remote_field.model
+            schema_editor.alter_field(field.model, field, new_field)
+    return dropped
+
+
+def plan_rebalance(loads, max_moves=None):
+    """
+    Plan moves that even out ``{shard: {user_id: rows}}``.
+
+    Greedily moves the largest user that narrows the gap between the
+    fullest and the emptiest shard. Returns ``(user_id, source, target)``
+    tuples in the order they should run.
+    """
+    users = {shard: dict(rows) for shard, rows in loads.items()}
+    totals = {shard: sum(rows.values()) for shard, rows in users.items()}
+    moves = []
+    while len(totals) > 1 and (max_moves is None or len(moves) < max_moves):
+        source = max(totals, key=totals.get)
+        target = min(totals, key=totals.get)
+        gap = totals[source] - totals[target]
+        candidates = [(rows, user_id) for user_id, rows in users[source].items() if 0 < rows < gap]
+        if not candidates:
+            break
+        rows, user_id = max(candidates)
+        moves.append((user_id, source, target))
+        users[target][user_id] = users[source].pop(user_id)
+        totals[source] -= rows
+        totals[target] += rows
+    return moves
+
+
+def load_categories(shared_expenses):
+    """Attach their categories, read from the payers' shards, to ``shared_expenses``."""
+    from .models import Category, SharedExpense
+
+    wanted = defaultdict(set)
+    for expense in shared_expenses:
+        if expense.category_id is not None:
+            wanted[db_for_user(expense.paid_by_id)].add(expense.category_id)
+    found = {}
+    for alias, category_ids in wanted.items():
+        found.update(Category.objects.using(alias).in_bulk(category_ids))
+    field = SharedExpense._meta.get_field('category')
+    for expense in shared_expenses:
+        field.set_cached_value(expense, found.get(expense.category_id))
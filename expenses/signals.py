@@ -0,0 +1,160 @@
+"""
+Model signal handlers that keep derived data in step with expenses.
+"""
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import F
+from django.db.models.signals import m2m_changed, pre_delete, pre_save, post_save, post_delete
+from django.dispatch import receiver
+
+from . import balances, caching, rollups, sharding
+from .models import (
+    Category, Expense, Group, GroupMember, SharedExpense, ExpenseSplit, DailySpending, MonthlySpending,
+)
+
+
+@receiver(pre_save, sender=Expense)
+def capture_previous_expense(sender, instance, raw=False, **kwargs):
+    """Remember the stored version of an expense so an edit can be undone in the rollups."""
+    instance._rollup_previous = None
+    if raw or instance.pk is None:
+        return
+    previous = Expense.objects.filter(pk=instance.pk)
+    if sharding.enabled():
+        # Names the shard to look on
+        previous = previous.filter(user_id=instance.user_id)
+    previous = previous.only('user', 'category', 'date', 'amount').first()
+    if previous is not None:
+        instance._rollup_previous = rollups.expense_key(previous)
+
+
+@receiver(pre_save, sender=Category)
+@receiver(pre_save, sender=Expense)
+@receiver(pre_save, sender=DailySpending)
+@receiver(pre_save, sender=MonthlySpending)
+def assign_sharded_pk(sender, instance, raw=False, **kwargs):
+    """New sharded rows take their key from the global allocator, not the shard's sequence."""
+    if not raw and instance.pk is None and sharding.enabled():
+        sharding.assign_ids([instance])
+
+
+@receiver(pre_delete, sender=User)
+def delete_sharded_rows(sender, instance, **kwargs):
+    """The deletion cascade only reaches the global shard; clear the user's own shard too."""
+    if sharding.enabled():
+        sharding.delete_user_rows(instance.pk, sharding.db_for_user(instance.pk))
+
+
+@receiver(post_delete, sender=Category)
+def delete_shared_expenses_of_category(sender, instance, **kwargs):
+    """Carry the category's cascade over to shared expenses on the global shard."""
+    if sharding.enabled():
+        SharedExpense.objects.filter(category_id=instance.pk).delete()
+
+
+@receiver(post_save, sender=Expense)
+def update_rollups_on_save(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    rollups.record_expense(instance, previous=getattr(instance, '_rollup_previous', None))
+
+
+@receiver(post_delete, sender=Expense)
+def update_rollups_on_delete(sender, instance, **kwargs):
+    rollups.forget_expense(instance)
+
+
+@receiver(post_save, sender=Expense)
+@receiver(post_delete, sender=Expense)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def invalidate_dashboard_cache(sender, instance, **kwargs):
+    """Bump the owner's data version once the change is committed."""
+    user_id = instance.user_id
+    if user_id is not None:
+        transaction.on_commit(lambda: caching.bump_data_version(user_id), using=sharding.db_for_user(user_id))
+
+
+def _split_contribution(split, sign=1):
+    expense = split.expense
+    return balances.split_deltas(
+        expense.group_id, expense.paid_by_id, split.user_id, split.amount, split.is_settled, sign
+    )
+
+
+@receiver(pre_save, sender=ExpenseSplit)
+def capture_previous_split(sender, instance, raw=False, **kwargs):
+    """Remember what the stored split contributed to the ledger before it changes."""
+    instance._ledger_previous = {}
+    if raw or instance.pk is None:
+        return
+    previous = ExpenseSplit.objects.filter(pk=instance.pk).values(
+        'expense__group_id', 'expense__paid_by_id', 'user_id', 'amount', 'is_settled'
+    ).first()
+    if previous is not None:
+        instance._ledger_previous = balances.split_deltas(
+            previous['expense__group_id'], previous['expense__paid_by_id'], previous['user_id'],
+            previous['amount'], previous['is_settled'], sign=-1,
+        )
+
+
+@receiver(post_save, sender=ExpenseSplit)
+def update_ledger_on_split_save(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    balances.apply_deltas(balances.merge(
+        getattr(instance, '_ledger_previous', {}), _split_contribution(instance)
+    ))
+
+
+@receiver(post_delete, sender=ExpenseSplit)
+def update_ledger_on_split_delete(sender, instance, **kwargs):
+    expense = SharedExpense.objects.filter(pk=instance.expense_id).values('group_id', 'paid_by_id').first()
+    if expense is None:
+        return  # Nothing left to attribute the split to
+    balances.apply_deltas(balances.split_deltas(
+        expense['group_id'], expense['paid_by_id'], instance.user_id,
+        instance.amount, instance.is_settled, sign=-1,
+    ), create=False)
+
+
+@receiver(pre_save, sender=SharedExpense)
+def capture_previous_shared_expense(sender, instance, raw=False, **kwargs):
+    instance._ledger_previous = None
+    if raw or instance.pk is None:
+        return
+    instance._ledger_previous = SharedExpense.objects.filter(pk=instance.pk).values_list(
+        'group_id', 'paid_by_id'
+    ).first()
+
+
+@receiver(post_save, sender=SharedExpense)
+def rebuild_ledger_on_payer_change(sender, instance, raw=False, **kwargs):
+    """Changing who paid (or the group) shifts every split's contribution, so recompute."""
+    previous = getattr(instance, '_ledger_previous', None)
+    if raw or previous is None or previous == (instance.group_id, instance.paid_by_id):
+        return
+    balances.rebuild({previous[0], instance.group_id})
+
+
+@receiver(post_save, sender=GroupMember)
+def count_new_member(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        Group.objects.filter(pk=instance.group_id).update(member_count=F('member_count') + 1)
+
+
+@receiver(post_delete, sender=GroupMember)
+def count_removed_member(sender, instance, **kwargs):
+    Group.objects.filter(pk=instance.group_id, member_count__gt=0).update(member_count=F('member_count') - 1)
+
+
+@receiver(m2m_changed, sender=GroupMember)
+def count_members_added_in_bulk(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    ``group.members.add()`` and ``set()`` bulk insert GroupMember rows
+    without post_save, so recount the groups they touched. Removals go
+    through delete(), which the post_delete handler above already counts.
+    """
+    if action != 'post_add' or not pk_set:
+        return
+    Group.recount_members(pk_set if reverse else [instance.pk])
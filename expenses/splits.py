@@ -0,0 +1,79 @@
+"""
+Dividing a shared expense between group members.
+
+Amounts are allocated in whole cents with the largest-remainder method, so
+the shares of an equal or percentage split always add up to exactly the
+expense amount, with any leftover cents going to the members whose exact
+shares were rounded down the most.
+"""
+import math
+from decimal import Decimal
+from fractions import Fraction
+
+
+CENT = Decimal('0.01')
+HUNDRED = Decimal('100')
+
+
+def allocate(amount, weights):
+    """
+    Split ``amount`` in proportion to ``weights``, returning Decimals in cents.
+
+    The result sums exactly to ``amount``, negative amounts included; ties
+    for the leftover cents go to the earlier weights.
+    """
+    total_weight = sum(Fraction(weight) for weight in weights)
+    if total_weight <= 0:
+        raise ValueError('Weights must add up to more than zero')
+    total_cents = int(Decimal(amount).quantize(CENT) / CENT)
+
+    exact = [Fraction(weight) * total_cents / total_weight for weight in weights]
+    # Rounded down, not towards zero, so the leftover is never negative
+    cents = [math.floor(share) for share in exact]
+    leftover = total_cents - sum(cents)
+    by_remainder = sorted(range(len(exact)), key=lambda i: exact[i] - cents[i], reverse=True)
+    for i in by_remainder[:leftover]:
+        cents[i] += 1
+    return [Decimal(c) * CENT for c in cents]
+
+
+def split_amounts(amount, split_type, member_ids, values=None):
+    """
+    Work out each member's share as ``{user_id: (amount, percentage)}``.
+
+    ``values`` maps user ids to the exact amounts or percentages entered for
+    ``exact`` and ``percentage`` splits; members without a share are left
+    out. Raises ValueError when the amount is not positive or the entries
+    do not add up.
+    """
+    amount = Decimal(amount)
+    if amount <= 0:
+        raise ValueError('The amount must be more than zero.')
+    values = values or {}
+
+    if split_type == 'equal':
+        shares = allocate(amount, [1] * len(member_ids))
+        return {user_id: (share, None) for user_id, share in zip(member_ids, shares)}
+
+    entered = {user_id: Decimal(values.get(user_id) or 0) for user_id in member_ids}
+    if any(value < 0 for value in entered.values()):
+        raise ValueError('Shares cannot be negative.')
+    entered = {user_id: value for user_id, value in entered.items() if value}
+
+    if split_type == 'exact':
+        if any(value != value.quantize(CENT) for value in entered.values()):
+            raise ValueError('Exact shares must be whole cents.')
+        if sum(entered.values(), Decimal('0')) != amount:
+            raise ValueError(f'Exact shares must add up to {amount}.')
+        return {user_id: (value, None) for user_id, value in entered.items()}
+
+    if split_type == 'percentage':
+        if sum(entered.values(), Decimal('0')) != HUNDRED:
+            raise ValueError('Percentages must add up to 100.')
+        shares = allocate(amount, list(entered.values()))
+        return {
+            user_id: (share, percentage)
+            for (user_id, percentage), share in zip(entered.items(), shares)
+        }
+
+    raise ValueError(f'Unknown split type: {split_type}')
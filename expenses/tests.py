@@ -1,14 +1,90 @@
-from django.test import TestCase
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection, connections
+from django.db.models import Count, F
+from django.db.models.signals import post_delete, pre_delete
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
 from django.utils import timezone
+from collections import defaultdict
+import csv
+import gzip
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import unittest
+from datetime import date, timedelta
+from io import StringIO
 from decimal import Decimal
-from .models import Category, Expense
+from . import aggregation, balances, bulk, caching, deletion, diagnostics, exports, forms, imports, metrics, pagination, rollups, routers, settlements, sharding, splits
+from benchmarks import support as bench_support
+from .middleware import ProfilingMiddleware, QueryCounter
+from .models import (
+    Category, Expense, DailySpending, MonthlySpending,
+    Group, GroupMember, SharedExpense, ExpenseSplit, GroupBalance, UserShard,
+)
 
 
-class CategoryModelTest(TestCase):
+# The page templates are not needed to exercise the views' context, so tests
+# fall back to empty stand-ins for any template the project does not ship.
+STUB_TEMPLATES = {
+    f'expenses/{name}.html': '' for name in [
+        'expense_list', 'expense_form', 'expense_confirm_delete',
+        'category_list', 'category_form', 'category_confirm_delete',
+        'group_list', 'group_form', 'group_detail', 'group_members',
+        'group_leave_confirm', 'shared_expense_form', 'shared_expense_detail',
+        'settle_expense_confirm', 'expense_import',
+    ]
+}
+
+stub_templates = override_settings(TEMPLATES=[{
+    'BACKEND': 'expenses.profiling.DjangoTemplates',
+    'DIRS': [],
+    'OPTIONS': {
+        'context_processors': [
+            'django.template.context_processors.request',
+            'django.contrib.auth.context_processors.auth',
+            'django.contrib.messages.context_processors.messages',
+        ],
+        'loaders': [
+            'django.template.loaders.filesystem.Loader',
+            'django.template.loaders.app_directories.Loader',
+            ('django.template.loaders.locmem.Loader', STUB_TEMPLATES),
+        ],
+    },
+}])
+
+
+# Everything but ShardingTest covers the single-database layout, and keeps to
+# it when SHARD_DATABASE_URLS is set for the sharded run
+@override_settings(EXPENSES_SHARDS=[])
+class UnshardedTestCase(TestCase):
+    pass
+
+
+@override_settings(EXPENSES_SHARDS=[])
+class UnshardedTransactionTestCase(TransactionTestCase):
+    pass
+
+
+class CategoryModelTest(UnshardedTestCase):
     def setUp(self):
+        self.user = User.objects.create_user('testuser')
         self.category = Category.objects.create(
             name='Food',
-            description='Food and groceries'
+            description='Food and groceries',
+            user=self.user
         )
 
     def test_category_creation(self):
@@ -16,14 +92,16 @@ class CategoryModelTest(TestCase):
         self.assertEqual(str(self.category), 'Food')
 
 
-class ExpenseModelTest(TestCase):
+class ExpenseModelTest(UnshardedTestCase):
     def setUp(self):
-        self.category = Category.objects.create(name='Transportation')
+        self.user = User.objects.create_user('testuser')
+        self.category = Category.objects.create(name='Transportation', user=self.user)
         self.expense = Expense.objects.create(
             title='Uber ride',
             amount=Decimal('25.50'),
             category=self.category,
-            description='Trip to office'
+            description='Trip to office',
+            user=self.user
         )
 
     def test_expense_creation(self):
@@ -31,3 +109,1733 @@ class ExpenseModelTest(TestCase):
         self.assertEqual(self.expense.amount, Decimal('25.50'))
         self.assertEqual(self.expense.category, self.category)
         self.assertIn('Uber ride', str(self.expense))
+
+
+class SpendingRollupTest(UnshardedTestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('alice', password='secret')
+        self.food = Category.objects.create(name='Food', user=self.user)
+        self.travel = Category.objects.create(name='Travel', user=self.user)
+
+    def add(self, amount, day, category=None):
+        return Expense.objects.create(
+            title='Item', amount=Decimal(amount), date=day,
+            category=category or self.food, user=self.user
+        )
+
+    def daily(self):
+        return {
+            (row.category_id, row.date): (row.total, row.count)
+            for row in DailySpending.objects.filter(user=self.user)
+        }
+
+    def test_create_update_delete_keep_rollups_in_step(self):
+        first = self.add('10.00', date(2024, 3, 1))
+        self.add('5.50', date(2024, 3, 1))
+        self.assertEqual(self.daily(), {
+            (self.food.pk, date(2024, 3, 1)): (Decimal('15.50'), 2),
+        })
+
+        first.amount = Decimal('20.00')
+        first.category = self.travel
+        first.date = date(2024, 4, 2)
+        first.save()
+        self.assertEqual(self.daily(), {
+            (self.food.pk, date(2024, 3, 1)): (Decimal('5.50'), 1),
+            (self.travel.pk, date(2024, 4, 2)): (Decimal('20.00'), 1),
+        })
+        monthly = MonthlySpending.objects.get(user=self.user, category=self.travel)
+        self.assertEqual((monthly.month, monthly.total), (date(2024, 4, 1), Decimal('20.00')))
+
+        first.delete()
+        self.assertEqual(self.daily(), {
+            (self.food.pk, date(2024, 3, 1)): (Decimal('5.50'), 1),
+        })
+        self.assertFalse(MonthlySpending.objects.filter(category=self.travel).exists())
+
+    def test_category_delete_cascades_cleanly(self):
+        self.add('10.00', date(2024, 3, 1), self.travel)
+        self.travel.delete()
+        self.assertFalse(DailySpending.objects.exists())
+        self.assertFalse(MonthlySpending.objects.exists())
+
+    def test_rebuild_command_repairs_drift(self):
+        self.add('10.00', date(2024, 3, 1))
+        DailySpending.objects.update(total=Decimal('99.00'))
+        with self.assertRaises(CommandError):
+            call_command('rebuild_rollups', '--check', stdout=StringIO())
+        call_command('rebuild_rollups', stdout=StringIO())
+        call_command('rebuild_rollups', '--check', stdout=StringIO())
+        self.assertEqual(DailySpending.objects.get().total, Decimal('10.00'))
+
+    def test_rebuild_of_a_date_span(self):
+        self.add('10.00', date(2024, 1, 31))
+        self.add('4.00', date(2024, 2, 10))
+        self.add('6.00', date(2024, 2, 20))
+        DailySpending.objects.update(total=Decimal('99.00'))
+        MonthlySpending.objects.update(total=Decimal('99.00'))
+        rollups.rebuild([self.user.pk], date(2024, 2, 15), date(2024, 2, 29))
+        daily = self.daily()
+        self.assertEqual(daily[(self.food.pk, date(2024, 2, 20))], (Decimal('6.00'), 1))
+        # Days outside the span are left alone, the months it touches are whole
+        self.assertEqual(daily[(self.food.pk, date(2024, 2, 10))], (Decimal('99.00'), 1))
+        months = dict(MonthlySpending.objects.values_list('month', 'total'))
+        self.assertEqual(months, {date(2024, 1, 1): Decimal('99.00'), date(2024, 2, 1): Decimal('10.00')})
+
+    @stub_templates
+    def test_dashboard_reads_rollups(self):
+        today = timezone.now().date()
+        self.add('10.00', today)
+        self.add('2.50', today, self.travel)
+        self.add('4.00', date(2020, 1, 15))
+        self.client.force_login(self.user)
+
+        response = self.client.get(reverse('expense_list'))
+        self.assertEqual(response.context['total_amount'], Decimal('16.50'))
+        self.assertEqual(
+            [(row['category__name'], row['count']) for row in response.context['expenses_by_category']],
+            [('Food', 2), ('Travel', 1)],
+        )
+        chart = self.client.get(reverse('expense_chart_data')).json()
+        self.assertEqual(len(chart['trend']['labels']), 2)
+
+        response = self.client.get(reverse('expense_list'), {'period': 'daily'})
+        self.assertEqual(response.context['total_amount'], Decimal('12.50'))
+        chart = self.client.get(reverse('expense_chart_data'), {'period': 'daily'}).json()
+        self.assertEqual(chart['trend'], {'labels': ['Today'], 'data': [12.5]})
+
+
+class AggregationTest(UnshardedTestCase):
+    """The SQL aggregation must reproduce the old in-Python bucketing exactly."""
+
+    def setUp(self):
+        self.user = User.objects.create_user('bob', password='secret')
+        self.today = date(2024, 5, 15)  # a Wednesday
+        categories = [Category.objects.create(name=name, user=self.user)
+                      for name in ('Food', 'Rent', 'Fun')]
+        for i in range(60):
+            Expense.objects.create(
+                title=f'Item {i}', amount=Decimal(f'{i % 7 + 1}.{i % 100:02d}'),
+                date=self.today - timedelta(days=i * 3 % 75),
+                category=categories[i % 3], user=self.user,
+            )
+
+    def python_bucketing(self, period):
+        """The pre-aggregation expense_list trend logic, kept as the reference."""
+        expenses = list(aggregation.filter_dates(
+            Expense.objects.filter(user=self.user), period.start, period.end))
+        totals = defaultdict(float)
+        for expense in expenses:
+            key = expense.date if period.granularity == 'day' else expense.date.replace(day=1)
+            totals[key] += float(expense.amount)
+        if period.granularity is None:
+            return ['Today'], [float(sum(e.amount for e in expenses))]
+        keys = sorted(totals)
+        return [k.strftime(period.label_format) for k in keys], [totals[k] for k in keys]
+
+    def test_matches_python_bucketing_for_every_period(self):
+        for key in ('daily', 'weekly', 'monthly', 'all'):
+            period = aggregation.resolve_period(key, self.today)
+            expected_labels, expected_amounts = self.python_bucketing(period)
+            sources = [
+                aggregation.filter_dates(Expense.objects.filter(user=self.user), period.start, period.end),
+                rollups.spending_queryset(self.user, period.start, period.end),
+            ]
+            for queryset in sources:
+                with self.subTest(period=key, model=queryset.model.__name__):
+                    summary = aggregation.summarize(queryset, period.granularity)
+                    _, _, labels, amounts = aggregation.chart_series(summary, period)
+                    self.assertEqual(labels, expected_labels)
+                    for amount, expected in zip(amounts, expected_amounts, strict=True):
+                        self.assertAlmostEqual(amount, expected, places=6)
+
+    def test_category_breakdown_matches_across_sources(self):
+        expected = aggregation.category_breakdown(Expense.objects.filter(user=self.user))
+        self.assertEqual(aggregation.category_breakdown(rollups.spending_queryset(self.user)), expected)
+        self.assertEqual(sum(row['count'] for row in expected), 60)
+
+    def test_bounded_queries_without_model_instances(self):
+        period = aggregation.resolve_period('monthly', self.today)
+        queryset = rollups.spending_queryset(self.user, period.start, period.end)
+        with self.assertNumQueries(2):
+            summary = aggregation.summarize(queryset, period.granularity)
+        self.assertTrue(all(isinstance(row, dict) for row in summary['by_category']))
+
+
+class KeysetPaginationTest(UnshardedTestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('carol', password='secret')
+        category = Category.objects.create(name='Food', user=self.user)
+        # Several expenses share a date so the created_at/id tiebreakers matter
+        for i in range(23):
+            Expense.objects.create(
+                title=f'Item {i}', amount=Decimal('1.00'), date=date(2024, 1, 1 + i // 4),
+                category=category, user=self.user,
+            )
+        self.queryset = Expense.objects.filter(user=self.user)
+        self.expected = list(self.queryset.order_by('-date', '-created_at', '-id'))
+
+    def test_forward_and_backward_walks_cover_every_row_once(self):
+        pages, cursor = [], None
+        while True:
+            with self.assertNumQueries(1):
+                page = pagination.paginate(self.queryset, cursor, page_size=5)
+            pages.append(page)
+            if not page.has_next:
+                break
+            cursor = page.next_cursor
+        self.assertEqual([e for page in pages for e in page], self.expected)
+        self.assertEqual([len(page) for page in pages], [5, 5, 5, 5, 3])
+        self.assertFalse(pages[0].has_previous)
+
+        back = pagination.paginate(self.queryset, pages[-1].previous_cursor, page_size=5)
+        self.assertEqual(list(back), list(pages[-2]))
+        self.assertEqual(back.next_cursor, pages[-2].next_cursor)
+        first = pagination.paginate(self.queryset, pages[1].previous_cursor, page_size=5)
+        self.assertEqual(list(first), list(pages[0]))
+        self.assertFalse(first.has_previous)
+
+    def test_malformed_cursor_is_rejected(self):
+        for cursor in ('garbage', 'W10', pagination.encode_cursor(self.expected[0], 'sideways')):
+            with self.assertRaises(pagination.InvalidCursor):
+                pagination.paginate(self.queryset, cursor)
+
+    @stub_templates
+    def test_expense_list_is_paginated(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('expense_list'), {'page_size': 10, 'cursor': 'bogus'})
+        self.assertEqual(response.context['expenses'], self.expected[:10])
+        self.assertEqual(response.context['expense_count'], 23)
+        response = self.client.get(reverse('expense_list'), {
+            'page_size': 10, 'cursor': response.context['page'].next_cursor,
+        })
+        self.assertEqual(response.context['expenses'], self.expected[10:20])
+
+
+@stub_templates
+class DashboardCacheTest(UnshardedTestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('dave', password='secret')
+        self.category = Category.objects.create(name='Food', user=self.user)
+        self.client.force_login(self.user)
+
+    def add_expense(self, amount):
+        with self.captureOnCommitCallbacks(execute=True):
+            Expense.objects.create(title='Lunch', amount=Decimal(amount), category=self.category, user=self.user)
+
+    def test_repeat_visits_hit_cache_until_data_changes(self):
+        self.add_expense('12.00')
+        url = reverse('expense_list')
+        self.assertEqual(self.client.get(url).context['total_amount'], Decimal('12.00'))
+        self.assertEqual(caching.stats(), {'hits': 0, 'misses': 1})
+
+        self.assertEqual(self.client.get(url).context['total_amount'], Decimal('12.00'))
+        self.assertEqual(caching.stats(), {'hits': 1, 'misses': 1})
+
+        self.add_expense('3.00')
+        self.assertEqual(self.client.get(url).context['total_amount'], Decimal('15.00'))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.category.name = 'Groceries'
+            self.category.save()
+        response = self.client.get(url)
+        self.assertEqual(response.context['expenses_by_category'][0]['category__name'], 'Groceries')
+        self.assertEqual(caching.stats(), {'hits': 1, 'misses': 3})
+
+    def test_periods_are_cached_separately(self):
+        self.add_expense('5.00')
+        self.client.get(reverse('expense_list'))
+        self.client.get(reverse('expense_list'), {'period': 'weekly'})
+        self.assertEqual(caching.stats()['misses'], 2)
+
+    def test_file_based_backend(self):
+        with tempfile.TemporaryDirectory() as location, override_settings(CACHES={
+            'default': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': location},
+        }):
+            before = caching.data_version(self.user.pk)
+            caching.bump_data_version(self.user.pk)
+            self.assertEqual(caching.data_version(self.user.pk), before + 1)
+            calls = []
+            for _ in range(2):
+                caching.get_dashboard(self.user.pk, 'all', lambda: calls.append(1) or {'total': 1})
+            self.assertEqual(len(calls), 1)
+            self.assertEqual(caching.stats(), {'hits': 1, 'misses': 1})
+
+
+class ChartDataEndpointTest(UnshardedTestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('erin', password='secret')
+        self.category = Category.objects.create(name='Food', user=self.user)
+        for day, amount in ((date(2024, 1, 10), '4.00'), (date(2024, 1, 20), '6.00'), (date(2024, 6, 1), '5.00')):
+            Expense.objects.create(title='Item', amount=Decimal(amount), date=day,
+                                   category=self.category, user=self.user)
+        self.client.force_login(self.user)
+        self.url = reverse('expense_chart_data')
+
+    def test_custom_range_is_charted_by_day_or_month(self):
+        data = self.client.get(self.url, {'start': '2024-01-01', 'end': '2024-01-31'}).json()
+        self.assertEqual(data['total'], 10.0)
+        self.assertEqual(data['trend'], {'labels': ['Jan 10', 'Jan 20'], 'data': [4.0, 6.0]})
+        self.assertEqual(data['categories'], {'labels': ['Food'], 'data': [10.0]})
+
+        data = self.client.get(self.url, {'start': '2024-01-01', 'end': '2024-12-31'}).json()
+        self.assertEqual(data['trend'], {'labels': ['Jan 2024', 'Jun 2024'], 'data': [10.0, 5.0]})
+
+    def test_invalid_range_is_rejected(self):
+        self.assertEqual(self.client.get(self.url, {'start': 'yesterday'}).status_code, 400)
+        self.assertEqual(self.client.get(self.url, {'start': '2024-02-01', 'end': '2024-01-01'}).status_code, 400)
+
+    def test_unchanged_data_revalidates_with_304(self):
+        response = self.client.get(self.url)
+        etag = response['ETag']
+        self.assertIn('no-cache', response['Cache-Control'])
+
+        with self.assertNumQueries(2):  # session and user lookups only
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Expense.objects.create(title='New', amount=Decimal('1.00'), category=self.category, user=self.user)
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.json()['total'], 16.0)
+
+    def test_requires_login(self):
+        self.client.logout()
+        self.assertEqual(self.client.get(self.url).status_code, 302)
+
+
+@unittest.skipUnless(connection.vendor == 'sqlite', 'EXPLAIN QUERY PLAN output is SQLite-specific')
+@stub_templates
+class QueryPlanTest(UnshardedTestCase):
+    """
+    Run the hot views against seeded data and EXPLAIN every query they issue.
+
+    A ``SCAN`` of one of the app's tables means SQLite found no usable index
+    and read the whole table (or a whole index), which is what the composite
+    indexes exist to prevent.
+    """
+    FULL_SCAN = re.compile(r'\bSCAN (expenses_\w+)')
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [User.objects.create_user(f'plan{i}', password='secret') for i in range(4)]
+        cls.user = cls.users[0]
+        cls.group = Group.objects.create(name='Trip', created_by=cls.user)
+        for user in cls.users:
+            GroupMember.objects.create(group=cls.group, user=user, is_admin=user == cls.user)
+            category = Category.objects.create(name='Food', user=user)
+            Expense.objects.bulk_create([
+                Expense(title=f'Item {i}', amount=Decimal('2.00'), date=date(2024, 1 + i % 12, 1 + i % 28),
+                        category=category, user=user)
+                for i in range(200)
+            ])
+        rollups.rebuild([user.pk for user in cls.users])
+        for i in range(50):
+            shared = SharedExpense.objects.create(
+                title=f'Shared {i}', amount=Decimal('8.00'), group=cls.group,
+                paid_by=cls.users[i % 4], date=date(2024, 1 + i % 12, 1),
+            )
+            ExpenseSplit.objects.bulk_create([
+                ExpenseSplit(expense=shared, user=user, amount=Decimal('2.00')) for user in cls.users
+            ])
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.user)
+
+    def assert_no_full_scans(self, url, params=None, method='get'):
+        with CaptureQueriesContext(connection) as captured:
+            response = getattr(self.client, method)(url, params or {})
+        self.assertLess(response.status_code, 400)
+        selects = [q['sql'] for q in captured.captured_queries if q['sql'].startswith('SELECT')]
+        self.assertTrue(selects)
+        with connection.cursor() as cursor:
+            for sql in selects:
+                cursor.execute(f'EXPLAIN QUERY PLAN {sql}')
+                plan = '\n'.join(row[-1] for row in cursor.fetchall())
+                with self.subTest(url=url, sql=sql):
+                    self.assertIsNone(self.FULL_SCAN.search(plan), f'Full scan in:\n{plan}')
+
+    def test_expense_views(self):
+        for period in ('all', 'daily', 'weekly', 'monthly'):
+            self.assert_no_full_scans(reverse('expense_list'), {'period': period})
+        self.assert_no_full_scans(reverse('expense_chart_data'), {'start': '2024-01-01', 'end': '2024-02-01'})
+        page = self.client.get(reverse('expense_list')).context['page']
+        self.assert_no_full_scans(reverse('expense_list'), {'cursor': page.next_cursor})
+        self.assert_no_full_scans(reverse('category_list'))
+
+    def test_group_views(self):
+        self.assert_no_full_scans(reverse('group_detail', args=[self.group.pk]))
+        page = self.client.get(reverse('group_detail', args=[self.group.pk])).context['page']
+        self.assert_no_full_scans(reverse('group_detail', args=[self.group.pk]), {'cursor': page.next_cursor})
+        self.assert_no_full_scans(reverse('group_members', args=[self.group.pk]))
+        self.assert_no_full_scans(reverse('shared_expense_detail', args=[self.group.shared_expenses.first().pk]))
+        # Members with open splits are turned away after the unsettled check
+        self.assert_no_full_scans(reverse('group_leave', args=[self.group.pk]), method='post')
+
+
+@stub_templates
+class GroupBalanceLedgerTest(UnshardedTestCase):
+    def setUp(self):
+        self.payer, self.bob, self.cat = [
+            User.objects.create_user(name, password='secret') for name in ('payer', 'bobby', 'cathy')
+        ]
+        self.group = Group.objects.create(name='Flat', created_by=self.payer)
+        for user in (self.payer, self.bob, self.cat):
+            GroupMember.objects.create(group=self.group, user=user)
+        self.client.force_login(self.payer)
+
+    def ledger(self):
+        return {row.user.username: row.net for row in GroupBalance.objects.filter(group=self.group)}
+
+    def add_shared_expense(self, amount):
+        self.client.post(reverse('shared_expense_create', args=[self.group.pk]), {
+            'title': 'Groceries', 'amount': amount, 'date': '2024-05-01', 'split_type': 'equal',
+        })
+        return self.group.shared_expenses.latest('pk')
+
+    def test_splits_and_settlements_update_the_ledger(self):
+        expense = self.add_shared_expense('30.00')
+        self.assertEqual(self.ledger(), {'payer': Decimal('20.00'), 'bobby': Decimal('-10.00'), 'cathy': Decimal('-10.00')})
+
+        split = expense.splits.get(user=self.bob)
+        self.client.force_login(self.bob)
+        self.client.post(reverse('settle_expense', args=[split.pk]))
+        self.assertEqual(self.ledger(), {'payer': Decimal('10.00'), 'bobby': Decimal('0.00'), 'cathy': Decimal('-10.00')})
+
+        response = self.client.get(reverse('group_detail', args=[self.group.pk]))
+        self.assertEqual(response.context['balances'], {
+            'payer': Decimal('10.00'), 'bobby': Decimal('0.00'), 'cathy': Decimal('-10.00'),
+        })
+
+        expense.delete()
+        self.assertEqual(set(self.ledger().values()), {Decimal('0')})
+        self.assertEqual(balances.find_mismatches([self.group.pk]), [])
+
+    def test_balance_read_is_flat_in_member_count(self):
+        self.add_shared_expense('30.00')
+        url = reverse('group_detail', args=[self.group.pk])
+        with CaptureQueriesContext(connection) as small:
+            self.client.get(url)
+        for i in range(20):
+            GroupMember.objects.create(group=self.group, user=User.objects.create_user(f'extra{i}'))
+        self.add_shared_expense('46.00')
+        with CaptureQueriesContext(connection) as large:
+            self.client.get(url)
+        self.assertEqual(len(small), len(large))
+
+    def test_reconcile_command_reports_and_fixes_drift(self):
+        self.add_shared_expense('30.00')
+        GroupBalance.objects.filter(user=self.cat).update(net=Decimal('5.00'))
+        with self.assertRaises(CommandError):
+            call_command('reconcile_balances', stdout=StringIO())
+        call_command('reconcile_balances', '--fix', stdout=StringIO())
+        self.assertEqual(self.ledger()['cathy'], Decimal('-10.00'))
+        call_command('reconcile_balances', stdout=StringIO())
+
+
+class SettlementPlanTest(UnshardedTestCase):
+    def assert_settles(self, balances, transfers):
+        remaining = dict(balances)
+        for debtor, creditor, amount in transfers:
+            self.assertGreater(amount, 0)
+            remaining[debtor] += amount
+            remaining[creditor] -= amount
+        self.assertEqual(set(remaining.values()) - {Decimal('0')}, set())
+
+    def test_plan_clears_every_balance_to_the_cent(self):
+        balances = {'a': Decimal('10.01'), 'b': Decimal('-3.34'), 'c': Decimal('-3.34'),
+                    'd': Decimal('-3.33'), 'e': Decimal('0')}
+        transfers = settlements.simplify_debts(balances)
+        self.assert_settles(balances, transfers)
+        self.assertEqual(len(transfers), 3)
+
+    def test_exact_matches_are_paired_directly(self):
+        balances = {'a': Decimal('5'), 'b': Decimal('7'), 'c': Decimal('-7'), 'd': Decimal('-5')}
+        transfers = settlements.simplify_debts(balances)
+        self.assertEqual(sorted(transfers), [('c', 'b', Decimal('7.00')), ('d', 'a', Decimal('5.00'))])
+
+    def test_unbalanced_input_is_rejected(self):
+        with self.assertRaises(ValueError):
+            settlements.simplify_debts({'a': Decimal('1.00'), 'b': Decimal('-0.99')})
+
+    def test_large_group_needs_at_most_n_minus_one_transfers(self):
+        rng = random.Random(7)
+        cents = [rng.randint(-10_000, 10_000) for _ in range(4_999)]
+        balances = {i: Decimal(c) / 100 for i, c in enumerate(cents)}
+        balances[4_999] = -sum(balances.values())
+        transfers = settlements.simplify_debts(balances)
+        self.assertLessEqual(len(transfers), 4_999)
+        self.assert_settles(balances, transfers)
+
+    def test_plan_endpoint(self):
+        payer, other, outsider = (User.objects.create_user(name) for name in ('pam', 'oli', 'out'))
+        group = Group.objects.create(name='Trip', created_by=payer)
+        GroupMember.objects.create(group=group, user=payer)
+        GroupMember.objects.create(group=group, user=other)
+        expense = SharedExpense.objects.create(title='Hotel', amount=Decimal('90.00'), group=group, paid_by=payer)
+        ExpenseSplit.objects.create(expense=expense, user=payer, amount=Decimal('45.00'))
+        ExpenseSplit.objects.create(expense=expense, user=other, amount=Decimal('45.00'))
+
+        url = reverse('group_settlement_plan', args=[group.pk])
+        self.client.force_login(other)
+        self.assertEqual(self.client.get(url).json()['transfers'], [{'from': 'oli', 'to': 'pam', 'amount': '45.00'}])
+        self.client.force_login(outsider)
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+        # A drifted ledger is reported and planned around from the splits
+        GroupBalance.objects.filter(group=group, user=payer).update(net=Decimal('50.00'))
+        self.client.force_login(other)
+        with self.assertLogs('expenses.balances', 'WARNING'):
+            response = self.client.get(url)
+        self.assertEqual(response.json()['transfers'], [{'from': 'oli', 'to': 'pam', 'amount': '45.00'}])
+
+
+@stub_templates
+class SharedExpenseSplitTest(UnshardedTestCase):
+    def setUp(self):
+        self.members = [User.objects.create_user(f'member{i}') for i in range(3)]
+        self.payer = self.members[0]
+        self.group = Group.objects.create(name='House', created_by=self.payer)
+        for user in self.members:
+            GroupMember.objects.create(group=self.group, user=user)
+        self.client.force_login(self.payer)
+        self.url = reverse('shared_expense_create', args=[self.group.pk])
+
+    def post(self, amount, split_type, shares=None):
+        data = {'title': 'Bill', 'amount': amount, 'date': '2024-05-01', 'split_type': split_type}
+        data.update({f'share_{user.pk}': value for user, value in zip(self.members, shares or [])})
+        return self.client.post(self.url, data)
+
+    def split_amounts(self):
+        expense = self.group.shared_expenses.latest('pk')
+        return [split.amount for split in expense.splits.order_by('user_id')]
+
+    def test_allocate_uses_largest_remainder(self):
+        self.assertEqual(splits.allocate(Decimal('10.00'), [1, 1, 1]),
+                         [Decimal('3.34'), Decimal('3.33'), Decimal('3.33')])
+        self.assertEqual(splits.allocate(Decimal('1.00'), [Decimal('33.33'), Decimal('33.33'), Decimal('33.34')]),
+                         [Decimal('0.33'), Decimal('0.33'), Decimal('0.34')])
+        self.assertEqual(splits.allocate(Decimal('-10.00'), [1, 1, 1]),
+                         [Decimal('-3.33'), Decimal('-3.33'), Decimal('-3.34')])
+
+    def test_amount_must_be_positive(self):
+        for amount in ('0.00', '-10.00'):
+            response = self.post(amount, 'equal')
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('The amount must be more than zero.', response.context['form'].non_field_errors())
+        self.assertFalse(self.group.shared_expenses.exists())
+
+    def test_equal_split_sums_exactly(self):
+        self.post('10.00', 'equal')
+        self.assertEqual(self.split_amounts(), [Decimal('3.34'), Decimal('3.33'), Decimal('3.33')])
+        self.assertEqual(balances.find_mismatches([self.group.pk]), [])
+
+    def test_exact_split(self):
+        self.post('50.00', 'exact', ['10.00', '15.50', '24.50'])
+        self.assertEqual(self.split_amounts(), [Decimal('10.00'), Decimal('15.50'), Decimal('24.50')])
+
+        response = self.post('50.00', 'exact', ['10.00', '15.50', '20.00'])
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Exact shares must add up to 50.00.', response.context['form'].non_field_errors())
+        self.assertEqual(self.group.shared_expenses.count(), 1)
+
+    def test_percentage_split(self):
+        self.post('200.00', 'percentage', ['50', '25.5', '24.5'])
+        expense = self.group.shared_expenses.get()
+        self.assertEqual(
+            [(split.amount, split.percentage) for split in expense.splits.order_by('user_id')],
+            [(Decimal('100.00'), Decimal('50.00')), (Decimal('51.00'), Decimal('25.50')),
+             (Decimal('49.00'), Decimal('24.50'))],
+        )
+        response = self.post('200.00', 'percentage', ['50', '25'])
+        self.assertIn('Percentages must add up to 100.', response.context['form'].non_field_errors())
+
+    def test_query_count_is_constant_in_group_size(self):
+        with CaptureQueriesContext(connection) as small:
+            self.post('90.00', 'equal')
+        for i in range(3, 40):
+            user = User.objects.create_user(f'member{i}')
+            GroupMember.objects.create(group=self.group, user=user)
+        with CaptureQueriesContext(connection) as large:
+            self.post('90.00', 'equal')
+        self.assertEqual(len(small), len(large))
+        self.assertEqual(self.group.shared_expenses.latest('pk').splits.count(), 40)
+
+
+class SettleUpTest(UnshardedTestCase):
+    def setUp(self):
+        self.ann, self.ben, self.cal = (User.objects.create_user(name) for name in ('ann', 'ben', 'cal'))
+        self.group = Group.objects.create(name='Trip', created_by=self.ann)
+        for user in (self.ann, self.ben, self.cal):
+            GroupMember.objects.create(group=self.group, user=user)
+        # ann paid for 30 things ben shares, ben paid for 5 things ann shares
+        for payer, debtor, count, share in ((self.ann, self.ben, 30, '4.00'), (self.ben, self.ann, 5, '3.00')):
+            for _ in range(count):
+                expense = SharedExpense.objects.create(title='x', amount=Decimal(share) * 3, group=self.group, paid_by=payer)
+                for user in (self.ann, self.ben, self.cal):
+                    ExpenseSplit.objects.create(expense=expense, user=user, amount=Decimal(share))
+
+    def test_settles_both_directions_in_one_update(self):
+        with CaptureQueriesContext(connection) as queries:
+            count, amount = balances.settle_between(self.group.pk, self.ben.pk, self.ann.pk)
+        self.assertEqual((count, amount), (35, Decimal('105.00')))
+        self.assertEqual(sum(q['sql'].startswith('UPDATE "expenses_expensesplit"') for q in queries), 1)
+        self.assertFalse(ExpenseSplit.objects.filter(
+            expense__group=self.group, user__in=[self.ann, self.ben],
+            expense__paid_by__in=[self.ann, self.ben], is_settled=False,
+        ).exclude(user=F('expense__paid_by')).exists())
+        # cal's debts are untouched and the ledger still reconciles
+        self.assertEqual(ExpenseSplit.objects.filter(user=self.cal, is_settled=False).count(), 35)
+        self.assertEqual(balances.find_mismatches([self.group.pk]), [])
+
+    def test_double_submit_settles_once(self):
+        self.client.force_login(self.ben)
+        url = reverse('settle_up_with', args=[self.group.pk, self.ann.pk])
+        self.client.post(url)
+        ledger_after_first = list(GroupBalance.objects.order_by('pk').values_list('net', flat=True))
+        self.client.post(url)
+        self.assertEqual(list(GroupBalance.objects.order_by('pk').values_list('net', flat=True)), ledger_after_first)
+        self.assertEqual(balances.settle_between(self.group.pk, self.ann.pk, self.ben.pk), (0, Decimal('0')))
+        self.assertEqual(self.client.get(url).status_code, 405)
+
+    def test_only_other_members_can_be_settled_with(self):
+        outsider = User.objects.create_user('out')
+        self.client.force_login(self.ben)
+        for user in (self.ben, outsider):
+            response = self.client.post(reverse('settle_up_with', args=[self.group.pk, user.pk]))
+            self.assertEqual(response.status_code, 404)
+        self.assertFalse(ExpenseSplit.objects.filter(is_settled=True).exists())
+        self.assertEqual(balances.find_mismatches([self.group.pk]), [])
+
+
+@stub_templates
+class GroupMemberCountTest(UnshardedTestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user('owner', password='secret')
+        self.client.force_login(self.owner)
+        self.client.post(reverse('group_create'), {'name': 'Club'})
+        self.group = Group.objects.get(name='Club')
+
+    def test_member_count_follows_joins_and_leaves(self):
+        self.assertEqual(self.group.member_count, 1)
+        joiners = [User.objects.create_user(f'joiner{i}', password='secret') for i in range(3)]
+        for user in joiners:
+            self.client.force_login(user)
+            self.client.post(reverse('group_join', args=[self.group.pk]))
+        self.client.post(reverse('group_leave', args=[self.group.pk]))
+        joiners[0].delete()
+
+        stale = self.group
+        self.group.refresh_from_db()
+        self.assertEqual(self.group.member_count, 2)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.group.get_member_count(), 2)
+
+        # Saving an out-of-date instance leaves the counter alone
+        stale.member_count = 99
+        stale.name = 'Renamed'
+        stale.save()
+        self.group.refresh_from_db()
+        self.assertEqual((self.group.name, self.group.member_count), ('Renamed', 2))
+
+        GroupMember.objects.filter(group=self.group).update(is_admin=False)
+        Group.objects.filter(pk=self.group.pk).update(member_count=0)
+        Group.recount_members([self.group.pk])
+        self.group.refresh_from_db()
+        self.assertEqual(self.group.member_count, 2)
+
+    def test_member_count_follows_related_manager_changes(self):
+        friends = [User.objects.create_user(f'friend{i}') for i in range(3)]
+        self.group.members.add(*friends[:2])
+        friends[2].user_groups.add(self.group)
+        self.group.refresh_from_db()
+        self.assertEqual(self.group.member_count, 4)
+
+        self.group.members.remove(friends[0])
+        self.group.members.set([self.owner, friends[1]])
+        self.group.refresh_from_db()
+        self.assertEqual(self.group.member_count, 2)
+        self.group.members.clear()
+        self.group.refresh_from_db()
+        self.assertEqual(self.group.member_count, 0)
+
+    def test_user_shares_for_a_page_in_one_query(self):
+        other = User.objects.create_user('other')
+        GroupMember.objects.create(group=self.group, user=other)
+        split = SharedExpense.objects.create(title='a', amount=Decimal('9.00'), group=self.group,
+                                             paid_by=other, split_type='exact')
+        ExpenseSplit.objects.create(expense=split, user=self.owner, amount=Decimal('7.00'))
+        equal = SharedExpense.objects.create(title='b', amount=Decimal('9.00'), group=self.group, paid_by=other)
+        exact = SharedExpense.objects.create(title='c', amount=Decimal('9.00'), group=self.group,
+                                             paid_by=other, split_type='exact')
+        expenses = list(self.group.shared_expenses.select_related('group'))
+        with self.assertNumQueries(1):
+            shares = SharedExpense.get_user_shares(expenses, self.owner)
+        self.assertEqual(shares, {split.pk: Decimal('7.00'), equal.pk: Decimal('4.50'), exact.pk: 0})
+
+        self.client.force_login(self.owner)
+        response = self.client.get(reverse('group_detail', args=[self.group.pk]))
+        self.assertEqual({e.pk: e.user_share for e in response.context['shared_expenses']}, shares)
+
+
+@stub_templates
+class GroupListTest(UnshardedTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('viewer', password='secret')
+        self.friend = User.objects.create_user('friend')
+        self.client.force_login(self.user)
+
+    def make_groups(self, count):
+        for i in range(count):
+            group = Group.objects.create(name=f'group {i:03}', created_by=self.user if i % 2 else self.friend)
+            GroupMember.objects.create(group=group, user=self.friend)
+            expense = SharedExpense.objects.create(title='x', amount=Decimal('10.00'), group=group,
+                                                   paid_by=self.friend, split_type='exact')
+            if i % 3:
+                GroupMember.objects.create(group=group, user=self.user)
+                ExpenseSplit.objects.create(expense=expense, user=self.user, amount=Decimal('4.00'))
+
+    def get_page(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('group_list'))
+        return response, len(queries)
+
+    def test_annotated_rows(self):
+        self.make_groups(6)
+        response, _ = self.get_page()
+        user_groups = response.context['user_groups']
+        created = response.context['created_groups']
+        self.assertEqual([g.name for g in user_groups], ['group 001', 'group 002', 'group 004', 'group 005'])
+        self.assertEqual([g.name for g in created], ['group 001', 'group 003', 'group 005'])
+        # A group in both lists is the same instance, fetched once
+        self.assertIs(user_groups[0], created[0])
+
+        with self.assertNumQueries(0):
+            rows = [(g.get_member_count(), g.get_total_expenses(), g.user_net) for g in user_groups + created]
+        self.assertEqual(rows[0], (2, Decimal('10.00'), Decimal('-4.00')))
+        self.assertEqual(rows[-2], (1, Decimal('10.00'), Decimal('0')))
+
+    def test_query_count_is_flat(self):
+        self.make_groups(3)
+        _, few = self.get_page()
+        self.make_groups(200)
+        _, many = self.get_page()
+        self.assertEqual(few, many)
+
+
+@stub_templates
+class AdminChangelistTest(UnshardedTestCase):
+    def setUp(self):
+        self.admin = User.objects.create_superuser('root', 'root@example.com', 'secret')
+        self.client.force_login(self.admin)
+
+    def make_rows(self, count):
+        for i in range(count):
+            user = User.objects.create_user(f'user{Category.objects.count()}')
+            category = Category.objects.create(name=f'cat {i}', user=user)
+            for amount in range(i % 3):
+                Expense.objects.create(title='x', amount=Decimal('1.00'), category=category,
+                                       user=user, date=date(2024, 1, 1))
+            group = Group.objects.create(name=f'group {i}', created_by=user)
+            GroupMember.objects.create(group=group, user=user)
+            SharedExpense.objects.create(title='x', amount=Decimal(i), group=group, paid_by=user)
+
+    def changelist_queries(self, model, query=''):
+        url = reverse(f'admin:expenses_{model}_changelist') + query
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response, len(queries)
+
+    def test_query_count_does_not_grow_with_rows(self):
+        self.make_rows(3)
+        few = [self.changelist_queries(model)[1] for model in ('category', 'group')]
+        self.make_rows(40)
+        many = [self.changelist_queries(model)[1] for model in ('category', 'group')]
+        self.assertEqual(few, many)
+
+    def test_annotated_columns_sort(self):
+        self.make_rows(5)
+        response, _ = self.changelist_queries('category', '?o=4')
+        self.assertEqual([c._expense_count for c in response.context['cl'].result_list],
+                         [0, 0, 1, 1, 2])
+        response, _ = self.changelist_queries('group', '?o=-4')
+        self.assertEqual([g._total_expenses for g in response.context['cl'].result_list],
+                         [4, 3, 2, 1, 0])
+        self.assertContains(response, '$4.00')
+
+    def test_user_filter_is_an_autocomplete(self):
+        self.make_rows(30)
+        chosen = User.objects.get(username='user7')
+        response, _ = self.changelist_queries('category', f'?user__id__exact={chosen.pk}')
+        self.assertEqual([c.user for c in response.context['cl'].result_list], [chosen])
+        self.assertContains(response, 'admin-autocomplete')
+        self.assertContains(response, f'<option value="{chosen.pk}" selected>user7</option>', html=True)
+        # Other users are searched on demand instead of listed in the sidebar
+        self.assertNotContains(response, 'user__id__exact=%s' % User.objects.get(username='user8').pk)
+
+        response = self.client.get(reverse('admin:autocomplete'), {
+            'app_label': 'expenses', 'model_name': 'category', 'field_name': 'user', 'term': 'user2',
+        })
+        self.assertIn('user21', [r['text'] for r in response.json()['results']])
+
+
+@stub_templates
+class UserExpenseSummaryAdminTest(UnshardedTestCase):
+    url = '/admin/expenses/userexpensesummary/'
+
+    def setUp(self):
+        self.admin = User.objects.create_superuser('root', 'root@example.com', 'secret')
+        self.client.force_login(self.admin)
+
+    def make_users(self, count, offset=0):
+        for i in range(offset, offset + count):
+            user = User.objects.create_user(f'user{i:03}')
+            category = Category.objects.create(name='Food', user=user)
+            Expense.objects.create(title='old', amount=Decimal('5.00'), category=category,
+                                   user=user, date=date(2024, 1, 15))
+            Expense.objects.create(title='new', amount=Decimal(i), category=category,
+                                   user=user, date=date(2024, 3, 1))
+
+    def get_rows(self, query=''):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url + query)
+        self.assertEqual(response.status_code, 200)
+        rows = [(u.username, u._total_amount, u._total_count, u._categories_count)
+                for u in response.context['cl'].result_list]
+        return rows, len(queries)
+
+    def test_totals_sorting_and_date_range(self):
+        self.make_users(3)
+        rows, _ = self.get_rows('?o=1')
+        self.assertEqual(rows[:3], [
+            ('root', 0, 0, 0), ('user000', Decimal('5.00'), 2, 1), ('user001', Decimal('6.00'), 2, 1),
+        ])
+        rows, _ = self.get_rows('?o=-1&start=2024-02-01&end=2024-03-31')
+        self.assertEqual(rows[0], ('user002', Decimal('2.00'), 1, 1))
+        self.assertEqual(rows[1], ('user001', Decimal('1.00'), 1, 1))
+
+        response = self.client.get(self.url + '?start=2024-03-01&end=2024-01-01')
+        self.assertRedirects(response, self.url + '?e=1', fetch_redirect_response=False)
+
+    def test_bounded_by_page_size(self):
+        self.make_users(5)
+        _, few = self.get_rows('?o=-1')
+        self.make_users(120, offset=5)
+        rows, many = self.get_rows('?o=-1')
+        self.assertEqual(len(rows), 50)
+        self.assertEqual(rows[0][0], 'user124')
+        self.assertEqual(few, many)
+
+
+@stub_templates
+class ExportTest(UnshardedTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('exporter', password='secret')
+        self.other = User.objects.create_user('other')
+        self.category = Category.objects.create(name='Food', user=self.user)
+        for day in range(1, 6):
+            Expense.objects.create(title=f'meal {day}', amount=Decimal('2.50'), category=self.category,
+                                   user=self.user, date=date(2024, 1, day), description='a, "quoted" note')
+        Expense.objects.create(title='not mine', amount=Decimal('1.00'), user=self.other,
+                               category=Category.objects.create(name='Food', user=self.other),
+                               date=date(2024, 1, 3))
+        self.client.force_login(self.user)
+
+    def read_csv(self, content):
+        return list(csv.reader(content.decode().splitlines()))
+
+    def test_user_export_streams_own_expenses_in_range(self):
+        response = self.client.get(reverse('expense_export'), {'start': '2024-01-02', 'end': '2024-01-04'})
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="expenses-exporter.csv"')
+        rows = self.read_csv(b''.join(response.streaming_content))
+        self.assertEqual(rows[0], ['User', 'Title', 'Amount', 'Category', 'Date', 'Description'])
+        self.assertEqual(rows[1:], [
+            ['exporter', f'meal {day}', '2.50', 'Food', f'2024-01-0{day}', 'a, "quoted" note']
+            for day in (2, 3, 4)
+        ])
+        self.assertEqual(self.client.get(reverse('expense_export'), {'start': 'soon'}).status_code, 400)
+
+    def test_gzip_export(self):
+        response = self.client.get(reverse('expense_export'), {'gzip': '1'})
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        self.assertEqual(len(self.read_csv(gzip.decompress(b''.join(response.streaming_content)))), 6)
+
+    @override_settings(EXPENSES_EXPORT_CHUNK_SIZE=2)
+    def test_rows_are_sent_in_chunks(self):
+        response = self.client.get(reverse('expense_export'))
+        chunks = list(response.streaming_content)
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual(len(self.read_csv(b''.join(chunks))), 6)
+
+    def test_admin_actions(self):
+        admin_user = User.objects.create_superuser('root', 'root@example.com', 'secret')
+        self.client.force_login(admin_user)
+        selected = Expense.objects.filter(user=self.user).values_list('pk', flat=True)[:2]
+        response = self.client.post(reverse('admin:expenses_expense_changelist'), {
+            'action': 'export_user_expenses', '_selected_action': list(selected),
+        })
+        self.assertEqual(len(self.read_csv(b''.join(response.streaming_content))), 3)
+
+
+class BulkDeleteTest(UnshardedTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('deleter')
+        self.other = User.objects.create_user('keeper')
+        for user in (self.user, self.other):
+            category = Category.objects.create(name='Food', user=user)
+            for day in range(1, 11):
+                Expense.objects.create(title='x', amount=Decimal('3.00'), category=category,
+                                       user=user, date=date(2024, 1, day))
+
+    def test_batches_keep_rollups_in_sync(self):
+        seen = []
+        with self.captureOnCommitCallbacks(execute=True):
+            count = deletion.delete_expenses(
+                Expense.objects.filter(user=self.user, date__gte=date(2024, 1, 4)),
+                batch_size=3, progress=seen.append,
+            )
+        self.assertEqual((count, seen), (7, [3, 6, 7]))
+        self.assertEqual(Expense.objects.filter(user=self.user).count(), 3)
+        self.assertEqual(Expense.objects.filter(user=self.other).count(), 10)
+        self.assertEqual(rollups.find_drift([self.user.pk, self.other.pk]), [])
+
+    def test_batch_query_count_is_fixed(self):
+        with CaptureQueriesContext(connection) as small:
+            deletion.delete_expenses(Expense.objects.filter(user=self.other), batch_size=10)
+        with CaptureQueriesContext(connection) as large:
+            deletion.delete_expenses(Expense.objects.filter(user=self.user, date__lte=date(2024, 1, 2)),
+                                     batch_size=10)
+        self.assertEqual(len(small), len(large))
+
+    def test_command(self):
+        out = StringIO()
+        call_command('delete_expenses', '--user', 'deleter', '--end', '2024-01-05',
+                     '--batch-size', '2', stdout=out)
+        self.assertIn('Deleted 5 expenses.', out.getvalue())
+        self.assertEqual(Expense.objects.count(), 15)
+        with self.assertRaises(CommandError):
+            call_command('delete_expenses', stdout=out)
+        with self.assertRaises(CommandError):
+            call_command('delete_expenses', '--start', 'yesterday', stdout=out)
+
+
+class DeleteRowsTest(UnshardedTestCase):
+    def setUp(self):
+        user = User.objects.create_user('raw')
+        category = Category.objects.create(name='Food', user=user)
+        for day in range(1, 4):
+            Expense.objects.create(title='x', amount=Decimal('1.00'), category=category,
+                                   user=user, date=date(2024, 1, day))
+
+    def test_one_delete_and_no_signals(self):
+        sent = []
+        receiver = lambda sender, **kwargs: sent.append(sender)
+        post_delete.connect(receiver, weak=False)
+        pre_delete.connect(receiver, weak=False)
+        self.addCleanup(post_delete.disconnect, receiver)
+        self.addCleanup(pre_delete.disconnect, receiver)
+        pks = list(Expense.objects.filter(date__lte=date(2024, 1, 2)).values_list('pk', flat=True))
+        with CaptureQueriesContext(connection) as queries:
+            count = bulk.delete_rows(Expense, pks, 'default')
+        self.assertEqual(count, 2)
+        self.assertEqual(sent, [])
+        self.assertEqual([q['sql'].split()[0] for q in queries], ['DELETE'])
+        self.assertEqual(Expense.objects.count(), 1)
+
+
+@stub_templates
+class ImportTest(UnshardedTestCase):
+    CSV = (
+        'Title,Amount,Category,Date,Description\n'
+        'Lunch,12.50,Food,2024-01-05,with team\n'
+        'Bus,2.75,Transport,2024-01-05,\n'
+        ',3.00,Food,2024-01-06,\n'
+        'Snack,abc,Food,2024-01-06,\n'
+        'Dinner,20.00,Food,2024-02-30,\n'
+        '\n'
+        'Taxi,15.00,Transport,2024-02-01,late\n'
+    )
+
+    def setUp(self):
+        self.user = User.objects.create_user('importer', password='secret')
+        Category.objects.create(name='Food', user=self.user)
+
+    def test_import_reports_bad_rows_and_keeps_rollups(self):
+        # Already in the span the import rebuilds
+        Expense.objects.create(title='Old', amount=Decimal('1.00'), category=self.user.categories.get(),
+                               user=self.user, date=date(2024, 1, 20))
+        with CaptureQueriesContext(connection) as queries:
+            result = imports.import_expenses(self.user, StringIO(self.CSV), batch_size=2)
+        self.assertEqual(result.created, 3)
+        self.assertEqual([(e.line, e.message) for e in result.errors], [
+            (4, 'Title is required.'),
+            (5, "Invalid amount: 'abc'"),
+            (6, "Invalid date: '2024-02-30'"),
+        ])
+        self.assertEqual(sorted(self.user.categories.values_list('name', flat=True)), ['Food', 'Transport'])
+        self.assertEqual(rollups.find_drift([self.user.pk]), [])
+        # Categories are looked up once and new ones created once, not per row
+        self.assertEqual(sum('expenses_category' in q['sql'] for q in queries.captured_queries), 3)
+
+    def test_categories_created_meanwhile_are_reused(self):
+        # The import read its category names before another request added Travel
+        categories = {}
+        travel = Category.objects.create(name='Travel', user=self.user)
+        imports._insert(self.user, [('Bus', Decimal('2.00'), 'Travel', date(2024, 1, 5), '')], categories)
+        self.assertEqual(categories['Travel'], travel.pk)
+        self.assertEqual(self.user.categories.filter(name='Travel').count(), 1)
+        self.assertEqual(Expense.objects.get(title='Bus').category, travel)
+
+    def test_export_round_trip(self):
+        imports.import_expenses(self.user, StringIO(self.CSV))
+        exported = b''.join(exports.export_response(Expense.objects.order_by('pk')).streaming_content)
+        other = User.objects.create_user('copy')
+        result = imports.import_expenses(other, StringIO(exported.decode()))
+        self.assertEqual((result.created, result.errors), (3, []))
+        self.assertEqual(
+            list(other.expenses.order_by('pk').values_list('title', 'amount', 'category__name', 'date')),
+            list(self.user.expenses.order_by('pk').values_list('title', 'amount', 'category__name', 'date')),
+        )
+
+    def test_missing_columns(self):
+        with self.assertRaisesMessage(imports.InvalidImportFile, 'Missing column(s): amount, date'):
+            imports.import_expenses(self.user, StringIO('Title,Category\nLunch,Food\n'))
+
+    def test_upload_view_and_command(self):
+        self.client.force_login(self.user)
+        response = self.client.post(reverse('expense_import'), {
+            'file': SimpleUploadedFile('history.csv', self.CSV.encode('utf-8-sig')),
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['row_errors']), 3)
+        self.assertEqual(self.user.expenses.count(), 3)
+
+        out, err = StringIO(), StringIO()
+        path = self._write_csv()
+        call_command('import_expenses', path, '--user', 'importer', stdout=out, stderr=err)
+        self.assertIn('Imported 3 expenses, skipped 3 rows.', out.getvalue())
+        self.assertIn('line 5: Invalid amount', err.getvalue())
+        with self.assertRaises(CommandError):
+            call_command('import_expenses', path, '--user', 'nobody', stdout=out)
+
+    def _write_csv(self):
+        handle = tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False)
+        with handle:
+            handle.write(self.CSV)
+        self.addCleanup(os.remove, handle.name)
+        return handle.name
+
+
+class SeedScaleTest(UnshardedTestCase):
+    def seed(self, **options):
+        out = StringIO()
+        call_command('seed_scale', users=30, expenses=600, groups=6, shared_expenses=80,
+                     end=date(2024, 6, 30), batch_size=100, stdout=out, **options)
+        return out.getvalue()
+
+    def snapshot(self):
+        return (
+            list(Expense.objects.order_by('pk').values_list('user__username', 'category__name', 'amount', 'date')),
+            list(ExpenseSplit.objects.order_by('pk').values_list('expense__title', 'user__username', 'amount', 'is_settled')),
+        )
+
+    def test_generates_consistent_data(self):
+        self.assertIn('Done.', self.seed(skew=1.5))
+        self.assertEqual(User.objects.count(), 30)
+        self.assertEqual(Expense.objects.count(), 600)
+        self.assertEqual(SharedExpense.objects.count(), 80)
+
+        # Skewed: the heaviest user has far more than an even share
+        counts = sorted(Expense.objects.values('user').annotate(n=Count('pk')).values_list('n', flat=True))
+        self.assertGreater(counts[-1], 600 / 30 * 4)
+
+        for expense in SharedExpense.objects.prefetch_related('splits'):
+            self.assertEqual(sum(split.amount for split in expense.splits.all()), expense.amount)
+        user_ids = list(User.objects.values_list('pk', flat=True))
+        group_ids = list(Group.objects.values_list('pk', flat=True))
+        self.assertEqual(rollups.find_drift(user_ids), [])
+        self.assertEqual(balances.find_mismatches(group_ids), [])
+        for group in Group.objects.annotate(n=Count('members')):
+            self.assertEqual(group.member_count, group.n)
+
+    def test_reproducible_from_seed(self):
+        self.seed(seed=7)
+        first = self.snapshot()
+        for model in (User, Group):
+            model.objects.all().delete()
+        self.seed(seed=7)
+        self.assertEqual(self.snapshot(), first)
+        with self.assertRaises(CommandError):
+            self.seed()
+
+
+# Templates that touch what each page displays, so queries made while
+# rendering happen in tests too
+stub_display_templates = override_settings(TEMPLATES=[{
+    'BACKEND': 'expenses.profiling.DjangoTemplates',
+    'OPTIONS': {
+        'context_processors': [
+            'django.template.context_processors.request',
+            'django.contrib.auth.context_processors.auth',
+            'django.contrib.messages.context_processors.messages',
+        ],
+        'loaders': [
+            'django.template.loaders.app_directories.Loader',
+            ('django.template.loaders.locmem.Loader', {**STUB_TEMPLATES, **bench_support.STUB_TEMPLATES}),
+        ],
+    },
+}])
+
+
+@stub_display_templates
+class QueryBudgetTest(UnshardedTestCase):
+    # Queries per request, including the session and user lookups and,
+    # for writes, the savepoints of the test transaction
+    BUDGETS = {
+        'expense_list': 5,
+        'category_list': 3,
+        'group_list': 3,
+        'group_detail': 8,
+        'shared_expense_create': 13,
+        'admin:expense': 7,
+        'admin:category': 5,
+        'admin:group': 5,
+        'admin:sharedexpense': 7,
+        'admin:userexpensesummary': 4,
+    }
+
+    def setUp(self):
+        self.user = User.objects.create_user('budget', password='secret')
+        self.admin = User.objects.create_superuser('root', 'root@example.com', 'secret')
+        self.group = Group.objects.create(name='Flat', created_by=self.user)
+        GroupMember.objects.create(group=self.group, user=self.user, is_admin=True)
+        self.added = 0
+
+    def populate(self, count):
+        for i in range(self.added, self.added + count):
+            friend = User.objects.create_user(f'friend{i}')
+            category = Category.objects.create(name=f'cat {i}', user=self.user)
+            Expense.objects.create(title='x', amount=Decimal('5.00'), category=category,
+                                   user=self.user, date=timezone.now().date() - timedelta(days=i))
+            group = Group.objects.create(name=f'group {i}', created_by=friend)
+            for member_group in (group, self.group):
+                GroupMember.objects.create(group=member_group, user=friend)
+            GroupMember.objects.create(group=group, user=self.user)
+            shared = SharedExpense.objects.create(title='y', amount=Decimal('8.00'), group=self.group,
+                                                  paid_by=friend, category=category, split_type='exact')
+            ExpenseSplit.objects.create(expense=shared, user=self.user, amount=Decimal('8.00'))
+        self.added += count
+
+    def requests(self):
+        for period in ('daily', 'weekly', 'monthly', 'all'):
+            yield 'expense_list', self.user, 'get', reverse('expense_list'), {'period': period}
+        yield 'category_list', self.user, 'get', reverse('category_list'), None
+        yield 'group_list', self.user, 'get', reverse('group_list'), None
+        yield 'group_detail', self.user, 'get', reverse('group_detail', args=[self.group.pk]), None
+        yield 'shared_expense_create', self.user, 'post', reverse('shared_expense_create', args=[self.group.pk]), {
+            'title': 'Budget', 'amount': '30.00', 'split_type': 'equal', 'date': '2024-01-01',
+        }
+        for model in ('expense', 'category', 'group', 'sharedexpense', 'userexpensesummary'):
+            yield f'admin:{model}', self.admin, 'get', reverse(f'admin:expenses_{model}_changelist'), None
+
+    def query_counts(self):
+        counts = defaultdict(int)
+        for name, user, method, url, data in self.requests():
+            self.client.force_login(user)
+            cache.clear()
+            with CaptureQueriesContext(connection) as queries:
+                response = getattr(self.client, method)(url, data)
+            self.assertEqual(response.status_code, 302 if method == 'post' else 200, name)
+            counts[name] = max(counts[name], len(queries))
+        return counts
+
+    def test_budgets_hold_as_data_grows(self):
+        self.populate(2)
+        small = self.query_counts()
+        self.populate(25)
+        large = self.query_counts()
+        for name, budget in self.BUDGETS.items():
+            with self.subTest(view=name):
+                self.assertLessEqual(small[name], budget)
+                self.assertEqual(large[name], small[name])
+
+
+@stub_templates
+class ProfilingMiddlewareTest(UnshardedTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('profiled', password='secret')
+        self.group = Group.objects.create(name='Trip', created_by=self.user)
+        GroupMember.objects.create(group=self.group, user=self.user, is_admin=True)
+        self.client.force_login(self.user)
+        self.url = reverse('group_detail', args=[self.group.pk])
+
+    def test_disabled_by_default(self):
+        self.assertNotIn('Server-Timing', self.client.get(self.url))
+
+    @override_settings(EXPENSES_PROFILING=True, EXPENSES_PROFILING_LOG_THRESHOLD_MS=0)
+    def test_header_and_log_line(self):
+        with CaptureQueriesContext(connection) as queries:
+            with self.assertLogs('expenses.profiling', 'INFO') as logs:
+                response = self.client.get(self.url)
+        timing = dict(
+            (entry.split(';')[0], entry) for entry in response['Server-Timing'].split(', ')
+        )
+        self.assertEqual(sorted(timing), ['db', 'total', 'tpl', 'view'])
+        self.assertIn(f'desc="{len(queries)} queries"', timing['db'])
+
+        profile = logs.records[0].profile
+        self.assertEqual((profile['view'], profile['status'], profile['db_queries']),
+                         ('group_detail', 200, len(queries)))
+        self.assertGreater(profile['template_ms'], 0)
+        self.assertGreaterEqual(profile['total_ms'], profile['view_ms'])
+        self.assertGreaterEqual(profile['view_ms'], profile['template_ms'])
+
+    @override_settings(EXPENSES_PROFILING=True, EXPENSES_PROFILING_LOG_THRESHOLD_MS=0)
+    async def test_async_requests(self):
+        async def view(request):
+            return HttpResponse()
+
+        middleware = ProfilingMiddleware(view)
+        self.assertTrue(iscoroutinefunction(middleware))
+        self.assertIn('Server-Timing', await middleware(RequestFactory().get('/')))
+
+        await self.async_client.aforce_login(self.user)
+        with self.assertLogs('expenses.profiling', 'INFO') as logs:
+            await self.async_client.get(reverse('group_detail_async', args=[self.group.pk]))
+        profile = logs.records[-1].profile
+        self.assertEqual(profile['view'], 'group_detail_async')
+        self.assertGreater(profile['db_queries'], 0)
+        self.assertGreater(profile['template_ms'], 0)
+
+    @override_settings(EXPENSES_PROFILING=True, EXPENSES_PROFILING_LOG_THRESHOLD_MS=60_000)
+    def test_fast_requests_are_not_logged(self):
+        with self.assertNoLogs('expenses.profiling'):
+            self.assertIn('Server-Timing', self.client.get(self.url))
+
+    @override_settings(EXPENSES_PROFILING=True, EXPENSES_PROFILING_SAMPLE_RATE=0)
+    def test_unsampled_requests_are_untouched(self):
+        self.assertNotIn('Server-Timing', self.client.get(self.url))
+
+
+@stub_templates
+class SlowQueryCaptureTest(UnshardedTestCase):
+    def setUp(self):
+        diagnostics.clear()
+        self.addCleanup(diagnostics.clear)
+        self.user = User.objects.create_user('slow', password='secret')
+        self.group = Group.objects.create(name='Trip', created_by=self.user)
+        GroupMember.objects.create(group=self.group, user=self.user, is_admin=True)
+        self.client.force_login(self.user)
+
+    def test_disabled_by_default(self):
+        self.client.get(reverse('group_detail', args=[self.group.pk]))
+        self.assertEqual(diagnostics.recent(), [])
+
+    @override_settings(EXPENSES_SLOW_QUERY_MS=0, EXPENSES_SLOW_QUERY_BUFFER=50)
+    def test_captures_sql_view_frame_and_plan(self):
+        self.client.get(reverse('group_detail', args=[self.group.pk]))
+        captured = [q for q in diagnostics.recent() if 'expenses_groupbalance' in q.sql]
+        self.assertEqual(len(captured), 1)
+        query = captured[0]
+        self.assertEqual(query.view, 'group_detail')
+        self.assertRegex(query.frame, r'^expenses/group_views\.py:\d+ in group_detail$')
+        self.assertIsNone(query.params)
+        self.assertRegex(query.plan, r'(SEARCH|SCAN)')
+        # The EXPLAIN queries themselves are never captured
+        self.assertFalse(any(q.sql.startswith('EXPLAIN') for q in diagnostics.recent()))
+
+    @override_settings(EXPENSES_SLOW_QUERY_MS=0, EXPENSES_SLOW_QUERY_PARAMS=True)
+    def test_params_only_kept_when_asked_for(self):
+        self.client.get(reverse('group_detail', args=[self.group.pk]))
+        query = next(q for q in diagnostics.recent() if 'expenses_groupbalance' in q.sql)
+        self.assertIn(str(self.group.pk), query.params)
+
+    @override_settings(EXPENSES_SLOW_QUERY_MS=0, EXPENSES_SLOW_QUERY_BUFFER=3)
+    def test_buffer_is_bounded(self):
+        for _ in range(3):
+            self.client.get(reverse('group_detail', args=[self.group.pk]))
+        self.assertEqual(len(diagnostics.recent()), 3)
+
+    @override_settings(EXPENSES_SLOW_QUERY_MS=0)
+    def test_staff_only_page(self):
+        self.client.get(reverse('group_detail', args=[self.group.pk]))
+        response = self.client.get(reverse('slow_query_list'))
+        self.assertEqual(response.status_code, 302)
+
+        staff = User.objects.create_user('staff', password='secret', is_staff=True)
+        self.client.force_login(staff)
+        response = self.client.get(reverse('slow_query_list'))
+        self.assertContains(response, 'group_detail')
+        self.assertContains(response, 'expenses_groupbalance')
+
+        self.client.post(reverse('slow_query_list'))
+        self.assertFalse(any(q.view == 'group_detail' for q in diagnostics.recent()))
+
+
+@stub_templates
+class MetricsTest(UnshardedTestCase):
+    def setUp(self):
+        metrics_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(metrics_dir.cleanup)
+        self.override = override_settings(EXPENSES_METRICS=True, EXPENSES_METRICS_DIR=metrics_dir.name)
+        self.override.enable()
+        self.addCleanup(self.override.disable)
+        self.metrics_dir = metrics_dir.name
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+        cache.clear()
+
+        self.user = User.objects.create_user('measured', password='secret')
+        self.client.force_login(self.user)
+
+    def scrape(self, **headers):
+        response = self.client.get(reverse('metrics'), headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        return response.content.decode()
+
+    def test_requests_latency_queries_and_cache(self):
+        counter = QueryCounter()
+        with connection.execute_wrapper(counter):
+            self.client.get(reverse('expense_list'))
+            self.client.get(reverse('expense_list'))
+        self.client.get('/no-such-page/')
+
+        text = self.scrape()
+        self.assertIn('expenses_http_requests_total{method="GET",status="200",view="expense_list"} 2', text)
+        self.assertIn('expenses_http_requests_total{method="GET",status="404",view="unresolved"} 1', text)
+        self.assertIn('expenses_http_request_duration_seconds_count{view="expense_list"} 2', text)
+        self.assertIn('expenses_http_request_duration_seconds_bucket{view="expense_list",le="+Inf"} 2', text)
+        self.assertIn(f'expenses_db_queries_total{{view="expense_list"}} {counter.count}', text)
+        self.assertIn('expenses_cache_requests_total{outcome="miss",view="expense_list"} 1', text)
+        self.assertIn('expenses_cache_requests_total{outcome="hit",view="expense_list"} 1', text)
+
+    def test_histogram_buckets_are_cumulative(self):
+        for value in (0.003, 0.2, 20):
+            metrics.observe('expenses_http_request_duration_seconds', {'view': 'x'}, value)
+        text = self.scrape()
+        self.assertIn('expenses_http_request_duration_seconds_bucket{view="x",le="0.005"} 1', text)
+        self.assertIn('expenses_http_request_duration_seconds_bucket{view="x",le="0.25"} 2', text)
+        self.assertIn('expenses_http_request_duration_seconds_bucket{view="x",le="10.0"} 2', text)
+        self.assertIn('expenses_http_request_duration_seconds_bucket{view="x",le="+Inf"} 3', text)
+        self.assertIn('expenses_http_request_duration_seconds_sum{view="x"} 20.203', text)
+
+    def test_sums_across_worker_files(self):
+        self.client.get(reverse('expense_list'))
+        # Another worker's figures, as it would have flushed them
+        with open(os.path.join(self.metrics_dir, f'{os.getpid() + 1}.json'), 'w') as handle:
+            json.dump([
+                ['expenses_http_requests_total',
+                 [['method', 'GET'], ['status', '200'], ['view', 'expense_list']], 3],
+                ['expenses_http_exceptions_total',
+                 [['exception', 'ValueError'], ['view', 'group_detail']], 1],
+            ], handle)
+        text = self.scrape()
+        self.assertIn('expenses_http_requests_total{method="GET",status="200",view="expense_list"} 4', text)
+        self.assertIn('expenses_http_exceptions_total{exception="ValueError",view="group_detail"} 1', text)
+
+    @unittest.skipUnless(metrics.fcntl, 'needs fcntl')
+    def test_files_of_exited_workers_are_folded_together(self):
+        self.client.get(reverse('expense_list'))
+        labels = [['method', 'GET'], ['status', '200'], ['view', 'expense_list']]
+        exited = []
+        for count in (3, 5):
+            worker = subprocess.Popen([sys.executable, '-c', ''])
+            worker.wait()
+            exited.append(worker.pid)
+            with open(os.path.join(self.metrics_dir, f'{worker.pid}.json'), 'w') as handle:
+                json.dump([['expenses_http_requests_total', labels, count]], handle)
+        for _ in range(2):
+            text = self.scrape()
+            self.assertIn('expenses_http_requests_total{method="GET",status="200",view="expense_list"} 9', text)
+        self.assertEqual(sorted(name for name in os.listdir(self.metrics_dir) if name.endswith('.json')),
+                         sorted([f'{os.getpid()}.json', metrics.EXITED_FILE]))
+
+    def test_token(self):
+        with override_settings(EXPENSES_METRICS_TOKEN='s3cret'):
+            self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+            self.assertIn('expenses_http_requests_total', self.scrape(authorization='Bearer s3cret'))
+
+    def test_disabled(self):
+        with override_settings(EXPENSES_METRICS=False):
+            self.assertEqual(self.client.get(reverse('metrics')).status_code, 404)
+
+
+@stub_templates
+class AsyncViewsTest(UnshardedTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('async', password='secret')
+        self.friend = User.objects.create_user('friend')
+        food = Category.objects.create(name='Food', user=self.user)
+        today = timezone.now().date()
+        for i in range(30):
+            Expense.objects.create(title=f'e{i}', amount=Decimal('2.50'), category=food, user=self.user,
+                                   date=today - timedelta(days=i))
+        self.group = Group.objects.create(name='Trip', created_by=self.user)
+        GroupMember.objects.create(group=self.group, user=self.user, is_admin=True)
+        GroupMember.objects.create(group=self.group, user=self.friend)
+        for i in range(30):
+            expense = SharedExpense.objects.create(title=f's{i}', amount=Decimal('10.00'), group=self.group,
+                                                   paid_by=self.friend, split_type='exact')
+            ExpenseSplit.objects.create(expense=expense, user=self.user, amount=Decimal('4.00'))
+        self.client.force_login(self.user)
+
+    async def get_both(self, sync_url, async_url):
+        await self.async_client.aforce_login(self.user)
+        expected = await sync_to_async(self.client.get)(sync_url)
+        response = await self.async_client.get(async_url)
+        self.assertEqual(response.status_code, 200)
+        return expected.context, response.context
+
+    async def test_expense_list_matches_sync_view(self):
+        expected, context = await self.get_both(
+            reverse('expense_list') + '?period=monthly', reverse('expense_list_async') + '?period=monthly')
+        for key in ('total_amount', 'expense_count', 'expenses_by_category', 'period_label', 'chart_data_url'):
+            self.assertEqual(context[key], expected[key], key)
+        self.assertEqual(context['expenses'], expected['expenses'])
+        self.assertEqual(context['page'].next_cursor, expected['page'].next_cursor)
+        # Evaluated by the view, so rendering doesn't query again
+        self.assertIsNotNone(context['categories']._result_cache)
+        self.assertEqual(list(context['categories']), [c async for c in expected['categories']])
+
+    async def test_async_summary_matches_sync(self):
+        today = timezone.now().date()
+        for user, start in ((self.user, None), (self.user, today - timedelta(days=9)), (self.friend, today)):
+            queryset = rollups.spending_queryset(user, start, None)
+            with self.subTest(user=user.username, start=start):
+                self.assertEqual(await aggregation.asummarize(queryset),
+                                 await sync_to_async(aggregation.summarize)(queryset))
+
+    async def test_group_detail_matches_sync_view(self):
+        expected, context = await self.get_both(
+            reverse('group_detail', args=[self.group.pk]), reverse('group_detail_async', args=[self.group.pk]))
+        self.assertEqual(context['balances'], expected['balances'])
+        self.assertEqual(context['shared_expenses'], expected['shared_expenses'])
+        self.assertEqual([e.user_share for e in context['shared_expenses']],
+                         [e.user_share for e in expected['shared_expenses']])
+        self.assertTrue(context['is_admin'])
+        self.assertEqual(context['group'].get_total_expenses(), Decimal('300.00'))
+
+    async def test_group_detail_requires_membership(self):
+        outsider = await sync_to_async(User.objects.create_user)('outsider')
+        await self.async_client.aforce_login(outsider)
+        response = await self.async_client.get(reverse('group_detail_async', args=[self.group.pk]))
+        self.assertRedirects(response, reverse('group_list'), fetch_redirect_response=False)
+
+    async def test_login_required(self):
+        response = await self.async_client.get(reverse('expense_list_async'))
+        self.assertEqual(response.status_code, 302)
+        self.assertIn(settings.LOGIN_URL, response['Location'])
+
+
+class ReplicaRouterTest(UnshardedTestCase):
+    def setUp(self):
+        cache.clear()
+        self.router = routers.ReplicaRouter()
+
+    def test_reads_follow_the_context_and_writes_stay_on_primary(self):
+        self.assertIsNone(self.router.db_for_read(Expense))
+        expense = Expense(title='x', amount=Decimal('1.00'))
+        expense._state.db = routers.REPLICA_ALIAS
+        token = routers._read_alias.set(routers.REPLICA_ALIAS)
+        try:
+            # A TestCase always runs inside a transaction on the primary
+            self.assertIsNone(self.router.db_for_read(Expense))
+            self.assertEqual(self.router.db_for_write(Expense, instance=expense), 'default')
+        finally:
+            routers._read_alias.reset(token)
+        self.assertFalse(self.router.allow_migrate(routers.REPLICA_ALIAS, 'expenses'))
+        self.assertIsNone(self.router.allow_migrate('default', 'expenses'))
+
+    def test_data_changes_pin_the_user_to_the_primary(self):
+        user = User.objects.create_user('pinned')
+        self.assertFalse(caching.pinned_to_primary(user.pk))
+        with self.captureOnCommitCallbacks(execute=True):
+            Category.objects.create(name='Food', user=user)
+        self.assertTrue(caching.pinned_to_primary(user.pk))
+
+
+@unittest.skipUnless(routers.replica_configured(), 'set REPLICA_DATABASE_URL to test replica routing')
+@stub_display_templates
+class ReplicaRoutingTest(UnshardedTransactionTestCase):
+    # The replica mirrors the test database, so the data must be committed
+    databases = '__all__'
+
+    def setUp(self):
+        self.user = User.objects.create_user('analyst', password='secret', is_staff=True, is_superuser=True)
+        food = Category.objects.create(name='Food', user=self.user)
+        Expense.objects.create(title='Lunch', amount=Decimal('12.00'), category=food, user=self.user)
+        group = Group.objects.create(name='Trip', created_by=self.user)
+        GroupMember.objects.create(group=group, user=self.user, is_admin=True)
+        # As if the pin from creating the data above had expired
+        cache.clear()
+        self.client.force_login(self.user)
+
+    def queries_by_alias(self, url, method='get', data=None):
+        with CaptureQueriesContext(connections['default']) as primary, \
+                CaptureQueriesContext(connections[routers.REPLICA_ALIAS]) as replica:
+            response = getattr(self.client, method)(url, data)
+        self.assertIn(response.status_code, (200, 302))
+        return [q['sql'] for q in primary], [q['sql'] for q in replica]
+
+    def test_analytics_reads_go_to_the_replica(self):
+        primary, replica = self.queries_by_alias(reverse('expense_list'))
+        self.assertTrue(any('expenses_monthlyspending' in sql for sql in replica))
+        # The list of expenses itself is read from the primary
+        self.assertTrue(any('FROM "expenses_expense"' in sql for sql in primary))
+        self.assertFalse(any('expenses_monthlyspending' in sql for sql in primary))
+
+        for url in (reverse('category_list'), reverse('group_list'),
+                    reverse('admin:expenses_userexpensesummary_changelist')):
+            primary, replica = self.queries_by_alias(url)
+            self.assertTrue(replica, url)
+            # Only the session and user lookups stay on the primary
+            self.assertFalse([sql for sql in primary if 'expenses_' in sql], url)
+
+    def test_writes_pin_the_user_to_the_primary(self):
+        self.queries_by_alias(reverse('group_create'), 'post', {'name': 'Flat', 'description': ''})
+        _, replica = self.queries_by_alias(reverse('group_list'))
+        self.assertEqual(replica, [])
+        _, replica = self.queries_by_alias(reverse('category_list'))
+        self.assertEqual(replica, [])
+
+
+class ShardPlanTest(UnshardedTestCase):
+    def test_moves_the_largest_users_that_narrow_the_gap(self):
+        loads = {'shard0': {1: 50, 2: 30, 3: 20}, 'shard1': {4: 10}, 'shard2': {}}
+        moves = sharding.plan_rebalance(loads)
+        self.assertEqual(moves[:2], [(1, 'shard0', 'shard2'), (2, 'shard0', 'shard1')])
+        totals = {shard: sum(users.values()) for shard, users in loads.items()}
+        for user_id, source, target in moves:
+            rows = loads[source][user_id]
+            totals[source] -= rows
+            totals[target] += rows
+        self.assertEqual(sorted(totals.values()), [20, 40, 50])
+        self.assertEqual(sharding.plan_rebalance(loads, max_moves=1), moves[:1])
+        self.assertEqual(sharding.plan_rebalance({'shard0': {1: 5}, 'shard1': {}}), [])
+
+    @override_settings(EXPENSES_SHARDS=[])
+    def test_inactive_without_shards(self):
+        router = routers.ShardRouter()
+        user = User.objects.create_user('solo')
+        self.assertIsNone(router.db_for_read(Expense, instance=user))
+        self.assertIsNone(router.allow_relation(user, Category(user=user)))
+        self.assertEqual(sharding.db_for_user(user.pk), 'default')
+
+
+@unittest.skipUnless(len(settings.EXPENSES_SHARDS) >= 2, 'set SHARD_DATABASE_URLS to two or more databases')
+@stub_display_templates
+class ShardedTestCase(TestCase):
+    databases = '__all__'
+
+    @classmethod
+    def setUpClass(cls):
+        # The cut-over a sharded deployment starts with; SQLite can't alter
+        # tables inside the transaction each test runs in
+        call_command('shard_existing_rows', stdout=StringIO())
+        super().setUpClass()
+
+    def setUp(self):
+        cache.clear()
+        # Placements cached by other tests refer to rolled-back rows
+        sharding.forget()
+        self.addCleanup(sharding.forget)
+
+
+class ShardCutOverTest(ShardedTestCase):
+    def test_rows_kept_on_default_move_to_their_shards(self):
+        # Data stored before sharding was turned on
+        with override_settings(EXPENSES_SHARDS=[]):
+            user = User.objects.create_user('unsharded')
+            category = Category.objects.create(name='Food', user=user)
+            Expense.objects.create(title='Lunch', amount=Decimal('8.00'), category=category,
+                                   user=user, date=date(2024, 1, 5))
+        shard = sharding.db_for_user(user.pk)
+        out = StringIO()
+        call_command('shard_existing_rows', stdout=out)
+        self.assertIn(f'Moved user {user.pk} from default to {shard}', out.getvalue())
+        for model in (Category, Expense, DailySpending, MonthlySpending):
+            self.assertFalse(model.objects.using('default').exists(), model)
+            self.assertTrue(model.objects.using(shard).filter(user=user).exists(), model)
+        self.assertEqual(Expense.objects.get(user=user).category, category)
+        self.assertEqual(rollups.find_drift([user.pk]), [])
+
+        call_command('shard_existing_rows', stdout=out)
+        self.assertIn('Moved 0 user(s) to their shards.', out.getvalue())
+
+    def test_rows_stay_on_default_while_the_user_moves(self):
+        with override_settings(EXPENSES_SHARDS=[]):
+            user = User.objects.create_user('unsharded')
+            Category.objects.create(name='Food', user=user)
+        sharding.placement(user.pk)
+        UserShard.objects.filter(user=user).update(moving_to=settings.EXPENSES_SHARDS[0])
+        sharding.forget(user.pk)
+        with self.assertRaises(sharding.UserMoving):
+            sharding.adopt_global_rows(user.pk)
+        self.assertTrue(Category.objects.using('default').filter(user=user).exists())
+
+    def test_cross_shard_constraints_are_dropped_once(self):
+        for alias in ['default', *settings.EXPENSES_SHARDS]:
+            self.assertEqual(sharding.drop_cross_shard_constraints(alias), [])
+
+
+class ShardingTest(ShardedTestCase):
+    def setUp(self):
+        super().setUp()
+        # Placement goes by id parity, so consecutive users land apart
+        self.users = [User.objects.create_user(f'sharded{i}', password='secret') for i in range(2)]
+        self.shards = [sharding.db_for_user(user.pk) for user in self.users]
+        self.assertNotEqual(self.shards[0], self.shards[1])
+        self.categories = []
+        for user in self.users:
+            category = Category.objects.create(name='Food', user=user)
+            Expense.objects.create(title='Lunch', amount=Decimal('12.00'), category=category,
+                                   user=user, date=date(2024, 1, 5))
+            self.categories.append(category)
+
+    def test_rows_live_on_their_owners_shard(self):
+        for user, shard in zip(self.users, self.shards):
+            self.assertEqual(Expense.objects.using(shard).filter(user=user).count(), 1)
+            self.assertEqual(MonthlySpending.objects.using(shard).get(user=user).total, Decimal('12.00'))
+            self.assertEqual(Expense.objects.using('default').filter(user=user).count(), 0)
+            # Found without naming the shard, from the manager or the user
+            self.assertEqual(Expense.objects.filter(user=user).get().category.name, 'Food')
+            self.assertEqual(user.expenses.count(), 1)
+            self.assertEqual(rollups.find_drift([user.pk]), [])
+        # Keys come from one allocator, so they never collide across shards
+        self.assertNotEqual(self.categories[0].pk, self.categories[1].pk)
+        with self.assertRaises(sharding.CrossShardQuery):
+            list(Expense.objects.filter(user__in=self.users))
+
+    def test_views_read_and_write_the_users_shard(self):
+        user, shard = self.users[1], self.shards[1]
+        self.client.force_login(user)
+        response = self.client.post(reverse('expense_create'), {
+            'title': 'Taxi', 'amount': '30.00', 'category': self.categories[1].pk,
+            'description': '', 'date': '2024-01-06',
+        })
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Expense.objects.using(shard).filter(user=user).count(), 2)
+        response = self.client.get(reverse('expense_list'), {'period': 'all'})
+        self.assertContains(response, 'Taxi')
+        self.assertEqual(response.context['total_amount'], Decimal('42.00'))
+
+        imports.import_expenses(user, ['title,amount,category,date', 'Bus,2.50,Travel,2024-01-07'])
+        self.assertTrue(Category.objects.using(shard).filter(user=user, name='Travel').exists())
+        self.assertEqual(rollups.find_drift([user.pk]), [])
+
+    def test_shared_expense_categories_come_from_the_payers_shard(self):
+        group = Group.objects.create(name='Trip', created_by=self.users[0])
+        for user in self.users:
+            GroupMember.objects.create(group=group, user=user)
+        for user, category in zip(self.users, self.categories):
+            category.name = f'Food of {user.username}'
+            category.save()
+            SharedExpense.objects.create(title='Dinner', amount=Decimal('20.00'), group=group,
+                                         paid_by=user, category=category)
+        self.client.force_login(self.users[0])
+        response = self.client.get(reverse('group_detail', args=[group.pk]))
+        for user in self.users:
+            self.assertContains(response, f'Food of {user.username}')
+        self.assertEqual(
+            list(forms.SharedExpenseForm(group=group, payer=self.users[0]).fields['category'].queryset),
+            [self.categories[0]],
+        )
+
+    def test_rebalance_moves_a_user_and_keeps_their_data(self):
+        user, source = self.users[0], self.shards[0]
+        target = self.shards[1]
+        expense = Expense.objects.get(user=user)
+        call_command('rebalance_shards', '--user', user.username, '--to', target,
+                     stdout=StringIO())
+
+        self.assertEqual(UserShard.objects.get(user=user).shard, target)
+        self.assertEqual(sharding.db_for_user(user.pk), target)
+        for model in (Category, Expense, DailySpending, MonthlySpending):
+            self.assertFalse(model.objects.using(source).filter(user=user).exists(), model)
+            self.assertTrue(model.objects.using(target).filter(user=user).exists(), model)
+        moved = Expense.objects.get(user=user)
+        self.assertEqual((moved.pk, moved.created_at, moved.updated_at, moved.category_id),
+                         (expense.pk, expense.created_at, expense.updated_at, expense.category_id))
+        self.assertEqual(rollups.find_drift([user.pk]), [])
+
+        out = StringIO()
+        call_command('rebalance_shards', '--even', '--dry-run', stdout=out)
+        self.assertIn('Would move', out.getvalue())
+
+    def test_writes_are_refused_while_a_user_moves(self):
+        user = self.users[0]
+        UserShard.objects.filter(user=user).update(moving_to=self.shards[1])
+        sharding.forget(user.pk)
+        with self.assertRaises(sharding.UserMoving):
+            Expense.objects.create(title='Late', amount=Decimal('1.00'), category=self.categories[0], user=user)
+        # Reads still work
+        self.assertEqual(Expense.objects.filter(user=user).count(), 1)
+
+    def test_admin_reads_and_writes_every_shard(self):
+        self.client.force_login(User.objects.create_superuser('root', 'root@example.com', 'secret'))
+        url = reverse('admin:expenses_expense_changelist')
+        for user, shard, category in zip(self.users, self.shards, self.categories):
+            for query in ({'shard': shard}, {'user__id__exact': user.pk}):
+                response = self.client.get(url, query)
+                self.assertEqual([expense.user for expense in response.context['cl'].result_list], [user])
+            response = self.client.get(reverse('admin:expenses_category_changelist'), {'shard': shard})
+            self.assertEqual(list(response.context['cl'].result_list), [category])
+
+        user, shard = self.users[1], self.shards[1]
+        expense = Expense.objects.get(user=user)
+        change_url = reverse('admin:expenses_expense_change', args=[expense.pk])
+        self.assertEqual(list(self.client.get(change_url).context['adminform'].form.fields['category'].queryset),
+                         [self.categories[1]])
+        response = self.client.post(change_url, {
+            'title': 'Brunch', 'amount': '15.00', 'category': self.categories[1].pk,
+            'description': '', 'date': '2024-01-05',
+        })
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Expense.objects.get(user=user).title, 'Brunch')
+        self.assertEqual(rollups.find_drift([user.pk]), [])
+
+        response = self.client.get('/admin/expenses/userexpensesummary/', {'o': '1'})
+        rows = [(row.username, row._total_amount, row._total_count, row._categories_count)
+                for row in response.context['cl'].result_list]
+        self.assertEqual(rows, [
+            ('root', 0, 0, 0), ('sharded0', Decimal('12.00'), 1, 1), ('sharded1', Decimal('15.00'), 1, 1),
+        ])
+
+        self.client.post(f'{url}?shard={shard}', {
+            'action': 'delete_selected_expenses', '_selected_action': [expense.pk],
+        })
+        self.assertFalse(Expense.objects.filter(user=user).exists())
+        self.assertEqual(Expense.objects.filter(user=self.users[0]).count(), 1)
+
+    def test_writes_check_the_placement_past_the_cache(self):
+        user, source, target = self.users[0], self.shards[0], self.shards[1]
+        # Another process marks the user as moving; this one's cache still has them settled
+        UserShard.objects.filter(user=user).update(moving_to=target)
+        with self.assertRaises(sharding.UserMoving):
+            with sharding.atomic(user.pk):
+                Expense.objects.filter(user=user).delete()
+        self.assertEqual(Expense.objects.filter(user=user).count(), 1)
+
+        # ... and later finishes the move, which this process hasn't seen either
+        sharding.move_user(user.pk, target)
+        UserShard.objects.filter(user=user).update(shard=source)
+        sharding.placement(user.pk)
+        UserShard.objects.filter(user=user).update(shard=target)
+        with sharding.atomic(user.pk) as alias:
+            self.assertEqual(alias, target)
+            self.assertEqual(sharding.db_for_user(user.pk, for_write=True), target)
+
+    def test_deleting_a_user_clears_their_shard(self):
+        user, shard = self.users[0], self.shards[0]
+        user.delete()
+        for model in (Category, Expense, DailySpending, MonthlySpending):
+            self.assertFalse(model.objects.using(shard).filter(user_id=user.pk).exists(), model)
@@ -2,6 +2,7 @@ from django.urls import path
 from . import views
 from . import auth_views
 from . import group_views
+from . import diagnostics_views
 
 urlpatterns = [
     # Authentication URLs
@@ -11,6 +12,9 @@ urlpatterns = [
     
     # Expense URLs
     path('', views.expense_list, name='expense_list'),
+    path('expenses/chart-data/', views.expense_chart_data, name='expense_chart_data'),
+    path('expenses/export/', views.expense_export, name='expense_export'),
+    path('expenses/import/', views.expense_import, name='expense_import'),
     path('expense/add/', views.expense_create, name='expense_create'),
     path('expense/<int:pk>/edit/', views.expense_update, name='expense_update'),
     path('expense/<int:pk>/delete/', views.expense_delete, name='expense_delete'),
@@ -25,6 +29,7 @@ urlpatterns = [
     path('groups/', group_views.group_list, name='group_list'),
     path('groups/create/', group_views.group_create, name='group_create'),
     path('groups/<int:pk>/', group_views.group_detail, name='group_detail'),
+    path('groups/<int:pk>/settle-up/', group_views.group_settlement_plan, name='group_settlement_plan'),
     path('groups/<int:pk>/join/', group_views.group_join, name='group_join'),
     path('groups/<int:pk>/leave/', group_views.group_leave, name='group_leave'),
     path('groups/<int:pk>/members/', group_views.group_members, name='group_members'),
@@ -34,4 +39,13 @@ urlpatterns = [
     path('groups/<int:group_pk>/expense/add/', group_views.shared_expense_create, name='shared_expense_create'),
     path('shared-expense/<int:pk>/', group_views.shared_expense_detail, name='shared_expense_detail'),
     path('expense-split/<int:split_pk>/settle/', group_views.settle_expense, name='settle_expense'),
+    path('groups/<int:pk>/settle-with/<int:user_pk>/', group_views.settle_up_with, name='settle_up_with'),
+    
+    # Async versions of the heaviest pages, for ASGI servers
+    path('async/', views.expense_list_async, name='expense_list_async'),
+    path('async/groups/<int:pk>/', group_views.group_detail_async, name='group_detail_async'),
+    
+    # Diagnostics (staff only)
+    path('diagnostics/slow-queries/', diagnostics_views.slow_query_list, name='slow_query_list'),
+    path('metrics', diagnostics_views.metrics_view, name='metrics'),
 ]
@@ -1,13 +1,112 @@
+from asgiref.sync import sync_to_async
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.db.models import Sum, Count
+from django.http import HttpResponseBadRequest, JsonResponse
+from django.urls import reverse
 from django.utils import timezone
-from datetime import timedelta
-from collections import defaultdict
-import json
+from django.utils.dateparse import parse_date
+from django.utils.http import urlencode
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
+import asyncio
+import csv
+import hashlib
+import io
+from . import aggregation, caching, exports, imports, pagination, rollups, routers, sharding
 from .models import Expense, Category
-from .forms import ExpenseForm, CategoryForm
+from .forms import ExpenseForm, CategoryForm, ExpenseImportForm
+
+
+IMPORT_ERRORS_SHOWN = 100
+
+
+def _period_variant(period):
+    return f'{period.key}:{period.start}:{period.end}'
+
+
+def _dashboard_summary(user, period):
+    """
+    Summary figures for ``period``: total, item count and category breakdown.
+
+    Aggregated in SQL from the spending rollups rather than from individual
+    expenses, on the read replica if there is one, and cached until the
+    user's data next changes.
+    """
+    def compute():
+        with routers.read_from_replica(user.pk):
+            summary = aggregation.summarize(rollups.spending_queryset(user, period.start, period.end))
+        return {
+            'total_amount': summary['total'],
+            'expense_count': summary['count'],
+            'expenses_by_category': summary['by_category'],
+        }
+
+    return caching.get_dashboard(user.pk, f'summary:{_period_variant(period)}', compute)
+
+
+async def _adashboard_summary(user, period):
+    """``_dashboard_summary()`` for async views, aggregating without a thread hop."""
+    async def compute():
+        with routers.read_from_replica(user.pk):
+            summary = await aggregation.asummarize(rollups.spending_queryset(user, period.start, period.end))
+        return {
+            'total_amount': summary['total'],
+            'expense_count': summary['count'],
+            'expenses_by_category': summary['by_category'],
+        }
+
+    return await caching.aget_dashboard(user.pk, f'summary:{_period_variant(period)}', compute)
+
+
+def _chart_data(user, period):
+    """Pie and trend chart series for ``period``, cached like the summary."""
+    def compute():
+        with routers.read_from_replica(user.pk):
+            summary = aggregation.summarize(
+                rollups.spending_queryset(user, period.start, period.end),
+                period.granularity,
+            )
+        category_labels, category_data, trend_labels, trend_amounts = aggregation.chart_series(summary, period)
+        return {
+            'period': period.key,
+            'label': period.label,
+            'total': float(summary['total']),
+            'categories': {'labels': category_labels, 'data': category_data},
+            'trend': {'labels': trend_labels, 'data': trend_amounts},
+        }
+
+    return caching.get_dashboard(user.pk, f'chart:{_period_variant(period)}', compute)
+
+
+def _requested_period(request):
+    """
+    The period asked for by ``?period=`` or an explicit ``?start=``/``?end=``.
+
+    Raises ValueError for malformed or inverted dates.
+    """
+    today = timezone.now().date()
+    start, end = request.GET.get('start'), request.GET.get('end')
+    if not (start or end):
+        return aggregation.resolve_period(request.GET.get('period', 'all'), today)
+    bounds = []
+    for value in (start, end):
+        parsed = parse_date(value) if value else None
+        if value and parsed is None:
+            raise ValueError(f'Invalid date: {value}')
+        bounds.append(parsed)
+    return aggregation.custom_period(*bounds, today)
+
+
+def _chart_etag(request):
+    try:
+        period = _requested_period(request)
+    except ValueError:
+        return None
+    version = caching.data_version(request.user.pk)
+    key = f'{request.user.pk}:{version}:{_period_variant(period)}'
+    return hashlib.md5(key.encode(), usedforsecurity=False).hexdigest()
 
 
 @login_required
@@ -18,101 +117,152 @@ def expense_list(request):
     """
     # Get filter parameter from request
     time_filter = request.GET.get('period', 'all')
+    period = aggregation.resolve_period(time_filter, timezone.now().date())
     
     # Base queryset - filter by current user
-    expenses = Expense.objects.filter(user=request.user).select_related('category')
-    
-    # Apply time filter
-    now = timezone.now()
-    if time_filter == 'daily':
-        start_date = now.date()
-        expenses = expenses.filter(date=start_date)
-        period_label = "Today"
-    elif time_filter == 'weekly':
-        start_date = now.date() - timedelta(days=now.weekday())  # Start of current week (Monday)
-        expenses = expenses.filter(date__gte=start_date)
-        period_label = "This Week"
-    elif time_filter == 'monthly':
-        start_date = now.date().replace(day=1)  # Start of current month
-        expenses = expenses.filter(date__gte=start_date)
-        period_label = "This Month"
-    else:
-        period_label = "All Time"
+    expenses = aggregation.filter_dates(
+        Expense.objects.filter(user=request.user).select_related('category'),
+        period.start, period.end,
+    )
     
     categories = Category.objects.filter(user=request.user)
     
-    # Calculate total expenses for the filtered period
-    total_amount = expenses.aggregate(total=Sum('amount'))['total'] or 0
-    
-    # Get expenses by category for the filtered period
-    expenses_by_category = expenses.values('category__name').annotate(
-        total=Sum('amount'),
-        count=Count('id')
-    ).order_by('-total')
-    
-    # Prepare data for pie chart (category breakdown)
-    category_labels = [item['category__name'] for item in expenses_by_category]
-    category_data = [float(item['total']) for item in expenses_by_category]
-    
-    # Convert queryset to list to avoid SQLite issues with iteration
-    expenses_list = list(expenses)
-    
-    # Prepare data for line chart (spending over time)
-    trend_labels = []
-    trend_amounts = []
-    
-    if time_filter == 'daily':
-        # For daily view, show just today's total
-        trend_labels = ['Today']
-        trend_amounts = [float(total_amount)]
-    elif time_filter == 'weekly':
-        # Show daily breakdown for the week - group by date in Python
-        daily_totals = defaultdict(float)
-        for expense in expenses_list:
-            daily_totals[expense.date] += float(expense.amount)
-        
-        # Sort by date and format
-        sorted_dates = sorted(daily_totals.keys())
-        trend_labels = [d.strftime('%a') for d in sorted_dates]
-        trend_amounts = [daily_totals[d] for d in sorted_dates]
-    elif time_filter == 'monthly':
-        # Show daily breakdown for the month - group by date in Python
-        daily_totals = defaultdict(float)
-        for expense in expenses_list:
-            daily_totals[expense.date] += float(expense.amount)
-        
-        # Sort by date and format
-        sorted_dates = sorted(daily_totals.keys())
-        trend_labels = [d.strftime('%b %d') for d in sorted_dates]
-        trend_amounts = [daily_totals[d] for d in sorted_dates]
-    else:
-        # Show monthly breakdown for all time - group by month in Python
-        monthly_totals = defaultdict(float)
-        for expense in expenses_list:
-            month_key = expense.date.replace(day=1)  # First day of month
-            monthly_totals[month_key] += float(expense.amount)
-        
-        # Sort by date and format
-        sorted_months = sorted(monthly_totals.keys())
-        trend_labels = [m.strftime('%b %Y') for m in sorted_months]
-        trend_amounts = [monthly_totals[m] for m in sorted_months]
+    # Summary figures are cached per user and period; the charts are
+    # fetched separately from expense_chart_data
+    dashboard = _dashboard_summary(request.user, period)
+    
+    # Only one page of expenses is loaded; ?cursor= moves between pages
+    page = pagination.paginate_request(request, expenses)
     
     context = {
-        'expenses': expenses,
+        'expenses': page.object_list,
+        'page': page,
         'categories': categories,
-        'total_amount': total_amount,
-        'expenses_by_category': expenses_by_category,
         'time_filter': time_filter,
-        'period_label': period_label,
-        # Chart data
-        'category_labels_json': json.dumps(category_labels),
-        'category_data_json': json.dumps(category_data),
-        'trend_labels_json': json.dumps(trend_labels),
-        'trend_amounts_json': json.dumps(trend_amounts),
+        'period_label': period.label,
+        'chart_data_url': f"{reverse('expense_chart_data')}?{urlencode({'period': period.key})}",
+        **dashboard,
     }
     return render(request, 'expenses/expense_list.html', context)
 
 
+@login_required
+async def expense_list_async(request):
+    """
+    Async version of expense_list for ASGI servers.
+
+    The cached summary, the page of expenses and the category list don't
+    depend on each other, so they are requested at the same time.
+    """
+    user = await request.auser()
+    time_filter = request.GET.get('period', 'all')
+    period = aggregation.resolve_period(time_filter, timezone.now().date())
+    
+    expenses = aggregation.filter_dates(
+        Expense.objects.filter(user=user).select_related('category'),
+        period.start, period.end,
+    )
+    categories = Category.objects.filter(user=user)
+    
+    async def load_categories():
+        # Fills the queryset's result cache, so the template reuses the rows
+        async for _ in categories:
+            pass
+    
+    dashboard, page, _ = await asyncio.gather(
+        _adashboard_summary(user, period),
+        pagination.apaginate_request(request, expenses),
+        load_categories(),
+    )
+    
+    context = {
+        'expenses': page.object_list,
+        'page': page,
+        'categories': categories,
+        'time_filter': time_filter,
+        'period_label': period.label,
+        'chart_data_url': f"{reverse('expense_chart_data')}?{urlencode({'period': period.key})}",
+        **dashboard,
+    }
+    # Rendered in a thread: templates may follow relations lazily, which
+    # the ORM only allows from sync code
+    return await sync_to_async(render)(request, 'expenses/expense_list.html', context)
+
+
+@login_required
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=_chart_etag)
+def expense_chart_data(request):
+    """
+    Chart data for the dashboard as JSON, fetched by the page after it loads.
+
+    Accepts the same ``period`` values as the list, or an explicit
+    ``start``/``end`` date range. Responses carry an ETag derived from the
+    user's data version, so unchanged polls get a 304 without recomputation.
+    """
+    try:
+        period = _requested_period(request)
+    except ValueError as exc:
+        return JsonResponse({'error': str(exc)}, status=400)
+    return JsonResponse(_chart_data(request.user, period), json_dumps_params={'separators': (',', ':')})
+
+
+@login_required
+def expense_export(request):
+    """
+    Download the user's own expenses as CSV, streamed row batch by row batch.
+
+    ``start``/``end`` restrict the date range; ``?gzip=1`` compresses the file.
+    """
+    start, end = request.GET.get('start'), request.GET.get('end')
+    bounds = []
+    for value in (start, end):
+        parsed = parse_date(value) if value else None
+        if value and parsed is None:
+            return HttpResponseBadRequest(f'Invalid date: {value}')
+        bounds.append(parsed)
+    
+    expenses = aggregation.filter_dates(Expense.objects.filter(user=request.user), *bounds)
+    return exports.export_response(
+        expenses.order_by('date', 'created_at', 'id'),
+        filename=f'expenses-{request.user.username}',
+        compress=request.GET.get('gzip') == '1',
+    )
+
+
+@login_required
+def expense_import(request):
+    """
+    Import expenses from an uploaded CSV file.
+    
+    Valid rows are inserted in batches; rows that fail validation are
+    listed back to the user instead of stopping the import.
+    """
+    result = None
+    if request.method == 'POST':
+        form = ExpenseImportForm(request.POST, request.FILES)
+        if form.is_valid():
+            lines = io.TextIOWrapper(form.cleaned_data['file'].file, encoding='utf-8-sig', newline='')
+            try:
+                result = imports.import_expenses(request.user, lines)
+            except (imports.InvalidImportFile, UnicodeDecodeError, csv.Error) as exc:
+                form.add_error('file', str(exc))
+            else:
+                messages.success(request, f'Imported {result.created} expenses.')
+                if not result.errors:
+                    return redirect('expense_list')
+                messages.warning(request, f'{len(result.errors)} rows were skipped.')
+    else:
+        form = ExpenseImportForm()
+    
+    return render(request, 'expenses/expense_import.html', {
+        'form': form,
+        'result': result,
+        # The report is capped so a badly broken file doesn't produce a huge page
+        'row_errors': result.errors[:IMPORT_ERRORS_SHOWN] if result else [],
+    })
+
+
 @login_required
 def expense_create(request):
     """
@@ -123,7 +273,8 @@ def expense_create(request):
         if form.is_valid():
             expense = form.save(commit=False)
             expense.user = request.user
-            expense.save()
+            with sharding.atomic(request.user.pk):
+                expense.save()
             messages.success(request, 'Expense added successfully!')
             return redirect('expense_list')
     else:
@@ -142,7 +293,8 @@ def expense_update(request, pk):
     if request.method == 'POST':
         form = ExpenseForm(request.POST, instance=expense, user=request.user)
         if form.is_valid():
-            form.save()
+            with sharding.atomic(request.user.pk):
+                form.save()
             messages.success(request, 'Expense updated successfully!')
             return redirect('expense_list')
     else:
@@ -159,7 +311,8 @@ def expense_delete(request, pk):
     expense = get_object_or_404(Expense, pk=pk, user=request.user)
     
     if request.method == 'POST':
-        expense.delete()
+        with sharding.atomic(request.user.pk):
+            expense.delete()
         messages.success(request, 'Expense deleted successfully!')
         return redirect('expense_list')
     
@@ -167,6 +320,7 @@ def expense_delete(request, pk):
 
 
 @login_required
+@routers.replica_reads
 def category_list(request):
     """
     Display a list of all categories.
@@ -192,7 +346,8 @@ def category_create(request):
         if form.is_valid():
             category = form.save(commit=False)
             category.user = request.user
-            category.save()
+            with sharding.atomic(request.user.pk):
+                category.save()
             messages.success(request, 'Category added successfully!')
             return redirect('category_list')
     else:
@@ -211,7 +366,8 @@ def category_update(request, pk):
     if request.method == 'POST':
         form = CategoryForm(request.POST, instance=category)
         if form.is_valid():
-            form.save()
+            with sharding.atomic(request.user.pk):
+                form.save()
             messages.success(request, 'Category updated successfully!')
             return redirect('category_list')
     else:
@@ -228,7 +384,8 @@ def category_delete(request, pk):
     category = get_object_or_404(Category, pk=pk, user=request.user)
     
     if request.method == 'POST':
-        category.delete()
+        with sharding.atomic(request.user.pk):
+            category.delete()
         messages.success(request, 'Category deleted successfully!')
         return redirect('category_list')
     